@@ -31,6 +31,11 @@ void ycap_can_recv_callback(CanControllerIdType channel, CANMsgElement_t *messag
 
 void yacp_can_init()
 {
+#ifdef YACP_EXTENDED_ADDRESSING
+	// The command IDs vary with the message type and a single slot only receives
+	// one of them, so receive all traffic through the CAN RX callback instead
+	F_Abstr_CAN_InstallRxSltCall(ycap_can_recv_callback);
+#else
 	// Option 1) Use a slot for receiving filtered traffic, polling
 
 	// Define the following somewhere pointed at the real slot
@@ -46,6 +51,7 @@ void yacp_can_init()
 
 	// Option 2) Use the CAN RX callback for receiving all traffic
 	//F_Abstr_CAN_InstallRxSltCall(ycap_can_recv_callback);
+#endif
 
 	yacp_can_msg.extended = 0;
 	yacp_can_msg.length = 8;
@@ -55,6 +61,7 @@ void yacp_can_init()
 void yacp_can_send(uint32_t id, uint8_t* buf)
 {
 	yacp_can_msg.id = id;
+	yacp_can_msg.extended = id > 0x7FF;
 
 	uint8_t i;
 	for (i=0; i<8; i++)
@@ -65,16 +72,18 @@ void yacp_can_send(uint32_t id, uint8_t* buf)
 
 void yacp_can_recv()
 {
+#ifndef YACP_EXTENDED_ADDRESSING
 	// Polling style receive, call from the main loop periodically
 	if (1 == F_Abstr_CAN_ReceiveDirect(&CAN_B_YACP_CMD, &yacp_can_msg_in))
 	{
 		yacp_handle_can(yacp_can_msg_in.id, yacp_can_msg_in.data);
 	}
+#endif
 }
 
 void ycap_can_recv_callback(CanControllerIdType channel, CANMsgElement_t *messageObj)
 {
-	if (channel == CAN_CTRL_B)
+	if (channel == CAN_CTRL_B && YACP_IS_COMMAND_ID(messageObj->id))
 	{
 		yacp_handle_can(messageObj->id, messageObj->data);
 	}
@@ -113,7 +122,7 @@ void yacp_memcpy(void* s1, const void* s2, uint16_t n)
 	}
 }
 
-void yacp_update_setting(uint8_t* dst, uint16_t var_start, uint8_t var_len, uint8_t* buf)
+void yacp_update_setting(uint8_t* dst, uint32_t var_start, uint8_t var_len, uint8_t* buf)
 {
 	uint32_t value32;
 	uint16_t value16;
@@ -0,0 +1,382 @@
+/*
+ * yacp_driver_linux.c
+ * Yet Another Calibration Protocol (YACP)
+ *
+ * This is a driver for running the YACP core as a native Linux process, e.g. as a
+ * device simulator for testing host tools (see yacp_sim_linux.c).
+ *
+ * CAN frames go over SocketCAN (can0, vcan0, ...), or where SocketCAN is not
+ * available over TCP to one host speaking the socketcand raw mode protocol, which
+ * python-can opens as the socketcand interface. The EEPROM is kept in a file.
+ *
+ * Matthew Bergman 2021
+ *
+ * MIT license, all text above must be included in any redistribution.
+ * See license.txt at the root of the repository for full license text.
+ */
+
+#include "yacp.h"
+#include "yacp_api.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <poll.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/ioctl.h>
+#include <sys/socket.h>
+#include <net/if.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <arpa/inet.h>
+#include <linux/can.h>
+#include <linux/can/raw.h>
+
+#ifndef YACP_LINUX_EEPROM_SIZE
+#define YACP_LINUX_EEPROM_SIZE 4096
+#endif
+
+// Longest socketcand message kept while waiting for its end
+#define YACP_LINUX_LINE_SIZE 256
+
+// Set by the main code before yacp_can_init() and yacp_init().
+// A port serves socketcand on localhost instead of opening the SocketCAN channel.
+const char* yacp_linux_channel = "vcan0";
+int yacp_linux_port = 0;
+const char* yacp_linux_eeprom_file = "yacp-eeprom.bin";
+
+int yacp_linux_can_fd = -1;
+int yacp_linux_listen_fd = -1;
+int yacp_linux_client_fd = -1;
+bool yacp_linux_rawmode;
+char yacp_linux_line[YACP_LINUX_LINE_SIZE];
+size_t yacp_linux_line_len;
+
+uint8_t yacp_linux_eeprom[YACP_LINUX_EEPROM_SIZE];
+bool yacp_linux_eeprom_loaded;
+
+void yacp_linux_client_write(const char* msg)
+{
+  if (yacp_linux_client_fd < 0)
+    return;
+
+  // A host that went away is noticed by the next receive
+  send(yacp_linux_client_fd, msg, strlen(msg), MSG_NOSIGNAL);
+}
+
+void yacp_linux_client_close()
+{
+  close(yacp_linux_client_fd);
+  yacp_linux_client_fd = -1;
+  yacp_linux_rawmode = false;
+  yacp_linux_line_len = 0;
+}
+
+void yacp_can_init()
+{
+  if (yacp_linux_port != 0)
+  {
+    struct sockaddr_in addr;
+    int on = 1;
+
+    yacp_linux_listen_fd = socket(AF_INET, SOCK_STREAM | SOCK_NONBLOCK, 0);
+    setsockopt(yacp_linux_listen_fd, SOL_SOCKET, SO_REUSEADDR, &on, sizeof(on));
+
+    memset(&addr, 0, sizeof(addr));
+    addr.sin_family = AF_INET;
+    addr.sin_port = htons(yacp_linux_port);
+    addr.sin_addr.s_addr = htonl(INADDR_LOOPBACK);
+
+    if (bind(yacp_linux_listen_fd, (struct sockaddr*)&addr, sizeof(addr)) < 0 || listen(yacp_linux_listen_fd, 1) < 0)
+    {
+      perror("yacp: socketcand port");
+      exit(1);
+    }
+    return;
+  }
+
+  struct sockaddr_can addr;
+  struct ifreq ifr;
+  struct can_filter filter;
+
+  yacp_linux_can_fd = socket(PF_CAN, SOCK_RAW, CAN_RAW);
+  if (yacp_linux_can_fd < 0)
+  {
+    perror("yacp: SocketCAN");
+    exit(1);
+  }
+
+  memset(&ifr, 0, sizeof(ifr));
+  strncpy(ifr.ifr_name, yacp_linux_channel, IFNAMSIZ - 1);
+  if (ioctl(yacp_linux_can_fd, SIOCGIFINDEX, &ifr) < 0)
+  {
+    perror(yacp_linux_channel);
+    exit(1);
+  }
+
+  memset(&addr, 0, sizeof(addr));
+  addr.can_family = AF_CAN;
+  addr.can_ifindex = ifr.ifr_ifindex;
+  if (bind(yacp_linux_can_fd, (struct sockaddr*)&addr, sizeof(addr)) < 0)
+  {
+    perror(yacp_linux_channel);
+    exit(1);
+  }
+
+  // Only commands are received, so the responses of the other nodes on the bus cost nothing
+#ifdef YACP_EXTENDED_ADDRESSING
+  filter.can_id = YACP_EXT_COMMAND_BASE | CAN_EFF_FLAG;
+  filter.can_mask = YACP_EXT_COMMAND_MASK | CAN_EFF_FLAG | CAN_RTR_FLAG;
+#else
+  filter.can_id = YACP_COMMAND_ID;
+  filter.can_mask = CAN_SFF_MASK | CAN_EFF_FLAG | CAN_RTR_FLAG;
+#endif
+  setsockopt(yacp_linux_can_fd, SOL_CAN_RAW, CAN_RAW_FILTER, &filter, sizeof(filter));
+}
+
+void yacp_can_send(uint32_t id, uint8_t* buf)
+{
+  if (yacp_linux_can_fd >= 0)
+  {
+    struct can_frame frame;
+
+    memset(&frame, 0, sizeof(frame));
+    frame.can_id = id > 0x7FF ? (id | CAN_EFF_FLAG) : id;
+    frame.can_dlc = 8;
+    memcpy(frame.data, buf, 8);
+
+    // A full TX queue drops the frame like a lost frame on a real bus
+    send(yacp_linux_can_fd, &frame, sizeof(frame), MSG_DONTWAIT);
+    return;
+  }
+
+  if (!yacp_linux_rawmode)
+    return;
+
+  // socketcand tells extended IDs apart by their 8 digits
+  char msg[64];
+  struct timespec now;
+  clock_gettime(CLOCK_REALTIME, &now);
+
+  snprintf(msg, sizeof(msg), id > 0x7FF ? "< frame %08X %ld.%06ld %02X%02X%02X%02X%02X%02X%02X%02X >" : "< frame %03X %ld.%06ld %02X%02X%02X%02X%02X%02X%02X%02X >",
+    (unsigned int)id, (long)now.tv_sec, (long)now.tv_nsec / 1000, buf[0], buf[1], buf[2], buf[3], buf[4], buf[5], buf[6], buf[7]);
+  yacp_linux_client_write(msg);
+}
+
+// Handles one socketcand message from the host, without the < and >
+void yacp_linux_handle_message(char* msg)
+{
+  char* cmd = strtok(msg, " ");
+  if (cmd == NULL)
+    return;
+
+  if (strcmp(cmd, "open") == 0 || strcmp(cmd, "rawmode") == 0)
+  {
+    // There is one channel, whatever it is called
+    yacp_linux_rawmode = strcmp(cmd, "rawmode") == 0;
+    yacp_linux_client_write("< ok >");
+  }
+  else if (strcmp(cmd, "send") == 0 && yacp_linux_rawmode)
+  {
+    // < send ID LEN B0 B1 ... >, all in hex
+    char* field = strtok(NULL, " ");
+    uint8_t buf[8] = {0};
+    uint32_t id;
+    unsigned long len;
+    unsigned long i;
+
+    if (field == NULL)
+      return;
+    id = strtoul(field, NULL, 16);
+
+    field = strtok(NULL, " ");
+    if (field == NULL)
+      return;
+    len = strtoul(field, NULL, 16);
+
+    for (i = 0; i < len && i < 8; i++)
+    {
+      field = strtok(NULL, " ");
+      if (field == NULL)
+        return;
+      buf[i] = strtoul(field, NULL, 16);
+    }
+
+    if (len == 8 && YACP_IS_COMMAND_ID(id))
+      yacp_handle_can(id, buf);
+  }
+}
+
+void yacp_linux_client_recv()
+{
+  char data[512];
+  ssize_t n;
+  ssize_t i;
+
+  if (yacp_linux_client_fd < 0)
+  {
+    int on = 1;
+
+    yacp_linux_client_fd = accept(yacp_linux_listen_fd, NULL, NULL);
+    if (yacp_linux_client_fd < 0)
+      return;
+
+    setsockopt(yacp_linux_client_fd, IPPROTO_TCP, TCP_NODELAY, &on, sizeof(on));
+    yacp_linux_client_write("< hi >");
+  }
+
+  while ((n = recv(yacp_linux_client_fd, data, sizeof(data), MSG_DONTWAIT)) != 0)
+  {
+    if (n < 0)
+    {
+      if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR)
+        yacp_linux_client_close();
+      return;
+    }
+
+    for (i = 0; i < n; i++)
+    {
+      if (data[i] == '<')
+      {
+        yacp_linux_line_len = 0;
+      }
+      else if (data[i] == '>')
+      {
+        yacp_linux_line[yacp_linux_line_len] = 0;
+        yacp_linux_handle_message(yacp_linux_line);
+        yacp_linux_line_len = 0;
+
+        if (yacp_linux_client_fd < 0)
+          return;
+      }
+      else if (yacp_linux_line_len < YACP_LINUX_LINE_SIZE - 1)
+      {
+        yacp_linux_line[yacp_linux_line_len++] = data[i];
+      }
+    }
+  }
+
+  // The host disconnected, wait for the next one
+  yacp_linux_client_close();
+}
+
+void yacp_can_recv()
+{
+  if (yacp_linux_can_fd < 0)
+  {
+    if (yacp_linux_listen_fd >= 0)
+      yacp_linux_client_recv();
+    return;
+  }
+
+  struct can_frame frame;
+  uint32_t id;
+
+  while (recv(yacp_linux_can_fd, &frame, sizeof(frame), MSG_DONTWAIT) == sizeof(frame))
+  {
+    id = frame.can_id & CAN_EFF_FLAG ? frame.can_id & CAN_EFF_MASK : frame.can_id & CAN_SFF_MASK;
+
+    if (frame.can_dlc == 8 && YACP_IS_COMMAND_ID(id))
+      yacp_handle_can(id, frame.data);
+  }
+}
+
+// Waits up to timeout_ms for the host to send something
+void yacp_linux_wait(int timeout_ms)
+{
+  struct pollfd pfd;
+
+  pfd.fd = yacp_linux_can_fd >= 0 ? yacp_linux_can_fd : (yacp_linux_client_fd >= 0 ? yacp_linux_client_fd : yacp_linux_listen_fd);
+  pfd.events = POLLIN;
+  poll(&pfd, 1, timeout_ms);
+}
+
+// The file is read on first use, a missing file reads as erased EEPROM
+void yacp_linux_eeprom_load()
+{
+  FILE* f;
+
+  memset(yacp_linux_eeprom, 0xFF, sizeof(yacp_linux_eeprom));
+  yacp_linux_eeprom_loaded = true;
+
+  f = fopen(yacp_linux_eeprom_file, "rb");
+  if (f == NULL)
+    return;
+
+  if (fread(yacp_linux_eeprom, 1, sizeof(yacp_linux_eeprom), f) == 0)
+    memset(yacp_linux_eeprom, 0xFF, sizeof(yacp_linux_eeprom));
+  fclose(f);
+}
+
+uint8_t yacp_eeprom_load_byte(uint16_t addr)
+{
+  if (!yacp_linux_eeprom_loaded)
+    yacp_linux_eeprom_load();
+
+  if (addr >= YACP_LINUX_EEPROM_SIZE)
+    return 0xFF;
+
+  return yacp_linux_eeprom[addr];
+}
+
+void yacp_eeprom_store_byte(uint16_t addr, uint8_t val)
+{
+  if (!yacp_linux_eeprom_loaded)
+    yacp_linux_eeprom_load();
+
+  if (addr < YACP_LINUX_EEPROM_SIZE)
+    yacp_linux_eeprom[addr] = val;
+}
+
+void yacp_eeprom_persist()
+{
+  // Written to a new file and renamed so a killed simulator never leaves half an EEPROM
+  char tmp_file[4096];
+  FILE* f;
+
+  snprintf(tmp_file, sizeof(tmp_file), "%s.tmp", yacp_linux_eeprom_file);
+  f = fopen(tmp_file, "wb");
+  if (f == NULL)
+  {
+    perror(tmp_file);
+    return;
+  }
+
+  fwrite(yacp_linux_eeprom, 1, sizeof(yacp_linux_eeprom), f);
+  fclose(f);
+  rename(tmp_file, yacp_linux_eeprom_file);
+}
+
+void yacp_memcpy(void* s1, const void* s2, uint16_t n)
+{
+	memcpy(s1, s2, n);
+}
+
+void yacp_update_setting(uint8_t* dst, uint32_t var_start, uint8_t var_len, uint8_t* buf)
+{
+	uint32_t value32;
+	uint16_t value16;
+	uint8_t value8;
+
+    if (var_len == 1)
+    {
+      value8 = buf[4];
+      memcpy(dst + var_start, &value8, var_len);
+    }
+    else if (var_len == 2)
+    {
+      value16 = buf[5];
+      value16 |= (uint32_t)buf[4] << 8;
+      memcpy(dst + var_start, &value16, var_len);
+    }
+    else if (var_len == 4)
+    {
+      value32 = buf[7];
+      value32 |= (uint32_t)buf[6] << 8;
+      value32 |= (uint32_t)buf[5] << 16;
+      value32 |= (uint32_t)buf[4] << 24;
+      memcpy(dst + var_start, &value32, var_len);
+    }
+}
@@ -0,0 +1,145 @@
+/*
+ * yacp_sim_linux.c
+ * Yet Another Calibration Protocol (YACP)
+ *
+ * Runs the YACP core built with a project's generated cal.c and cal.h as a native
+ * Linux process that answers on the bus like the device would, for testing host
+ * tools against the real protocol implementation. See the Makefile.
+ *
+ * Usage: yacp_sim [-c vcan0 | -p port] [-d device_id] [-e eeprom_file]
+ *                 [-i product_id] [-f firmware_version]
+ *
+ * -c opens a SocketCAN channel, -p serves socketcand on localhost instead.
+ * -d replaces the device ID stored in the settings, so many simulators can share a
+ * bus and an EEPROM file each. It must fit in 4 bits, or with extended addressing in
+ * the device_id setting (255 for a uint8 as in the demo def, 65534 at most).
+ *
+ * The measurements keep the values they start with. Define yacp_sim_tick() in a
+ * file built into the simulator to drive them (and the overrides) like the
+ * firmware's main loop would.
+ *
+ * Matthew Bergman 2021
+ *
+ * MIT license, all text above must be included in any redistribution.
+ * See license.txt at the root of the repository for full license text.
+ */
+
+#include "cal.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <signal.h>
+#include <time.h>
+#include <unistd.h>
+
+// The calibration struct is declared in cal.c
+extern calibration cal;
+extern uint8_t yacp_product_firmware_version;
+extern uint8_t yacp_product_id;
+
+// yacp_driver_linux.c
+extern const char* yacp_linux_channel;
+extern int yacp_linux_port;
+extern const char* yacp_linux_eeprom_file;
+void yacp_linux_wait(int timeout_ms);
+
+volatile sig_atomic_t yacp_sim_running = 1;
+
+// Called once a millisecond with the milliseconds since the start
+__attribute__((weak)) void yacp_sim_tick(uint32_t millis)
+{
+}
+
+void yacp_sim_stop(int sig)
+{
+  yacp_sim_running = 0;
+}
+
+uint32_t yacp_sim_millis()
+{
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint32_t)(now.tv_sec * 1000 + now.tv_nsec / 1000000);
+}
+
+int main(int argc, char** argv)
+{
+  long device_id = -1;
+  long max_device_id;
+  char* end;
+  int opt;
+
+  yacp_product_firmware_version = 1;
+  yacp_product_id = 1;
+
+  while ((opt = getopt(argc, argv, "c:p:d:e:i:f:")) != -1)
+  {
+    switch (opt)
+    {
+      case 'c': yacp_linux_channel = optarg; break;
+      case 'p': yacp_linux_port = atoi(optarg); break;
+      case 'd':
+        device_id = strtol(optarg, &end, 0);
+        if (*optarg == '\0' || *end != '\0' || device_id < 0)
+        {
+          fprintf(stderr, "Invalid device ID %s\n", optarg);
+          return 1;
+        }
+        break;
+      case 'e': yacp_linux_eeprom_file = optarg; break;
+      case 'i': yacp_product_id = strtol(optarg, NULL, 0); break;
+      case 'f': yacp_product_firmware_version = strtol(optarg, NULL, 0); break;
+      default:
+        fprintf(stderr, "Usage: %s [-c vcan0 | -p port] [-d device_id] [-e eeprom_file] [-i product_id] [-f firmware_version]\n", argv[0]);
+        return 1;
+    }
+  }
+
+#ifdef YACP_EXTENDED_ADDRESSING
+  // The address in the CAN ID has 16 bits but the device_id setting may have fewer
+  max_device_id = sizeof(cal.settings.device_id) == 1 ? 0xFF : YACP_EXT_BROADCAST - 1;
+  if (device_id > max_device_id)
+  {
+    fprintf(stderr, "Device ID %ld does not fit the device_id setting (at most %ld)\n", device_id, max_device_id);
+    return 1;
+  }
+#else
+  // The device ID shares the first byte of a frame with the message type
+  max_device_id = 15;
+  if (device_id > max_device_id)
+  {
+    fprintf(stderr, "Device IDs above %ld need extended addressing (make EXTENDED=1)\n", max_device_id);
+    return 1;
+  }
+#endif
+
+  signal(SIGINT, yacp_sim_stop);
+  signal(SIGTERM, yacp_sim_stop);
+
+  yacp_can_init();
+
+  // Load default settings and saved settings from the EEPROM file into the cal structs
+  yacp_init();
+
+  if (device_id >= 0)
+    cal.settings.device_id = device_id;
+
+  uint32_t start = yacp_sim_millis();
+  uint32_t last = 0;
+  uint32_t now;
+
+  while (yacp_sim_running)
+  {
+    yacp_linux_wait(1);
+    yacp_can_recv();
+
+    now = yacp_sim_millis() - start;
+    if (now != last)
+    {
+      last = now;
+      yacp_sim_tick(now);
+    }
+  }
+
+  return 0;
+}
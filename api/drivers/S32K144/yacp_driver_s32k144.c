@@ -43,8 +43,16 @@ flexcan_data_info_t dataInfo =
 // All CAN functions assume INST_CANCOM1, change as needed
 void yacp_can_init()
 {
+#ifdef YACP_EXTENDED_ADDRESSING
+	/* Commands to every device address share the ID bits covered by the mask */
+	dataInfo.msg_id_type = FLEXCAN_MSG_ID_EXT;
+	FLEXCAN_DRV_SetRxMaskType(INST_CANCOM1, FLEXCAN_RX_MASK_INDIVIDUAL);
+	FLEXCAN_DRV_SetRxIndividualMask(INST_CANCOM1, FLEXCAN_MSG_ID_EXT, YACP_RX_MAILBOX, YACP_EXT_COMMAND_MASK);
+	FLEXCAN_DRV_ConfigRxMb(INST_CANCOM1, YACP_RX_MAILBOX, &dataInfo, YACP_EXT_COMMAND_BASE);
+#else
 	/* Configure RX message buffer with index RX_MSG_ID and RX_MAILBOX */
 	FLEXCAN_DRV_ConfigRxMb(INST_CANCOM1, YACP_RX_MAILBOX, &dataInfo, YACP_COMMAND_ID);
+#endif
 
 	/* Start receiving data in RX_MAILBOX. */
 	FLEXCAN_DRV_Receive(INST_CANCOM1, YACP_RX_MAILBOX, &canMsgBuff);
@@ -52,6 +60,8 @@ void yacp_can_init()
 
 void yacp_can_send(uint32_t id, uint8_t* buf)
 {
+	dataInfo.msg_id_type = id > 0x7FF ? FLEXCAN_MSG_ID_EXT : FLEXCAN_MSG_ID_STD;
+
 	/* Configure TX message buffer with index TX_MSG_ID and TX_MAILBOX*/
 	FLEXCAN_DRV_ConfigTxMb(INST_CANCOM1, YACP_TX_MAILBOX, &dataInfo, id);
 
@@ -64,7 +74,7 @@ void yacp_can_recv()
 	/* Wait until the previous FlexCAN receive is completed and then process message */
 	if (FLEXCAN_DRV_GetTransferStatus(INST_CANCOM1, YACP_RX_MAILBOX) == STATUS_SUCCESS)
 	{
-		if (canMsgBuff.msgId == YACP_COMMAND_ID)
+		if (YACP_IS_COMMAND_ID(canMsgBuff.msgId))
 		{
 			handle_can(canMsgBuff.msgId, canMsgBuff.data);
 		}
@@ -102,7 +112,7 @@ void yacp_memcpy(void* s1, const void* s2, uint16_t n)
 	memcpy(s1, s2, n);
 }
 
-void yacp_update_setting(uint8_t* dst, uint16_t var_start, uint8_t var_len, uint8_t* buf)
+void yacp_update_setting(uint8_t* dst, uint32_t var_start, uint8_t var_len, uint8_t* buf)
 {
 	uint32_t value32;
 	uint16_t value16;
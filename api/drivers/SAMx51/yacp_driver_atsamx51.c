@@ -51,6 +51,7 @@ void yacp_can_init()
 
 void yacp_can_send(uint32_t id, uint8_t* buf)
 {
+    // IDs above 0x7FF are sent as extended frames by the PLIB
     CAN0_MessageTransmit(id, 8, buf, CAN_MODE_NORMAL, CAN_MSG_ATTR_TX_FIFO_DATA_FRAME);
 }
 
@@ -58,7 +59,7 @@ void yacp_can_recv()
 {
     if (CAN0_MessageReceive(&yacp_can_recv_id, &yacp_can_recv_len, yacp_can_recv_data, NULL, CAN_MSG_ATTR_RX_FIFO0, &yacp_can_rx_attr))
     {
-        if (yacp_can_recv_id == YACP_COMMAND_ID)
+        if (YACP_IS_COMMAND_ID(yacp_can_recv_id))
         {
             yacp_handle_can(yacp_can_recv_id, yacp_can_recv_data);
         }
@@ -91,7 +92,7 @@ void yacp_memcpy(void* s1, const void* s2, uint16_t n)
 	memcpy(s1, s2, n);
 }
 
-void yacp_update_setting(uint8_t* dst, uint16_t var_start, uint8_t var_len, uint8_t* buf)
+void yacp_update_setting(uint8_t* dst, uint32_t var_start, uint8_t var_len, uint8_t* buf)
 {
 	uint32_t value32;
 	uint16_t value16;
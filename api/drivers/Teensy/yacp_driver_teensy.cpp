@@ -21,7 +21,7 @@ CAN_message_t can_in_msg;
 
 void yacp_can_send(uint32_t id, uint8_t* buf)
 {
-  can_out_msg.ext = 0;
+  can_out_msg.ext = id > 0x7FF;
   can_out_msg.len = 8;
   can_out_msg.id = id;
   can_out_msg.flags.remote = 0;
@@ -65,7 +65,7 @@ void yacp_memcpy(void* s1, const void* s2, uint16_t n)
 	memcpy(s1, s2, n);
 }
 
-void yacp_update_setting(uint8_t* dst, uint16_t var_start, uint8_t var_len, uint8_t* buf)
+void yacp_update_setting(uint8_t* dst, uint32_t var_start, uint8_t var_len, uint8_t* buf)
 {
 	uint32_t value32;
 	uint16_t value16;
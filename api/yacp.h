@@ -17,6 +17,10 @@
 
 #define YACP_UPDATE_ID 0x101
 
+// Device IDs are 0-15 with standard addressing, they share byte 0 of a frame with the
+// message type. Extended addressing carries a 16 bit address (0xFFFF is broadcast),
+// but the ID is stored in the device_id setting, so a uint8 device_id stops at 255.
+
 #define CAL_UPDATE_SETTING 0
 #define CAL_READ_SETTING 1
 #define CAL_OVERRIDE_ON 2
@@ -26,10 +30,46 @@
 #define CAL_SAVE_SETTINGS 6
 #define CAL_HELLO 7
 #define CAL_ACK 8
+#define CAL_READ_MEASUREMENT_DELTA 9
+#define CAL_OVERRIDE_STAGE 10
+#define CAL_OVERRIDE_TRANSACTION 11
+#define CAL_READ_SETTINGS_CRC 12
+
+// Capability flags sent in the var_start field of the hello response
+#define YACP_CAP_DELTA 0x01
+#define YACP_CAP_EXTENDED 0x02
+#define YACP_CAP_TRANSACTIONS 0x04
+#define YACP_CAP_SETTINGS_CRC 0x08
+
+// Delta request flags (byte 4 of the request)
+#define YACP_DELTA_FULL 0x01
+
+// Override transactions: define YACP_OVERRIDE_TRANSACTIONS for the whole project to
+// stage overrides and apply them together on commit. It costs a second copy of
+// cal_overrides in RAM, so it is left out unless defined.
+// Operations (byte 4 of the request)
+#define YACP_TRANSACTION_BEGIN 0
+#define YACP_TRANSACTION_COMMIT 1
+
+// Every Nth sweep of the delta reporting sends all measurements again
+#ifndef YACP_DELTA_REFRESH_SWEEPS
+#define YACP_DELTA_REFRESH_SWEEPS 50
+#endif
+
+// Most measurements a delta request sends back at once, whatever budget the host asks
+// for. A measurement is marked reported when it is sent, so frames a driver cannot
+// queue are lost until the next refresh sweep. Drivers sending from a single TX
+// mailbox need 1, define it for the whole project when the driver queues more.
+#ifndef YACP_DELTA_MAX_BURST
+#define YACP_DELTA_MAX_BURST 1
+#endif
 
 #define EEPROM_CRC_OFFSET 0
 #define EEPROM_SETTINGS_OFFSET 4
 
+// Generated in cal.c, the size of each measurement in struct order
+extern const uint8_t yacp_measurement_lengths[];
+
 // YACP Internal Functions
 void yacp_load_defaults();
 void yacp_load_settings();
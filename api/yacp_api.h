@@ -23,6 +23,32 @@
 
 #define YACP_COMMAND_ID 0x100
 
+// Extended addressing: define YACP_EXTENDED_ADDRESSING for the whole project to move
+// the message type and a 16 bit device address into 29 bit CAN IDs, leaving the
+// payload for a 24 bit var_start. The ID is laid out as:
+// [28:21] prefix, [20] direction, [19:16] message type, [15:0] device address
+#ifndef YACP_EXT_PREFIX
+#define YACP_EXT_PREFIX 0x0C
+#endif
+
+#define YACP_EXT_COMMAND 0
+#define YACP_EXT_RESPONSE 1
+#define YACP_EXT_BROADCAST 0xFFFF
+
+#define YACP_EXT_ID(direction, message_type, address) (((uint32_t)YACP_EXT_PREFIX << 21) | ((uint32_t)(direction) << 20) | ((uint32_t)(message_type) << 16) | ((uint32_t)(address) & 0xFFFF))
+#define YACP_EXT_TYPE(id) (((id) >> 16) & 0x0F)
+#define YACP_EXT_ADDRESS(id) ((id) & 0xFFFF)
+
+// Receive filter (ID and mask) matching every command frame
+#define YACP_EXT_COMMAND_BASE YACP_EXT_ID(YACP_EXT_COMMAND, 0, 0)
+#define YACP_EXT_COMMAND_MASK 0x1FF00000
+
+#ifdef YACP_EXTENDED_ADDRESSING
+#define YACP_IS_COMMAND_ID(id) (((id) & YACP_EXT_COMMAND_MASK) == YACP_EXT_COMMAND_BASE)
+#else
+#define YACP_IS_COMMAND_ID(id) ((id) == YACP_COMMAND_ID)
+#endif
+
 #define CAL_PROTOCOL_VERSION 1
 
 // Remote data
@@ -45,7 +71,16 @@ typedef union cal_value
 } cal_value;
 
 // Each override has a status (OVERRIDDEN, PASSTHROUGH), and a value.
+// The aligned layout (YACP_ALIGNED_LAYOUT, set in cal.h by YACPGen) keeps the value
+// naturally aligned at the cost of 3 bytes of padding per override.
 
+#ifdef YACP_ALIGNED_LAYOUT
+typedef struct cal_override
+{
+  uint8_t status;
+  cal_value value;
+} cal_override;
+#else
 #pragma pack(push)
 #pragma pack(1)
 typedef struct cal_override
@@ -54,11 +89,15 @@ typedef struct cal_override
   cal_value value;
 } cal_override;
 #pragma pack(pop)
+#endif
+
+// Override offsets in the protocol point at the status, the value follows at this offset
+#define YACP_OVERRIDE_VALUE_OFFSET offsetof(cal_override, value)
 
 // Driver Functions
 
 // Sends a CAN message onto the bus
-// id: CAN arbitration ID
+// id: CAN arbitration ID, IDs above 0x7FF are sent as extended (29 bit) frames
 // buf: 8 byte buffer containing the data to be sent
 void yacp_can_send(uint32_t id, uint8_t* buf);
 
@@ -83,7 +122,7 @@ void yacp_eeprom_persist();
 
 // memcpy function that knows native byte order and types
 void yacp_memcpy(void* s1, const void* s2, uint16_t n);
-void yacp_update_setting(uint8_t* dst, uint16_t var_start, uint8_t var_len, uint8_t* buf);
+void yacp_update_setting(uint8_t* dst, uint32_t var_start, uint8_t var_len, uint8_t* buf);
 
 // YACP API
 // Called once at the start of execution by the main code. Loads default and stored settings.
@@ -23,14 +23,38 @@ uint8_t yacp_product_id;
 bool yacp_eeprom_version_mismatch_f;
 bool yacp_eeprom_crc_mismatch_f;
 
+#ifdef CAL_NUM_MEASUREMENTS
+// Image of the measurements as they were last reported by a delta request. There is
+// one for the device, two hosts polling deltas each miss the changes sent to the other.
+cal_measurements yacp_measurements_reported;
+uint16_t yacp_delta_index;
+uint32_t yacp_delta_offset;
+uint16_t yacp_delta_sweeps;
+bool yacp_delta_full_sweep = true;
+#endif
+
+#ifdef YACP_OVERRIDE_TRANSACTIONS
+// Overrides staged by a transaction, copied into cal.overrides at once on commit
+cal_overrides yacp_overrides_staged;
+uint16_t yacp_staged_count;
+bool yacp_transaction_open;
+#endif
 
 // Internal function declarations
-void yacp_send_measurement(uint16_t measurement_start, uint8_t var_len);
-void yacp_send_setting(uint16_t setting_start, uint8_t var_len);
-void yacp_send_override(uint8_t message_type, uint16_t override_start, uint8_t var_len);
+void yacp_send_response(uint8_t message_type, uint32_t var_start, uint8_t var_len, uint8_t* buf);
+void yacp_send_measurement(uint32_t measurement_start, uint8_t var_len);
+void yacp_send_measurement_delta(uint8_t budget, uint8_t flags);
+void yacp_send_setting(uint32_t setting_start, uint8_t var_len);
+void yacp_send_override(uint8_t message_type, uint32_t override_start, uint8_t var_len);
 void yacp_send_hello();
+void yacp_send_settings_crc();
 void yacp_send_ack();
+void yacp_send_nack();
+uint32_t yacp_crc_byte(uint32_t crc, uint8_t val);
 uint32_t yacp_eeprom_crc();
+uint32_t yacp_settings_crc();
+void yacp_store_settings_bytes();
+void yacp_store_crc(uint32_t crc);
 
 // API Functions
 void yacp_init()
@@ -81,48 +105,75 @@ void yacp_load_settings()
     // The stored revision number in EEPROM does not match the cal.h revision.
     yacp_eeprom_version_mismatch_f = true;
 
-    // Clear out the settings struct of the incorrect EEPROM data
-    memset(&cal.settings, 0, sizeof(cal.settings));
-    
-	// Load the defaults from the generated code and save to EEPROM
+    // Load the defaults from the generated code over the incorrect EEPROM data and save to EEPROM
     yacp_load_defaults();
+#ifdef CAL_DEFAULT_SETTINGS_CRC
+    // The CRC of the defaults is computed by YACPGen, no need to read them back
+    yacp_store_settings_bytes();
+    yacp_store_crc(CAL_DEFAULT_SETTINGS_CRC);
+    yacp_eeprom_persist();
+#else
     yacp_save_settings();
+#endif
 
     // A new cal will need to be pushed and saved using the GUI.
   }
 }
 
 void yacp_save_settings()
+{
+  yacp_store_settings_bytes();
+
+  // Calculate the CRC of the EEPROM data just saved
+  yacp_store_crc(yacp_eeprom_crc());
+
+  yacp_eeprom_persist();
+}
+
+void yacp_store_settings_bytes()
 {
   // Save the cal settings struct to EEPROM, byte for byte.
   uint8_t* cal_ptr = (uint8_t*)&cal.settings;
   size_t i;
   for (i=0; i<sizeof(cal.settings); i++)
     yacp_eeprom_store_byte(i + EEPROM_SETTINGS_OFFSET, cal_ptr[i]);
+}
 
-  // Calculate the CRC of the EEPROM data just saved
-  uint32_t crc = yacp_eeprom_crc();
-
+void yacp_store_crc(uint32_t crc)
+{
   // Save the CRC value to EEPROM for validation on next startup
   yacp_eeprom_store_byte(EEPROM_CRC_OFFSET, crc);
   yacp_eeprom_store_byte(EEPROM_CRC_OFFSET + 1, crc >> 8);
   yacp_eeprom_store_byte(EEPROM_CRC_OFFSET + 2, crc >> 16);
   yacp_eeprom_store_byte(EEPROM_CRC_OFFSET + 3, crc >> 24);
-
-  yacp_eeprom_persist();
 }
 
 // Internal Functions
-void yacp_send_measurement(uint16_t measurement_start, uint8_t var_len)
+void yacp_send_response(uint8_t message_type, uint32_t var_start, uint8_t var_len, uint8_t* buf)
 {
-  uint8_t buf[8];
+  // Fill in the header for the addressing mode in use, buf[4..7] holds the data
+#ifdef YACP_EXTENDED_ADDRESSING
+  buf[0] = var_start;
+  buf[1] = var_start >> 8;
+  buf[2] = var_start >> 16;
+  buf[3] = var_len;
 
-  // Send a measurement value back to the requestor
-  buf[0] = CAL_READ_MEASUREMENT | (cal.settings.device_id << 4);
-  buf[1] = measurement_start;
-  buf[2] = measurement_start >> 8;
+  yacp_can_send(YACP_EXT_ID(YACP_EXT_RESPONSE, message_type, cal.settings.device_id), buf);
+#else
+  buf[0] = message_type | (cal.settings.device_id << 4);
+  buf[1] = var_start;
+  buf[2] = var_start >> 8;
   buf[3] = var_len;
 
+  yacp_can_send(YACP_UPDATE_ID, buf);
+#endif
+}
+
+void yacp_send_measurement(uint32_t measurement_start, uint8_t var_len)
+{
+  uint8_t buf[8];
+
+  // Send a measurement value back to the requestor
   buf[4] = 0;
   buf[5] = 0;
   buf[6] = 0;
@@ -130,19 +181,62 @@ void yacp_send_measurement(uint16_t measurement_start, uint8_t var_len)
 
   yacp_memcpy(&buf[4], (uint8_t*)&cal.measurements + measurement_start, var_len);
     
-  yacp_can_send(YACP_UPDATE_ID, buf);
+  yacp_send_response(CAL_READ_MEASUREMENT, measurement_start, var_len, buf);
 }
 
-void yacp_send_setting(uint16_t setting_start, uint8_t var_len)
+#ifdef CAL_NUM_MEASUREMENTS
+void yacp_send_measurement_delta(uint8_t budget, uint8_t flags)
+{
+  /* Walk the measurements from where the last request stopped and send the ones
+   * whose bytes changed since they were last reported, at most budget of them.
+   * Every YACP_DELTA_REFRESH_SWEEPS sweeps everything is sent again in case a
+   * response was lost.
+   */
+  uint8_t* current = (uint8_t*)&cal.measurements;
+  uint8_t* reported = (uint8_t*)&yacp_measurements_reported;
+  uint16_t checked;
+  uint8_t sent = 0;
+  uint8_t var_len;
+
+  if (budget > YACP_DELTA_MAX_BURST)
+    budget = YACP_DELTA_MAX_BURST;
+
+  if (flags & YACP_DELTA_FULL)
+  {
+    yacp_delta_index = 0;
+    yacp_delta_offset = 0;
+    yacp_delta_full_sweep = true;
+  }
+
+  for (checked = 0; checked < CAL_NUM_MEASUREMENTS && sent < budget; checked++)
+  {
+    var_len = yacp_measurement_lengths[yacp_delta_index];
+
+    if (yacp_delta_full_sweep || memcmp(current + yacp_delta_offset, reported + yacp_delta_offset, var_len) != 0)
+    {
+      memcpy(reported + yacp_delta_offset, current + yacp_delta_offset, var_len);
+      yacp_send_measurement(yacp_delta_offset, var_len);
+      sent++;
+    }
+
+    yacp_delta_offset += var_len;
+    yacp_delta_index++;
+    if (yacp_delta_index >= CAL_NUM_MEASUREMENTS)
+    {
+      yacp_delta_index = 0;
+      yacp_delta_offset = 0;
+      yacp_delta_sweeps++;
+      yacp_delta_full_sweep = (yacp_delta_sweeps % YACP_DELTA_REFRESH_SWEEPS) == 0;
+    }
+  }
+}
+#endif
+
+void yacp_send_setting(uint32_t setting_start, uint8_t var_len)
 {
   uint8_t buf[8];
 
   // Send a setting value back to the requestor
-  buf[0] = CAL_READ_SETTING | (cal.settings.device_id << 4);
-  buf[1] = setting_start;
-  buf[2] = setting_start >> 8;
-  buf[3] = var_len;
-
   buf[4] = 0;
   buf[5] = 0;
   buf[6] = 0;
@@ -150,45 +244,64 @@ void yacp_send_setting(uint16_t setting_start, uint8_t var_len)
 
   yacp_memcpy(&buf[4], (uint8_t*)&cal.settings + setting_start, var_len);
     
-  yacp_can_send(YACP_UPDATE_ID, buf);
+  yacp_send_response(CAL_READ_SETTING, setting_start, var_len, buf);
 }
 
-void yacp_send_override(uint8_t message_type, uint16_t override_start, uint8_t var_len)
+void yacp_send_override(uint8_t message_type, uint32_t override_start, uint8_t var_len)
 {
   uint8_t buf[8];
 
   // Send a override value and status back to the requestor
-  buf[0] = message_type | (cal.settings.device_id << 4);
-  buf[1] = override_start;
-  buf[2] = override_start >> 8;
-  buf[3] = var_len;
-
   buf[4] = 0;
   buf[5] = 0;
   buf[6] = 0;
   buf[7] = 0;
 
-  yacp_memcpy(&buf[4], (uint8_t*)&cal.overrides + override_start + 1, var_len);
+  yacp_memcpy(&buf[4], (uint8_t*)&cal.overrides + override_start + YACP_OVERRIDE_VALUE_OFFSET, var_len);
     
-  yacp_can_send(YACP_UPDATE_ID, buf);
+  yacp_send_response(message_type, override_start, var_len, buf);
 }
 
 void yacp_send_hello()
 {
   uint8_t buf[8];
-
-  // Respond to a HELLO message with our device ID
-  buf[0] = CAL_HELLO | (cal.settings.device_id << 4);
-  buf[1] = 0;
-  buf[2] = 0;
-  buf[3] = 0;
+  uint8_t capabilities = 0;
+  uint8_t delta_burst = 0;
+
+  // Respond to a HELLO message with our device ID and capabilities, var_len holds
+  // the most measurements a delta request sends back
+#ifdef CAL_NUM_MEASUREMENTS
+  capabilities |= YACP_CAP_DELTA;
+  delta_burst = YACP_DELTA_MAX_BURST;
+#endif
+#ifdef YACP_EXTENDED_ADDRESSING
+  capabilities |= YACP_CAP_EXTENDED;
+#endif
+#ifdef YACP_OVERRIDE_TRANSACTIONS
+  capabilities |= YACP_CAP_TRANSACTIONS;
+#endif
+  capabilities |= YACP_CAP_SETTINGS_CRC;
 
   buf[4] = yacp_product_firmware_version;
   buf[5] = yacp_product_id;
   buf[6] = CAL_REVISION;
   buf[7] = CAL_PROTOCOL_VERSION;
     
-  yacp_can_send(YACP_UPDATE_ID, buf);
+  yacp_send_response(CAL_HELLO, capabilities, delta_burst, buf);
+}
+
+void yacp_send_settings_crc()
+{
+  uint8_t buf[8];
+  uint32_t crc = yacp_settings_crc();
+
+  // Send the CRC of the settings in RAM, a host that already has them can skip reading them
+  buf[4] = crc;
+  buf[5] = crc >> 8;
+  buf[6] = crc >> 16;
+  buf[7] = crc >> 24;
+
+  yacp_send_response(CAL_READ_SETTINGS_CRC, 0, 0, buf);
 }
 
 void yacp_send_ack()
@@ -196,116 +309,193 @@ void yacp_send_ack()
   uint8_t buf[8];
 
   // Send an ack after a successful command response
-  buf[0] = CAL_ACK | (cal.settings.device_id << 4);
-  buf[1] = 0;
-  buf[2] = 0;
-  buf[3] = 0;
   buf[4] = 1; // 1: success, 0: failure
   buf[5] = 0;
   buf[6] = 0;
   buf[7] = 0;
     
-  yacp_can_send(YACP_UPDATE_ID, buf);
+  yacp_send_response(CAL_ACK, 0, 0, buf);
+}
+
+void yacp_send_nack()
+{
+  uint8_t buf[8];
+
+  // Send a failure ack when a command could not be carried out
+  buf[4] = 0;
+  buf[5] = 0;
+  buf[6] = 0;
+  buf[7] = 0;
+    
+  yacp_send_response(CAL_ACK, 0, 0, buf);
 }
 
 void yacp_handle_can(uint32_t id, uint8_t* buf)
 {
-  uint8_t device_id;
+  uint32_t device_id;
   uint8_t message_type;
-  uint16_t var_start;
+  uint32_t var_start;
   uint8_t var_len;
 
-  switch (id)
+  if (!YACP_IS_COMMAND_ID(id))
+    return;
+
+#ifdef YACP_EXTENDED_ADDRESSING
+  device_id = YACP_EXT_ADDRESS(id);
+  message_type = YACP_EXT_TYPE(id);
+  var_start = buf[0];
+  var_start |= (uint32_t)buf[1] << 8;
+  var_start |= (uint32_t)buf[2] << 16;
+  var_len = buf[3];
+#else
+  device_id = buf[0] >> 4;
+  message_type = buf[0] & 0x0F;
+  var_start = buf[1];
+  var_start |= (uint32_t)buf[2] << 8;
+  var_len = buf[3];
+#endif
+
+  if (message_type == CAL_HELLO)
   {
-    case YACP_COMMAND_ID:
-      device_id = buf[0] >> 4;
-      message_type = buf[0] & 0x0F;
-      var_start = buf[1];
-      var_start |= (uint16_t)buf[2] << 8;
-      var_len = buf[3];
-
-      if (message_type == CAL_HELLO)
-      {
-        yacp_send_hello();
-      }
+    yacp_send_hello();
+  }
 
-      if (device_id != cal.settings.device_id)
-        break;
+  if (device_id != cal.settings.device_id)
+    return;
 
-      if (message_type == CAL_UPDATE_SETTING)
-      {
-    	yacp_can_send(0x200+var_start, buf);
+  if (message_type == CAL_UPDATE_SETTING)
+  {
+	yacp_can_send(0x200+var_start, buf);
 
-    	yacp_can_send(0x300+var_start, (uint8_t*)&cal.settings);
+	yacp_can_send(0x300+var_start, (uint8_t*)&cal.settings);
 
-    	//memcpy(((uint8_t*)&cal.settings) + var_start, &value, var_len);
-    	yacp_update_setting((uint8_t*)&cal.settings, var_start, var_len, buf);
+	//memcpy(((uint8_t*)&cal.settings) + var_start, &value, var_len);
+	yacp_update_setting((uint8_t*)&cal.settings, var_start, var_len, buf);
 
-    	yacp_can_send(0x400+var_start, (uint8_t*)&cal.settings);
+	yacp_can_send(0x400+var_start, (uint8_t*)&cal.settings);
 
-        yacp_send_ack();
-      }
-      else if (message_type == CAL_READ_SETTING)
-      {
-        yacp_send_setting(var_start, var_len);
-      }
-      else if (message_type == CAL_OVERRIDE_ON || message_type == CAL_OVERRIDE_OFF)
-      {
-        if (message_type == CAL_OVERRIDE_ON)
-          *((uint8_t*)&cal.overrides + var_start) = CAL_OVERRIDDEN;
-        else
-          *((uint8_t*)&cal.overrides + var_start) = CAL_PASSTHRU;
-          
-        //memcpy((uint8_t*)&cal.overrides + var_start + 1, &value, 4);
-        yacp_update_setting((uint8_t*)&cal.overrides, var_start+1, 4, buf);
+    yacp_send_ack();
+  }
+  else if (message_type == CAL_READ_SETTING)
+  {
+    yacp_send_setting(var_start, var_len);
+  }
+  else if (message_type == CAL_OVERRIDE_ON || message_type == CAL_OVERRIDE_OFF)
+  {
+    if (message_type == CAL_OVERRIDE_ON)
+      *((uint8_t*)&cal.overrides + var_start) = CAL_OVERRIDDEN;
+    else
+      *((uint8_t*)&cal.overrides + var_start) = CAL_PASSTHRU;
+      
+    //memcpy((uint8_t*)&cal.overrides + var_start + YACP_OVERRIDE_VALUE_OFFSET, &value, 4);
+    yacp_update_setting((uint8_t*)&cal.overrides, var_start + YACP_OVERRIDE_VALUE_OFFSET, 4, buf);
 
-        yacp_send_ack();
-      }
-      else if (message_type == CAL_READ_OVERRIDE)
-      {
-        if (*((uint8_t*)&cal.overrides + var_start) == CAL_PASSTHRU)
-          yacp_send_override(CAL_OVERRIDE_OFF, var_start, var_len);
-        else
-          yacp_send_override(CAL_OVERRIDE_ON, var_start, var_len);
-      }
-      else if (message_type == CAL_READ_MEASUREMENT)
+    yacp_send_ack();
+  }
+#ifdef YACP_OVERRIDE_TRANSACTIONS
+  else if (message_type == CAL_OVERRIDE_STAGE)
+  {
+    // Stages are not acked, the commit checks that all of them arrived.
+    // var_len holds the status to stage.
+    if (yacp_transaction_open)
+    {
+      *((uint8_t*)&yacp_overrides_staged + var_start) = var_len == CAL_OVERRIDDEN ? CAL_OVERRIDDEN : CAL_PASSTHRU;
+      yacp_update_setting((uint8_t*)&yacp_overrides_staged, var_start + YACP_OVERRIDE_VALUE_OFFSET, 4, buf);
+      yacp_staged_count++;
+    }
+  }
+  else if (message_type == CAL_OVERRIDE_TRANSACTION)
+  {
+    if (buf[4] == YACP_TRANSACTION_BEGIN)
+    {
+      // Overrides that are not staged keep their current values
+      memcpy(&yacp_overrides_staged, &cal.overrides, sizeof(cal.overrides));
+      yacp_staged_count = 0;
+      yacp_transaction_open = true;
+    }
+    else if (buf[4] == YACP_TRANSACTION_COMMIT)
+    {
+      // var_start holds the number of stages sent, a lost stage fails the whole transaction
+      if (yacp_transaction_open && yacp_staged_count == var_start)
       {
-        yacp_send_measurement(var_start, var_len);
+        memcpy(&cal.overrides, &yacp_overrides_staged, sizeof(cal.overrides));
+        yacp_send_ack();
       }
-      else if (message_type == CAL_SAVE_SETTINGS)
+      else
       {
-        yacp_save_settings();
-        
-        yacp_send_ack();
+        yacp_send_nack();
       }
-      
-      break;
+
+      yacp_transaction_open = false;
+    }
+  }
+#endif
+  else if (message_type == CAL_READ_OVERRIDE)
+  {
+    if (*((uint8_t*)&cal.overrides + var_start) == CAL_PASSTHRU)
+      yacp_send_override(CAL_OVERRIDE_OFF, var_start, var_len);
+    else
+      yacp_send_override(CAL_OVERRIDE_ON, var_start, var_len);
+  }
+  else if (message_type == CAL_READ_MEASUREMENT)
+  {
+    yacp_send_measurement(var_start, var_len);
+  }
+#ifdef CAL_NUM_MEASUREMENTS
+  else if (message_type == CAL_READ_MEASUREMENT_DELTA)
+  {
+    // var_len holds the maximum number of measurements to send back
+    yacp_send_measurement_delta(var_len, buf[4]);
+  }
+#endif
+  else if (message_type == CAL_READ_SETTINGS_CRC)
+  {
+    yacp_send_settings_crc();
+  }
+  else if (message_type == CAL_SAVE_SETTINGS)
+  {
+    yacp_save_settings();
+    
+    yacp_send_ack();
   }
 }
 
-uint32_t yacp_eeprom_crc() 
+uint32_t yacp_crc_byte(uint32_t crc, uint8_t val)
 {
   // CRC calc by Christopher Andrews.
-  const uint32_t crc_table[16] = 
+  static const uint32_t crc_table[16] = 
   {
     0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
     0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
     0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
     0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c
   };
-  
+
+  crc = crc_table[(crc ^ val) & 0x0f] ^ (crc >> 4);
+  crc = crc_table[(crc ^ (val >> 4)) & 0x0f] ^ (crc >> 4);
+  return ~crc;
+}
+
+uint32_t yacp_eeprom_crc() 
+{
   uint32_t crc = ~0L;
-  uint8_t val;
   
   uint16_t index;
   for (index = 0; index < sizeof(cal.settings); ++index)
-  {
-    val = yacp_eeprom_load_byte(index + EEPROM_SETTINGS_OFFSET);
-    
-    crc = crc_table[(crc ^ val) & 0x0f] ^ (crc >> 4);
-    crc = crc_table[(crc ^ (val >> 4)) & 0x0f] ^ (crc >> 4);
-    crc = ~crc;
-  }
+    crc = yacp_crc_byte(crc, yacp_eeprom_load_byte(index + EEPROM_SETTINGS_OFFSET));
+
+  return crc;
+}
+
+uint32_t yacp_settings_crc()
+{
+  // Same CRC as the EEPROM, over the settings in use
+  uint8_t* cal_ptr = (uint8_t*)&cal.settings;
+  uint32_t crc = ~0L;
+
+  uint16_t index;
+  for (index = 0; index < sizeof(cal.settings); ++index)
+    crc = yacp_crc_byte(crc, cal_ptr[index]);
 
   return crc;
 }
@@ -18,6 +18,7 @@ import json
 import sys
 import re
 import os
+import struct
 
 lengths = {}
 lengths["uint8"] = 1
@@ -37,83 +38,199 @@ types_c["uint32"] = "uint32_t"
 types_c["int32"] = "int32_t"
 types_c["float"] = "float"
 
+# cal_override size and offset of its value for each layout
+override_layouts = {}
+override_layouts["packed"] = (5, 1)
+override_layouts["aligned"] = (8, 4)
+
+# Returns the member indexes in struct order, their offsets and the struct size.
+# The aligned layout puts the widest members first so every member is naturally
+# aligned without padding between them. yacp.py lays the structs out the same way.
+def struct_layout(sizes, layout):
+    order = list(range(len(sizes)))
+    if layout == "aligned":
+        order.sort(key=lambda i: -sizes[i])
+
+    offsets = [0] * len(sizes)
+    size = 0
+    for i in order:
+        offsets[i] = size
+        size += sizes[i]
+
+    if layout == "aligned" and len(sizes) > 0:
+        align = max(min(x, 4) for x in sizes)
+        size = (size + align - 1) // align * align
+
+    return (order, offsets, size)
+
+crc_table = [
+    0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
+    0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
+    0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
+    0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c
+]
+
+# The CRC yacp_eeprom_crc() computes over the stored settings
+def settings_crc(data):
+    crc = 0xFFFFFFFF
+    for val in data:
+        crc = crc_table[(crc ^ val) & 0x0f] ^ (crc >> 4)
+        crc = crc_table[(crc ^ (val >> 4)) & 0x0f] ^ (crc >> 4)
+        crc = ~crc & 0xFFFFFFFF
+
+    return crc
+
+# Bytes of the default settings struct on a device of the given byte order ('little' or
+# 'big'). None when a default is not a plain number (e.g. a macro), only the compiler
+# can work those out.
+def default_settings_image(settings, offsets, size, byteorder):
+    image = bytearray(size)
+    for i, setting in enumerate(settings):
+        try:
+            if setting["type"] == "float":
+                data = struct.pack('<f' if byteorder == 'little' else '>f', float(setting["default"].rstrip('fF')))
+            else:
+                value = int(setting["default"], 0) & ((1 << (lengths[setting["type"]] * 8)) - 1)
+                data = value.to_bytes(lengths[setting["type"]], byteorder)
+        except (ValueError, OverflowError):
+            return None
+        image[offsets[i]:offsets[i]+len(data)] = data
+
+    return image
+
 re_spaces = re.compile('([\W]+)')
 def name_to_identifier(name):
     return re_spaces.sub('_', name.strip()).upper()
 
-def header_start(rev):
+def header_start(rev, num_measurements, layout):
     hfile.write("/* THIS IS GENERATED CODE FROM THE YACP PROJECT. DO NOT MODIFY! */\n\n")
     hfile.write("#ifndef YACP_CAL_H_\n")
     hfile.write("#define YACP_CAL_H_\n\n")
+    if layout == "aligned":
+        hfile.write("// Naturally aligned cal structs, members are ordered by size\n")
+        hfile.write("#define YACP_ALIGNED_LAYOUT\n\n")
     hfile.write("#include \"yacp_api.h\"\n\n")
-    hfile.write("#define CAL_REVISION "+rev+"\n\n")
+    hfile.write("#define CAL_REVISION "+rev+"\n")
+    if num_measurements > 0:
+        hfile.write("#define CAL_NUM_MEASUREMENTS "+str(num_measurements)+"\n")
+    hfile.write("\n")
 
-def measurements_start():
-    hfile.write("#pragma pack(push)\n")
-    hfile.write("#pragma pack(1)\n")
+def measurements_start(layout):
+    if layout == "packed":
+        hfile.write("#pragma pack(push)\n")
+        hfile.write("#pragma pack(1)\n")
     hfile.write("typedef struct cal_measurements\n")
     hfile.write("{\n")
 
-def measurements_var(name,cal_type,unit):
+def member_comment(unit, offset):
+    if offset != None:
+        unit = "offset "+str(offset)+(", "+unit if unit != "" else "")
     if unit != "":
         unit = " // "+unit
-    hfile.write("\t"+types_c[cal_type]+" "+name+";"+unit+"\n")
+    return unit
+
+def measurements_var(name,cal_type,unit,offset=None):
+    hfile.write("\t"+types_c[cal_type]+" "+name+";"+member_comment(unit, offset)+"\n")
 
 def measurements_end():
     hfile.write("} cal_measurements;\n\n")
     
 
-def settings_start():
-    hfile.write("#pragma pack(1)\n")
+def settings_start(layout):
+    if layout == "packed":
+        hfile.write("#pragma pack(1)\n")
     hfile.write("typedef struct cal_settings\n")
     hfile.write("{\n")
 
-def settings_var(name,cal_type,unit):
-    if unit != "":
-        unit = " // "+unit
-    hfile.write("\t"+types_c[cal_type]+" "+name+";"+unit+"\n")
+def settings_var(name,cal_type,unit,offset=None):
+    hfile.write("\t"+types_c[cal_type]+" "+name+";"+member_comment(unit, offset)+"\n")
 
 def settings_end():
     hfile.write("} cal_settings;\n\n")
     
 
-def override_start():
-    hfile.write("#pragma pack(1)\n")
+def override_start(layout):
+    if layout == "packed":
+        hfile.write("#pragma pack(1)\n")
     hfile.write("typedef struct cal_overrides\n")
     hfile.write("{\n")
 
-def override_var(name,unit):
-    if unit != "":
-        unit = " // "+unit
-    hfile.write("\tcal_override "+name+";"+unit+"\n")
+def override_var(name,unit,offset=None):
+    hfile.write("\tcal_override "+name+";"+member_comment(unit, offset)+"\n")
 
-def override_end():
+def override_end(layout):
     hfile.write("} cal_overrides;\n")
-    hfile.write("#pragma pack(pop)\n\n")
+    if layout == "packed":
+        hfile.write("#pragma pack(pop)\n")
+    hfile.write("\n")
     
 
-def header_end():
+def header_end(default_crcs):
     hfile.write("typedef struct calibration\n")
     hfile.write("{\n")
     hfile.write("\tcal_measurements measurements;\n")
     hfile.write("\tcal_settings settings;\n")
     hfile.write("\tcal_overrides overrides;\n")
     hfile.write("} calibration;\n\n")
+    hfile.write("// Default settings, kept in flash and copied into cal.settings by yacp_load_defaults\n")
+    hfile.write("extern const cal_settings yacp_default_settings;\n")
+    if default_crcs != None:
+        # The CRC depends on the byte order of the device, compilers that do not say
+        # which it is compute it at runtime
+        (little_crc, big_crc) = default_crcs
+        hfile.write("#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__\n")
+        hfile.write("#define CAL_DEFAULT_SETTINGS_CRC "+("0x%08XUL" % little_crc)+"\n")
+        hfile.write("#elif defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__\n")
+        hfile.write("#define CAL_DEFAULT_SETTINGS_CRC "+("0x%08XUL" % big_crc)+"\n")
+        hfile.write("#endif\n")
+    hfile.write("\n")
     hfile.write("#endif\n")
 
 def impl_start():
     cfile.write("/* THIS IS GENERATED CODE FROM THE YACP PROJECT. DO NOT MODIFY! */\n\n")
-    cfile.write("#include \"cal.h\"\n\n")
+    cfile.write("#include \"cal.h\"\n")
+    cfile.write("#include <string.h>\n\n")
     cfile.write("calibration cal;\n\n")
-    cfile.write("void yacp_load_defaults()\n")
+
+def impl_defaults_start():
+    cfile.write("// Default settings in struct order\n")
+    cfile.write("const cal_settings yacp_default_settings =\n")
     cfile.write("{\n")
 
-def impl_var(var,val):
-    cfile.write("\tcal.settings."+var+" = "+val+";\n")
+def impl_default(var,val,last):
+    cfile.write("\t"+val+("" if last else ",")+" // "+var+"\n")
+
+def impl_defaults_end():
+    cfile.write("};\n\n")
+    cfile.write("void yacp_load_defaults()\n")
+    cfile.write("{\n")
+    cfile.write("\tmemcpy(&cal.settings, &yacp_default_settings, sizeof(cal.settings));\n")
 
 def impl_end():
     cfile.write("}\n")
 
+def impl_measurement_lengths(measurements):
+    if len(measurements) == 0:
+        return
+    cfile.write("\n// Measurement sizes in struct order, used for delta reporting\n")
+    cfile.write("const uint8_t yacp_measurement_lengths[CAL_NUM_MEASUREMENTS] = {")
+    cfile.write(", ".join(str(lengths[m["type"]]) for m in measurements))
+    cfile.write("};\n")
+
+def impl_size_check(name, expression):
+    cfile.write("typedef char yacp_check_"+name+"[("+expression+") ? 1 : -1];\n")
+
+def impl_layout_checks(measurements_size, settings_size, overrides_size):
+    [override_size, override_value_offset] = override_layouts["aligned"]
+    cfile.write("\n// The compiler must lay the structs out as YACPcal computes them from the def\n")
+    impl_size_check("override", "sizeof(cal_override) == "+str(override_size)+" && offsetof(cal_override, value) == "+str(override_value_offset))
+    if measurements_size > 0:
+        impl_size_check("measurements", "sizeof(cal_measurements) == "+str(measurements_size))
+    if settings_size > 0:
+        impl_size_check("settings", "sizeof(cal_settings) == "+str(settings_size))
+    if overrides_size > 0:
+        impl_size_check("overrides", "sizeof(cal_overrides) == "+str(overrides_size))
+
 
 def choice_enum(name, val):
     hfile.write("#define "+name+" "+val+"\n")
@@ -159,7 +276,18 @@ except:
     sys.exit(1)
     
 
-header_start(rev)
+layout = defs.get("layout", "packed")
+if layout not in override_layouts:
+    print("Unknown layout '"+str(layout)+"', use 'packed' or 'aligned'.")
+    sys.exit(1)
+aligned = layout == "aligned"
+
+# Members are written in struct order, with their offsets when the layout reorders them
+[measurement_order, measurement_offsets, measurements_size] = struct_layout([lengths[m["type"]] for m in defs["measurements"]], layout)
+[setting_order, setting_offsets, settings_size] = struct_layout([lengths[s["type"]] for s in defs["settings"]], layout)
+[override_order, override_offsets, overrides_size] = struct_layout([override_layouts[layout][0] for o in defs["overrides"]], layout)
+
+header_start(rev, len(defs["measurements"]), layout)
 
 written = False
 for measurement in defs["measurements"]:
@@ -181,9 +309,10 @@ for setting in defs["settings"]:
 if written:
     hfile.write("\n")
 
-measurements_start()
+measurements_start(layout)
 revision_measurement_found = False
-for measurement in defs["measurements"]:
+for i in measurement_order:
+    measurement = defs["measurements"][i]
     if measurement["name"] == 'revision':
         revision_measurement_found = True
         
@@ -192,30 +321,39 @@ for measurement in defs["measurements"]:
         unit = measurement["unit"]
     elif "units" in measurement.keys():
         unit = measurement["units"]
-    measurements_var(measurement["name"], measurement["type"], unit)
+    measurements_var(measurement["name"], measurement["type"], unit, measurement_offsets[i] if aligned else None)
 measurements_end()
 
-settings_start()
-for setting in defs["settings"]:
+settings_start(layout)
+for i in setting_order:
+    setting = defs["settings"][i]
     unit = ""
     if "unit" in setting.keys():
         unit = setting["unit"]
     elif "units" in setting.keys():
         unit = setting["units"]
-    settings_var(setting["name"], setting["type"], unit)
+    settings_var(setting["name"], setting["type"], unit, setting_offsets[i] if aligned else None)
 settings_end()
 
-override_start()
-for override in defs["overrides"]:
+override_start(layout)
+for i in override_order:
+    override = defs["overrides"][i]
     unit = ""
     if "unit" in override.keys():
         unit = override["unit"]
     elif "units" in override.keys():
         unit = override["units"]
-    override_var(override["name"], unit)
-override_end()
+    override_var(override["name"], unit, override_offsets[i] if aligned else None)
+override_end(layout)
+
+# The CRCs the device computes over its EEPROM after storing the defaults, by byte order
+little_image = default_settings_image(defs["settings"], setting_offsets, settings_size, 'little')
+big_image = default_settings_image(defs["settings"], setting_offsets, settings_size, 'big')
+default_crcs = None
+if little_image != None and big_image != None:
+    default_crcs = (settings_crc(little_image), settings_crc(big_image))
 
-header_end()
+header_end(default_crcs)
         
 hfile.close()
 
@@ -227,6 +365,12 @@ except:
 
 impl_start()
 
+impl_defaults_start()
+for i in setting_order:
+    setting = defs["settings"][i]
+    impl_default(setting["name"], setting["default"], i == setting_order[-1])
+impl_defaults_end()
+
 revision = None
 try:
     revision = defs["revision"]
@@ -234,11 +378,14 @@ except:
     pass
 
 if revision_measurement_found and revision != None:
-    cfile.write("\tcal.measurements.revision = "+revision+";\n\n")
+    cfile.write("\tcal.measurements.revision = "+revision+";\n")
 
-for setting in defs["settings"]:
-    impl_var(setting["name"], setting["default"])
 impl_end()
 
+impl_measurement_lengths([defs["measurements"][i] for i in measurement_order])
+
+if aligned:
+    impl_layout_checks(measurements_size, settings_size, overrides_size)
+
 cfile.close()
     
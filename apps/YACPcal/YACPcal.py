@@ -11,10 +11,15 @@ See license.txt at the root of the repository for full license text.
 """
 
 import time
+
+# Startup times are measured from here, see yacp_startup_benchmark.py
+STARTED = time.perf_counter()
+
 import sys
 import configparser
 import os
 import traceback
+import multiprocessing
 
 from PyQt5.QtWidgets import QWidget
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QMenu
@@ -24,11 +29,14 @@ from PyQt5.QtWidgets import QLabel
 from PyQt5.QtWidgets import QComboBox
 from PyQt5.QtWidgets import QGroupBox
 from PyQt5.QtWidgets import QApplication
-from PyQt5.QtWidgets import QTableWidget
-from PyQt5.QtWidgets import QTableWidgetItem
+from PyQt5.QtWidgets import QTableView
+from PyQt5.QtWidgets import QListWidget
+from PyQt5.QtWidgets import QListWidgetItem
 from PyQt5.QtWidgets import QAbstractItemView
 from PyQt5.QtWidgets import QPushButton
+from PyQt5.QtWidgets import QCheckBox
 from PyQt5.QtWidgets import QHeaderView
+from PyQt5.QtWidgets import QStyledItemDelegate
 from PyQt5.QtWidgets import QFrame
 from PyQt5.QtWidgets import QInputDialog, QLineEdit, QFileDialog
 from PyQt5.QtWidgets import QAction, QMenu
@@ -42,17 +50,272 @@ from PyQt5.QtCore import QByteArray
 from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QAbstractTableModel
+from PyQt5.QtCore import QModelIndex
 
 from PyQt5.QtGui import QColor
 from PyQt5.QtGui import QIcon
 from PyQt5.QtGui import QCursor
 
-from pyqtgraph import PlotWidget, plot
-import pyqtgraph as pg
-
 from version import VERSION
 
 from yacp import YACPProtocol, CANThread, Measurement, Setting, Override, Device
+from yacp_stimulus import StimulusProfile, StimulusRunner
+from yacp_capture import load_capture
+from yacp_recorder import Recorder
+from yacp_search import RankFilterProxy, MEASUREMENT, SETTING, OVERRIDE
+
+# Changes of the graphed measurement kept in the plot
+GRAPH_SAMPLES = 100
+
+# Values are read from the device once the search has not changed for this long
+SEARCH_SETTLE_MS = 500
+
+# Role of the (label, value) pairs an edited cell chooses from, None for free text
+CHOICES_ROLE = Qt.UserRole
+
+# Reads a def in the background, the window is usable meanwhile
+class DefLoader(QThread):
+    def __init__(self, protocol, fileName):
+        QThread.__init__(self)
+
+        self.protocol = protocol
+        self.fileName = fileName
+        self.definition = None
+        self.error = ""
+        # Another def was opened before this one was read
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.definition = self.protocol.readDefFile(self.fileName)
+        except (OSError, ValueError, KeyError) as e:
+            self.error = str(e)
+
+# The measurements of the active session, one row per measurement in def order.
+# Cells are only formatted when the view draws them.
+class MeasurementsModel(QAbstractTableModel):
+    HEADERS = ["Measurement", "Value", "Type", "Unit"]
+
+    def __init__(self):
+        super().__init__()
+
+        self.measurements = {}
+        self.keys = []
+
+    def setMeasurements(self, measurements):
+        self.beginResetModel()
+        self.measurements = measurements
+        self.keys = [*measurements]
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(MeasurementsModel.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        measurement = self.measurements[self.keys[index.row()]]
+        if role == Qt.DisplayRole:
+            column = index.column()
+            if column == 0:
+                return measurement.name
+            elif column == 1:
+                return measurement.formatter.text(measurement.value)
+            elif column == 2:
+                return str(measurement.cal_type)
+            return str(measurement.unit)
+        elif role == Qt.ToolTipRole and measurement.notes != "":
+            return measurement.notes
+
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return MeasurementsModel.HEADERS[section]
+        return None
+
+    # One update for all the value cells changed since the last render
+    def valuesChanged(self, rows):
+        self.dataChanged.emit(self.index(min(rows), 1), self.index(max(rows), 1))
+
+def choice_label(entry, value):
+    for choice, label in entry.choices.items():
+        if str(choice) == str(value):
+            return label
+    return entry.formatter.text(value)
+
+# The settings or overrides of the active session, one row per entry in def order.
+# Edits are handed to the window to send, the cells show what the session holds.
+class EntriesModel(QAbstractTableModel):
+    HEADERS = []
+    EDITABLE = []
+
+    edited_signal = pyqtSignal(object, int, object)
+
+    def __init__(self):
+        super().__init__()
+
+        self.entries = {}
+        self.keys = []
+        self.rows = {}
+
+    def setEntries(self, entries):
+        self.beginResetModel()
+        self.entries = entries
+        self.keys = [*entries]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.isValid() and index.column() in self.EDITABLE:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    # Only changes are sent, closing an editor without changing it is not one
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole or index.column() not in self.EDITABLE:
+            return False
+        if str(value) == str(self.data(index, Qt.EditRole)):
+            return False
+
+        self.edited_signal.emit(self.keys[index.row()], index.column(), value)
+        return True
+
+    def valuesChanged(self, rows):
+        self.dataChanged.emit(self.index(min(rows), min(self.EDITABLE)), self.index(max(rows), max(self.EDITABLE)))
+
+class SettingsModel(EntriesModel):
+    HEADERS = ["Setting", "Value", "Type", "Unit", "Default"]
+    EDITABLE = [1]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        setting = self.entries[self.keys[index.row()]]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return setting.name
+            elif column == 1:
+                return choice_label(setting, setting.value)
+            elif column == 2:
+                return str(setting.cal_type)
+            elif column == 3:
+                return str(setting.unit)
+            return choice_label(setting, setting.default)
+        elif role == Qt.EditRole and column == 1:
+            if len(setting.choices) > 0:
+                return setting.value
+            return setting.formatter.text(setting.value)
+        elif role == CHOICES_ROLE and column == 1 and len(setting.choices) > 0:
+            return [(label, choice) for choice, label in setting.choices.items()]
+        elif role == Qt.ToolTipRole and setting.notes != "":
+            return setting.notes
+
+        return None
+
+# Changes staged for an override transaction are shown until they are applied or dropped
+class OverridesModel(EntriesModel):
+    HEADERS = ["Override", "Status", "Value", "Type", "Unit"]
+    EDITABLE = [1, 2]
+    STATUSES = ["Passthrough", "Overridden"]
+
+    def __init__(self):
+        super().__init__()
+
+        self.staged = {}
+
+    def setOverrides(self, overrides, staged):
+        self.staged = staged
+        self.setEntries(overrides)
+
+    # (value text, status) as shown
+    def shown(self, override_key):
+        override = self.entries[override_key]
+        (value, status) = self.staged.get(override_key, (override.value, override.status))
+        return (override.formatter.text(value), status)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        override_key = self.keys[index.row()]
+        override = self.entries[override_key]
+        column = index.column()
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            if column == 1 or column == 2:
+                (text, status) = self.shown(override_key)
+                return status if column == 1 else text
+            elif role == Qt.EditRole:
+                return None
+            elif column == 0:
+                return override.name
+            elif column == 3:
+                return str(override.cal_type)
+            return str(override.unit)
+        elif role == CHOICES_ROLE and column == 1:
+            return [(status, status) for status in OverridesModel.STATUSES]
+        elif role == Qt.ToolTipRole and override.notes != "":
+            return override.notes
+
+        return None
+
+# Cells offering CHOICES_ROLE are edited with a combobox, which only exists while the
+# cell is being edited, everything else as text
+class ChoiceDelegate(QStyledItemDelegate):
+    def createEditor(self, parent, option, index):
+        choices = index.data(CHOICES_ROLE)
+        if choices == None:
+            return super().createEditor(parent, option, index)
+
+        combobox = QComboBox(parent)
+        for (label, value) in choices:
+            combobox.addItem(label, value)
+        # A choice is sent as soon as it is picked
+        combobox.activated.connect(lambda: self.commitData.emit(combobox))
+        combobox.activated.connect(lambda: self.closeEditor.emit(combobox))
+        return combobox
+
+    def setEditorData(self, editor, index):
+        if not isinstance(editor, QComboBox):
+            return super().setEditorData(editor, index)
+
+        value = str(index.data(Qt.EditRole))
+        for i in range(editor.count()):
+            if str(editor.itemData(i)) == value:
+                editor.setCurrentIndex(i)
+
+    def setModelData(self, editor, model, index):
+        if not isinstance(editor, QComboBox):
+            return super().setModelData(editor, model, index)
+
+        model.setData(index, editor.currentData())
 
 class YACPcal(QMainWindow):
         
@@ -66,15 +329,42 @@ class YACPcal(QMainWindow):
         self.recentCalFiles = {}
         
         self.graph_row = -1
-        self.graph_x = list(x*10 for x in range(-100,0,1))
-        self.graph_y = list(0 for _ in range(100))
+        # Receive times and values of the last GRAPH_SAMPLES changes of the graphed measurement
+        self.graph_x = []
+        self.graph_y = []
+
+        # Rows changed since the last render, table index -> offset
+        self.dirty_measurements = {}
+        self.dirty_settings = {}
+        self.dirty_overrides = {}
+        self.dirty_graph = False
+        self.dirty_device_state = False
+        self.subscribed_state = None
+
+        # Section shown in the settings and overrides tables
+        self.section = None
+        # Cal export waiting for the unread sections
+        self.pending_cal_export = False
+        # Matches of the search box as [(kind, key, rank)], None when it is empty
+        self.search_results = None
+        self.stimulus = None
+        self.capture = None
+        self.recorder = None
+        self.export_runner = None
+        self.def_loader = None
+        # Def of the last session, read in the background once the window is up
+        self.startup_def = None
         
         self.readConfig()
 	
         self.init_widget()
 
         self.yacp = YACPProtocol()
-        self.yacp_base_can_id = 0x100
+        self.yacp.out_of_process_io = self.config['YACP'].getboolean('OutOfProcessIO', False)
+        self.yacp.delta_measurements = self.config['YACP'].getboolean('DeltaMeasurements', True)
+        self.yacp.settings_cache = self.config['YACP'].get('SettingsCache', 'yacp_settings_cache') or None
+        self.yacp.lazy_sections = self.config['YACP'].getboolean('LazySections', True)
+        self.yacp.shm_prefix = self.config['YACP'].get('SharedMemory', '') or None
         
         self.yacp.app_update_device_state_signal.connect(self.updateDeviceState)
         self.yacp.app_update_measurement_signal.connect(self.updateMeasurement)
@@ -82,18 +372,44 @@ class YACPcal(QMainWindow):
         self.yacp.app_update_override_signal.connect(self.updateOverride)
         self.yacp.app_update_devices_signal.connect(self.updateDeviceList)
         self.yacp.app_update_can_status_signal.connect(self.updateCANStatus)
+        self.yacp.app_bus_opened_signal.connect(self.busOpened)
+        self.yacp.app_scan_complete_signal.connect(self.scanComplete)
+        self.yacp.app_command_failed_signal.connect(self.commandFailed)
+        self.yacp.app_bus_lost_signal.connect(self.busLost)
+        self.yacp.app_bus_restored_signal.connect(self.busRestored)
+        self.yacp.app_bus_silent_signal.connect(self.busSilent)
+        self.yacp.app_bus_answering_signal.connect(self.busAnswering)
+
+        self.yacp.loadInventory('yacp_devices.json')
+
+        # Widgets are only touched at this rate, however fast the values arrive
+        self.render_timer = QTimer(self)
+        self.render_timer.timeout.connect(self.renderFrame)
+        self.render_timer.start(int(1000 / max(self.config['YACP'].getint('RefreshHz', 30), 1)))
 
         self.show()
 
+        last_def = self.config['YACP'].get('LastDef', '')
+        if last_def != '' and os.path.exists(last_def):
+            self.startup_def = last_def
+            QTimer.singleShot(0, self.loadStartupDef)
+
     def closeEvent(self, event):
         self.saveConfig()
+        self.stopStimulus()
+        self.stopCapture()
+        self.stopRecording()
+        if self.export_runner != None:
+            self.export_runner.wait()
+        if self.def_loader != None:
+            self.def_loader.wait()
         self.yacp.close()
 
     def readConfig(self):
         inifile = self.config.read('yacp.ini')
 
         if len(inifile) == 0:
-            self.config['YACP'] = {'CANAdaptor': 'PCAN', 'CANBAUD': '500'}
+            self.config['YACP'] = {'CANAdaptor': 'PCAN', 'CANBAUD': '500', 'BaseCANIDs': '0x100'}
             self.config['RecentCals'] = {}
             self.config['RecentDefs'] = {}
             self.saveConfig()
@@ -153,6 +469,46 @@ class YACPcal(QMainWindow):
         fileMenu.addAction(self.defOpenAct)
         fileMenu.addAction(self.calOpenAct)
         fileMenu.addMenu(recentDefMenu)
+
+        toolsMenu = menubar.addMenu('&Tools')
+
+        self.stimulusRunAct = QAction('&Run Stimulus Profile', self)
+        self.stimulusRunAct.setStatusTip('Send a timed profile of override changes to the device')
+        self.stimulusRunAct.triggered.connect(self.runStimulusDialog)
+
+        self.stimulusStopAct = QAction('&Stop Stimulus', self)
+        self.stimulusStopAct.triggered.connect(self.stopStimulus)
+        self.stimulusStopAct.setEnabled(False)
+
+        self.captureStartAct = QAction('Start &Capture', self)
+        self.captureStartAct.setStatusTip('Save measurements around trigger events to disk')
+        self.captureStartAct.triggered.connect(self.startCaptureDialog)
+
+        self.captureStopAct = QAction('Stop Capture', self)
+        self.captureStopAct.triggered.connect(self.stopCapture)
+        self.captureStopAct.setEnabled(False)
+
+        self.recordStartAct = QAction('Start &Recording', self)
+        self.recordStartAct.setStatusTip('Log every measurement change to a CSV file')
+        self.recordStartAct.triggered.connect(self.startRecordingDialog)
+
+        self.recordStopAct = QAction('Stop Recording', self)
+        self.recordStopAct.triggered.connect(self.stopRecording)
+        self.recordStopAct.setEnabled(False)
+
+        self.exportAct = QAction('&Export Recording', self)
+        self.exportAct.setStatusTip('Resample a recording onto a common time base and save it as columns')
+        self.exportAct.triggered.connect(self.exportRecordingDialog)
+
+        toolsMenu.addAction(self.stimulusRunAct)
+        toolsMenu.addAction(self.stimulusStopAct)
+        toolsMenu.addSeparator()
+        toolsMenu.addAction(self.captureStartAct)
+        toolsMenu.addAction(self.captureStopAct)
+        toolsMenu.addSeparator()
+        toolsMenu.addAction(self.recordStartAct)
+        toolsMenu.addAction(self.recordStopAct)
+        toolsMenu.addAction(self.exportAct)
         fileMenu.addMenu(self.recentCalMenu)
         
         form_lbx = QBoxLayout(QBoxLayout.LeftToRight, parent=self)
@@ -185,6 +541,11 @@ class YACPcal(QMainWindow):
         self.combo_rate.addItem("1M")
         self.combo_rate.addItem("125k")
 
+        self.txt_channels = QLineEdit(self)
+        self.txt_channels.setText(self.config['YACP'].get('CANChannels', ''))
+        self.txt_channels.setPlaceholderText('Default channel')
+        self.txt_channels.setToolTip('Adaptor channels to open, comma separated')
+
         self.btn_connect = QPushButton("Open")
         self.btn_connect.clicked.connect(self.connect)
 
@@ -199,228 +560,494 @@ class YACPcal(QMainWindow):
         self.btn_device_connect.setEnabled(False)
 
         self.txt_yacp_can_base_id = QLineEdit(self)
-        self.txt_yacp_can_base_id.setText(hex(0x100))
+        self.txt_yacp_can_base_id.setText(self.config['YACP'].get('BaseCANIDs', hex(0x100)))
+        self.txt_yacp_can_base_id.setToolTip('Base CAN IDs to scan, comma separated')
 
         self.btn_save = QPushButton("Persist and Save Cal")
         self.btn_save.clicked.connect(self.saveSettings)
         self.btn_save.setEnabled(False)
 
+        self.chk_stage_overrides = QCheckBox("Stage overrides")
+        self.chk_stage_overrides.setToolTip('Collect override changes and apply them to the device at once')
+        self.chk_stage_overrides.stateChanged.connect(self.on_stage_overrides_change)
+
+        self.btn_apply_overrides = QPushButton("Apply Overrides")
+        self.btn_apply_overrides.clicked.connect(self.applyOverrides)
+        self.btn_apply_overrides.setEnabled(False)
+
         
-        pen = pg.mkPen(color=(255, 0, 0))
-        self.graph = pg.PlotWidget()
-        self.graph.setBackground('default')
-        self.graph.showGrid(x=True, y=True)
-        self.graph.setLabel('left', 'Measurement')
-        self.graph.setLabel('bottom', 'Ticks')
-        self.graph_line = self.graph.plot(self.graph_x, self.graph_y, pen=pen)
+        # The plot replaces this once a measurement is graphed, see createGraph
+        self.graph = None
+        self.graph_line = None
+        self.graph_placeholder = QLabel("Right-click a measurement and choose Graph")
+        self.graph_placeholder.setAlignment(Qt.AlignCenter)
+        self.graph_grid = grid
 
         row = 0
         grid.addWidget(self.combo_bustype, row, 0)
         grid.addWidget(self.combo_rate, row, 1)
         grid.addWidget(self.btn_connect, row, 2)
         row += 1
+
+        grid.addWidget(QLabel("Channels"), row, 0)
+        grid.addWidget(self.txt_channels, row, 1, 1, 2)
+        row += 1
         
         grid.addWidget(self.btn_hello, row, 0)
         grid.addWidget(self.combo_devices, row, 1)
         grid.addWidget(self.btn_device_connect, row, 2)
         row += 1
 
-        grid.addWidget(QLabel("CAN ID"), row, 0)
+        grid.addWidget(QLabel("CAN IDs"), row, 0)
         grid.addWidget(self.txt_yacp_can_base_id, row, 1)
         grid.addWidget(self.btn_save, row, 2)
         row += 1
 
-        grid.addWidget(self.graph, row, 0, 1, 3)
+        grid.addWidget(self.chk_stage_overrides, row, 0)
+        grid.addWidget(self.btn_apply_overrides, row, 2)
+        row += 1
+
+        self.search_settle_timer = QTimer(self)
+        self.search_settle_timer.setSingleShot(True)
+        self.search_settle_timer.setInterval(SEARCH_SETTLE_MS)
+
+        self.txt_search = QLineEdit(self)
+        self.txt_search.setPlaceholderText('Name, unit, notes or label')
+        self.txt_search.setToolTip('Filter the tables as you type, Enter graphs the best measurement match')
+        self.txt_search.textChanged.connect(self.on_search_change)
+        self.txt_search.returnPressed.connect(self.graphBestMatch)
+        # Enter also reads the matches shown right away
+        self.txt_search.returnPressed.connect(self.search_settle_timer.stop)
+        grid.addWidget(QLabel("Search"), row, 0)
+        grid.addWidget(self.txt_search, row, 1, 1, 2)
+        row += 1
+
+        grid.addWidget(self.graph_placeholder, row, 0, 1, 3)
         row += 1
 
 
         # Measurements / Settings / Overrides
 
-        self.measurements_table = QTableWidget(0, 4)
+        # Hidden measurements and search misses are filtered out by the proxy
+        self.measurements_model = MeasurementsModel()
+        self.measurements_proxy = RankFilterProxy()
+        self.measurements_proxy.setSourceModel(self.measurements_model)
+
+        self.measurements_table = QTableView()
+        self.measurements_table.setModel(self.measurements_proxy)
         self.measurements_table.verticalHeader().hide()
-        self.measurements_table.setHorizontalHeaderItem(0, QTableWidgetItem("Measurement"))
-        self.measurements_table.setHorizontalHeaderItem(1, QTableWidgetItem("Value"))
-        self.measurements_table.setHorizontalHeaderItem(2, QTableWidgetItem("Type"))
-        self.measurements_table.setHorizontalHeaderItem(3, QTableWidgetItem("Unit"))
+        self.measurements_table.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.measurements_table.setContextMenuPolicy(Qt.CustomContextMenu)
         self.measurements_table.customContextMenuRequested.connect(self.handleContextMenu)
         form_lbx.addWidget(self.measurements_table)
 
-        self.settings_table = QTableWidget(0, 5)
+        self.sections_list = QListWidget()
+        self.sections_list.setMaximumWidth(200)
+        self.sections_list.currentRowChanged.connect(self.on_section_change)
+        form_lbx.addWidget(self.sections_list)
+
+        # Like the measurements, the rows of other sections and search misses are filtered
+        # out by the proxies, so typing a search builds no widgets
+        self.settings_model = SettingsModel()
+        self.settings_model.edited_signal.connect(self.on_setting_change)
+        self.settings_proxy = RankFilterProxy()
+        self.settings_proxy.setSourceModel(self.settings_model)
+
+        self.settings_table = QTableView()
+        self.settings_table.setModel(self.settings_proxy)
+        self.settings_table.setItemDelegate(ChoiceDelegate(self.settings_table))
         self.settings_table.verticalHeader().hide()
-        self.settings_table.setHorizontalHeaderItem(0, QTableWidgetItem("Setting"))
-        self.settings_table.setHorizontalHeaderItem(1, QTableWidgetItem("Value"))
-        self.settings_table.setHorizontalHeaderItem(2, QTableWidgetItem("Type"))
-        self.settings_table.setHorizontalHeaderItem(3, QTableWidgetItem("Unit"))
-        self.settings_table.setHorizontalHeaderItem(4, QTableWidgetItem("Default"))
-        self.settings_table.cellChanged.connect(self.on_setting_change)
         form_lbx.addWidget(self.settings_table)
 
-        self.overrides_table = QTableWidget(0, 5)
+        self.overrides_model = OverridesModel()
+        self.overrides_model.edited_signal.connect(self.on_override_change)
+        self.overrides_proxy = RankFilterProxy()
+        self.overrides_proxy.setSourceModel(self.overrides_model)
+
+        self.overrides_table = QTableView()
+        self.overrides_table.setModel(self.overrides_proxy)
+        self.overrides_table.setItemDelegate(ChoiceDelegate(self.overrides_table))
         self.overrides_table.verticalHeader().hide()
-        self.overrides_table.setHorizontalHeaderItem(0, QTableWidgetItem("Override"))
-        self.overrides_table.setHorizontalHeaderItem(1, QTableWidgetItem("Status"))
-        self.overrides_table.setHorizontalHeaderItem(2, QTableWidgetItem("Value"))
-        self.overrides_table.setHorizontalHeaderItem(3, QTableWidgetItem("Type"))
-        self.overrides_table.setHorizontalHeaderItem(4, QTableWidgetItem("Unit"))
-        self.overrides_table.cellChanged.connect(self.on_override_change)
         form_lbx.addWidget(self.overrides_table)
 
     def handleContextMenu(self, event):
-        row = self.measurements_table.rowAt(event.y())
-        col = self.measurements_table.columnAt(event.x())
-        cell = self.measurements_table.item(row, col)
-        if cell == None:
+        index = self.measurements_table.indexAt(event)
+        if not index.isValid():
             return
+        row = self.measurements_proxy.mapToSource(index).row()
         
         menu = QMenu()
         graph_action = QAction('Graph')
         graph_action.setProperty('measurements_table_row', row)
         menu.addAction(graph_action)
+
+        # Whatever the search found can be recorded together
+        if self.search_results != None:
+            record_action = QAction('Record Matches')
+            record_action.setEnabled(self.recorder == None and self.yacp.device_state == YACPProtocol.DEVICE_STATE_CONNECTED)
+            menu.addAction(record_action)
+
         menu.triggered[QAction].connect(self.contextMenuClicked)
         menu.exec_(QCursor.pos())
 
     def contextMenuClicked(self, item):
         if item.text() == 'Graph':
-            self.graph_row = item.property('measurements_table_row')
+            self.graphMeasurement(item.property('measurements_table_row'))
+        elif item.text() == 'Record Matches':
+            self.recordingDialog(self.shownMeasurementKeys())
+
+    # pyqtgraph takes a while to import, it is only loaded for the first graph
+    def createGraph(self):
+        if self.graph != None:
+            return
+
+        import pyqtgraph as pg
+
+        pen = pg.mkPen(color=(255, 0, 0))
+        self.graph = pg.PlotWidget()
+        self.graph.setBackground('default')
+        self.graph.showGrid(x=True, y=True)
+        self.graph.setLabel('left', 'Measurement')
+        self.graph.setLabel('bottom', 'Time', units='s')
+        self.graph_line = self.graph.plot(self.graph_x, self.graph_y, pen=pen)
+
+        self.graph_grid.replaceWidget(self.graph_placeholder, self.graph)
+        self.graph_placeholder.deleteLater()
+        self.graph_placeholder = None
+
+    def graphMeasurement(self, row):
+        self.createGraph()
+        self.graph_row = row
+        self.graph_x = []
+        self.graph_y = []
+
+        measurement = self.yacp.measurements[self.measurements_model.keys[self.graph_row]]
+        self.graph.setLabel('left', measurement.name, units=measurement.formatter.unit)
+
+    def graphBestMatch(self):
+        if self.measurements_proxy.rowCount() > 0:
+            self.graphMeasurement(self.measurements_proxy.mapToSource(self.measurements_proxy.index(0, 0)).row())
+
+    # Measurement keys of the rows the filter shows, in the order shown
+    def shownMeasurementKeys(self):
+        proxy = self.measurements_proxy
+        return [self.measurements_model.keys[proxy.mapToSource(proxy.index(row, 0)).row()] for row in range(proxy.rowCount())]
+
+    def on_search_change(self, text):
+        self.search_results = self.yacp.search_index.search(text)
+        self.search_settle_timer.start()
+        self.filterMeasurements()
+        self.update_section_widgets()
+
+    def filterMeasurements(self):
+        measurements = self.measurements_model.measurements
+        keys = self.measurements_model.keys
+
+        if self.search_results == None:
+            ranks = {row: 0 for row in range(len(keys))}
+        else:
+            rows = {key: row for row, key in enumerate(keys)}
+            ranks = {rows[key]: rank for (kind, key, rank) in self.search_results if kind == MEASUREMENT and key in rows}
+
+        self.measurements_proxy.setRanks({row: rank for row, rank in ranks.items() if not measurements[keys[row]].formatter.hidden})
         
     def update_widgets(self):
-        self.measurements_table.setRowCount(self.yacp.num_measurements)
-        self.settings_table.setRowCount(self.yacp.num_settings)
-        self.overrides_table.setRowCount(self.yacp.num_overrides)
-        
-        row = 0
-        for offset in self.yacp.measurements:
-            measurement = self.yacp.measurements[offset]
+        # The tables are rebuilt from the current values, pending row updates are moot
+        self.dirty_measurements.clear()
+        self.dirty_settings.clear()
+        self.dirty_overrides.clear()
+
+        self.measurements_model.setMeasurements(self.yacp.measurements)
+        self.filterMeasurements()
+        self.measurements_table.resizeColumnsToContents()
+        self.settings_model.setEntries(self.yacp.settings)
+        self.overrides_model.setOverrides(self.yacp.overrides, self.yacp.session.staged_overrides)
+
+        # The section being viewed stays selected if the def still has it
+        self.sections_list.blockSignals(True)
+        self.sections_list.clear()
+        for section in self.yacp.sections:
+            item = QListWidgetItem("General" if section == None else section)
+            item.setToolTip(self.yacp.section_descriptions[section])
+            self.sections_list.addItem(item)
+        if self.section not in self.yacp.sections:
+            self.section = self.yacp.sections[0] if len(self.yacp.sections) > 0 else None
+        if len(self.yacp.sections) > 0:
+            self.sections_list.setCurrentRow(self.yacp.sections.index(self.section))
+        self.sections_list.blockSignals(False)
+
+        self.update_section_widgets()
+        self.settings_table.resizeColumnsToContents()
+        self.overrides_table.resizeColumnsToContents()
+
+    # Opening a section leaves the search
+    def on_section_change(self, row):
+        if row < 0 or row >= len(self.yacp.sections):
+            return
 
-            item = QTableWidgetItem(measurement.name)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.measurements_table.setItem(row, 0, item)
+        self.section = self.yacp.sections[row]
+        if self.txt_search.text() != "":
+            self.txt_search.clear()
+            self.search_settle_timer.stop()
+        else:
+            self.update_section_widgets()
 
-            val = str(measurement.value)
-            for value in measurement.values.keys():
-                if val == value:
-                    val = measurement.values[value]
-                    break
+    # The settings and overrides tables show the section being viewed, or the search
+    # matches from every section
+    def update_section_widgets(self):
+        self.filterEntries(self.settings_model, self.settings_proxy, SETTING)
+        self.filterEntries(self.overrides_model, self.overrides_proxy, OVERRIDE)
 
-            item = QTableWidgetItem(val)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.measurements_table.setItem(row, 1, item)
+    def filterEntries(self, model, proxy, kind):
+        entries = model.entries
 
-            item = QTableWidgetItem(str(measurement.cal_type))
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.measurements_table.setItem(row, 2, item)
+        if self.search_results == None:
+            ranks = {row: 0 for row, key in enumerate(model.keys) if entries[key].section == self.section}
+        else:
+            ranks = {model.rows[key]: rank for (result_kind, key, rank) in self.search_results if result_kind == kind and key in model.rows}
 
-            item = QTableWidgetItem(str(measurement.unit))
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.measurements_table.setItem(row, 3, item)
-            row += 1
-        self.measurements_table.horizontalHeader().resizeSections(QHeaderView.ResizeToContents)
+        proxy.setRanks({row: rank for row, rank in ranks.items() if not entries[model.keys[row]].formatter.hidden})
 
-        row = 0
-        self.settings_table.cellChanged.disconnect()
-        for offset in self.yacp.settings:
-            setting = self.yacp.settings[offset]
+    # Source rows of a table's proxy that are on screen
+    def shownRows(self, table, proxy):
+        first = table.rowAt(0)
+        if first == -1:
+            return []
+
+        last = table.rowAt(table.viewport().height() - 1)
+        if last == -1:
+            last = proxy.rowCount() - 1
+        return [proxy.mapToSource(proxy.index(row, 0)).row() for row in range(first, last + 1)]
+
+    # Values are read from the device the first time a row of their section is on
+    # screen, and not while a search is still being typed
+    def loadShownSections(self):
+        if self.search_settle_timer.isActive():
+            return
 
-            item = QTableWidgetItem(setting.name)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.settings_table.setItem(row, 0, item)
+        sections = set()
+        for (table, proxy, model) in ((self.settings_table, self.settings_proxy, self.settings_model), (self.overrides_table, self.overrides_proxy, self.overrides_model)):
+            for row in self.shownRows(table, proxy):
+                sections.add(model.entries[model.keys[row]].section)
+
+        for section in sections:
+            self.yacp.loadSection(section)
+
+    def on_setting_change(self, setting_key, column, value):
+        try:
+            self.yacp.sendSettingChange(setting_key, value)
+        except ValueError:
+            self.statusBar().showMessage("Invalid value "+str(value)+" for "+self.yacp.settings[setting_key].name)
+        self.settings_model.valuesChanged([self.settings_model.rows[setting_key]])
+
+    def on_override_change(self, override_key, column, value):
+        (str_val, override_status) = self.overrides_model.shown(override_key)
+        if column == 1:
+            override_status = value
+        else:
+            str_val = value
 
-            if len(setting.choices) == 0:
-                self.settings_table.setItem(row, 1, QTableWidgetItem(str(setting.value)))
+        try:
+            if self.chk_stage_overrides.isChecked():
+                self.yacp.stageOverrideChange(override_key, str_val, override_status)
             else:
-                combobox = QComboBox()
-                for choice_value in setting.choices.keys():
-                    combobox.addItem(setting.choices[choice_value], choice_value)
-                combobox.setProperty('row', row)
-                combobox.currentIndexChanged.connect(self.on_setting_combobox_change)
-                item = QTableWidgetItem()
-                self.settings_table.setItem(row, 1, item)
-                self.settings_table.setCellWidget(row, 1, combobox)
-
-            item = QTableWidgetItem(setting.cal_type)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.settings_table.setItem(row, 2, item)
-
-            item = QTableWidgetItem(setting.unit)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.settings_table.setItem(row, 3, item)
-
-            item = QTableWidgetItem(str(setting.value))
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.settings_table.setItem(row, 4, item)
-            row += 1
-        self.settings_table.horizontalHeader().resizeSections(QHeaderView.ResizeToContents)
-        self.settings_table.cellChanged.connect(self.on_setting_change)
+                self.yacp.sendOverrideChange(override_key, str_val, override_status)
+        except ValueError:
+            self.statusBar().showMessage("Invalid value "+str(str_val)+" for "+self.yacp.overrides[override_key].name)
+        self.overrides_model.valuesChanged([self.overrides_model.rows[override_key]])
+
+    def on_stage_overrides_change(self):
+        staging = self.chk_stage_overrides.isChecked()
+        self.btn_apply_overrides.setEnabled(staging)
+
+        # Changes that were never applied go back to the device's values
+        if not staging:
+            self.yacp.abortOverrides()
+            self.overrides_model.valuesChanged(range(len(self.overrides_model.keys)))
+
+    def applyOverrides(self):
+        count = self.yacp.commitOverrides()
+        self.overrides_model.valuesChanged(range(len(self.overrides_model.keys)))
+        self.statusBar().showMessage("Applied "+str(count)+" override change(s)")
+
+    def runStimulusDialog(self):
+        if self.yacp.device_state != YACPProtocol.DEVICE_STATE_CONNECTED or self.stimulus != None:
+            self.statusBar().showMessage("Connect to a device to run a stimulus profile")
+            return
 
-        row = 0
-        self.overrides_table.cellChanged.disconnect()
-        for offset in self.yacp.overrides:
-            override = self.yacp.overrides[offset]
-
-            item = QTableWidgetItem(override.name)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.overrides_table.setItem(row, 0, item)
-
-            combobox = QComboBox()
-            combobox.addItem("Passthrough")
-            combobox.addItem("Overridden")
-            combobox.setProperty('row', row)
-            combobox.currentIndexChanged.connect(self.on_override_status_change)
-            
-            item = QTableWidgetItem()
-            self.overrides_table.setItem(row, 1, item)
-            self.overrides_table.setCellWidget(row, 1, combobox)
-            
-            self.overrides_table.setItem(row, 2, QTableWidgetItem(str(override.value)))
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getOpenFileName(self,"Open Stimulus Profile",self.projectPath,"Stimulus Profiles (*.csv)", options=options)
+        if fileName:
+            self.runStimulus(fileName)
+
+    def runStimulus(self, fileName):
+        profile = StimulusProfile()
+        try:
+            profile.loadCSV(fileName)
+        except ValueError:
+            self.statusBar().showMessage("Invalid stimulus profile "+fileName)
+            return
 
-            item = QTableWidgetItem(override.cal_type)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.overrides_table.setItem(row, 3, item)
+        runner = StimulusRunner(self.yacp.session, profile)
+        runner.error_signal.connect(lambda error: self.statusBar().showMessage("Stimulus profile "+fileName+" does not match the loaded def: "+error))
+        if not runner.resolve():
+            return
 
-            item = QTableWidgetItem(override.unit)
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.overrides_table.setItem(row, 4, item)
-            row += 1
-        self.overrides_table.horizontalHeader().resizeSections(QHeaderView.ResizeToContents)
-        self.overrides_table.cellChanged.connect(self.on_override_change)
+        self.stimulus = runner
+        self.stimulus_file = fileName
+        runner.update_override_signal.connect(self.updateStimulusOverride)
+        runner.finished.connect(self.stimulusFinished)
+        self.stimulusStopAct.setEnabled(True)
+        self.statusBar().showMessage("Running stimulus profile "+fileName)
+        runner.start(QThread.TimeCriticalPriority)
+
+    def stopStimulus(self):
+        if self.stimulus != None:
+            self.stimulus.stop = True
+            self.stimulus.wait()
+
+    def updateStimulusOverride(self, table_index, offset, overridden):
+        if self.stimulus != None and self.stimulus.session is self.yacp.session:
+            self.updateOverride(table_index, offset, overridden)
+
+    def stimulusFinished(self):
+        runner = self.stimulus
+        self.stimulus = None
+        self.stimulusStopAct.setEnabled(False)
+
+        # The achieved timing is saved next to the profile
+        logName = os.path.splitext(self.stimulus_file)[0]+"-log.csv"
+        runner.saveLog(logName)
+        self.statusBar().showMessage(runner.report()+", log saved to "+logName)
+
+    def startCaptureDialog(self):
+        if self.yacp.device_state != YACPProtocol.DEVICE_STATE_CONNECTED or self.capture != None:
+            self.statusBar().showMessage("Connect to a device to start a capture")
+            return
 
-    def on_setting_change(self, table_index, column):
-        if column != 1 or table_index == None:
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getOpenFileName(self,"Open Capture Config",self.projectPath,"Capture Configs (*.json)", options=options)
+        if fileName:
+            self.startCapture(fileName)
+
+    def startCapture(self, fileName):
+        try:
+            capture = load_capture(self.yacp, fileName)
+        except (ValueError, KeyError) as e:
+            self.statusBar().showMessage("Invalid capture config: "+str(e))
             return
 
-        setting_key = [*self.yacp.settings][table_index]
-        str_val = self.settings_table.item(table_index, column).text()
-        
-        self.yacp.sendSettingChange(setting_key, str_val)
-        
-    def on_override_change(self, table_index, column):
-        if column != 2 or table_index == None:
+        self.capture = capture
+        capture.capture_saved_signal.connect(self.captureSaved)
+        capture.start()
+        self.captureStopAct.setEnabled(True)
+        self.statusBar().showMessage("Capture armed")
+
+    def stopCapture(self):
+        if self.capture != None:
+            self.capture.stop()
+            self.capture = None
+            self.captureStopAct.setEnabled(False)
+
+    def captureSaved(self, fileName):
+        self.statusBar().showMessage("Capture saved to "+fileName)
+
+    def startRecordingDialog(self):
+        self.recordingDialog(None)
+
+    # Records the given measurements, all of them when None
+    def recordingDialog(self, measurement_keys):
+        if self.yacp.device_state != YACPProtocol.DEVICE_STATE_CONNECTED or self.recorder != None:
+            self.statusBar().showMessage("Connect to a device to start a recording")
+            return
+
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getSaveFileName(self,"Save Recording",self.projectPath,"Recordings (*.csv)", options=options)
+        if fileName:
+            self.startRecording(fileName, measurement_keys)
+
+    def startRecording(self, fileName, measurement_keys=None):
+        recorder = Recorder(self.yacp, fileName, measurement_keys)
+        try:
+            recorder.start()
+        except OSError as e:
+            self.statusBar().showMessage("Failed to start recording: "+str(e))
             return
 
-        override_key = [*self.yacp.overrides][table_index]
-        str_val = self.overrides_table.item(table_index, 2).text()
-        override_status = self.overrides_table.cellWidget(table_index, 1).currentText()
+        self.recorder = recorder
+        self.recordStopAct.setEnabled(True)
+        self.statusBar().showMessage("Recording to "+fileName)
 
-        self.yacp.sendOverrideChange(override_key, str_val, override_status)
-        
-    def on_override_status_change(self):
-        combo = self.sender()
-        table_index = combo.property('row')
-        self.on_override_change(table_index, 2)
+    def stopRecording(self):
+        if self.recorder != None:
+            self.recorder.stop()
+            self.statusBar().showMessage("Recording saved to "+self.recorder.fileName)
+            self.recorder = None
+            self.recordStopAct.setEnabled(False)
+
+    def exportRecordingDialog(self):
+        if self.export_runner != None:
+            self.statusBar().showMessage("An export is already running")
+            return
 
-    def on_setting_combobox_change(self):
-        combo = self.sender()
-        table_index = combo.property('row')
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getOpenFileName(self,"Open Recording",self.projectPath,"Recordings (*.csv)", options=options)
+        if not fileName:
+            return
 
-        if table_index == None:
+        outName, _ = QFileDialog.getSaveFileName(self,"Export Recording",os.path.splitext(fileName)[0]+".npz","NumPy Archives (*.npz);;NumPy Column Directories (*.npy);;CSV Files (*.csv)", options=options)
+        if not outName:
             return
 
-        setting_key = [*self.yacp.settings][table_index]
-        choice = combo.currentData()
+        period, ok = QInputDialog.getDouble(self, "Export Recording", "Sample period (ms)", 10, 0.001, 3600000, 3)
+        if not ok:
+            return
 
-        self.yacp.sendSettingChange(setting_key, choice)
-        
+        from yacp_export import METHODS
+        method, ok = QInputDialog.getItem(self, "Export Recording", "Resampling", METHODS, 0, False)
+        if not ok:
+            return
+
+        self.exportRecording(fileName, outName, period / 1000, method)
+
+    def exportRecording(self, fileName, outName, period, method):
+        # numpy is only loaded for exports
+        from yacp_export import ExportRunner
+        runner = ExportRunner(fileName, outName, period, method)
+        runner.export_done_signal.connect(self.exportDone)
+        self.export_runner = runner
+        self.exportAct.setEnabled(False)
+        runner.start()
+        self.statusBar().showMessage("Exporting "+fileName)
+
+    def exportDone(self, error):
+        runner = self.export_runner
+        self.export_runner = None
+        self.exportAct.setEnabled(True)
+
+        if error != "":
+            self.statusBar().showMessage("Export failed: "+error)
+        else:
+            self.statusBar().showMessage("Exported to "+runner.outName)
+
+    def busLost(self, name):
+        self.statusBar().showMessage("Lost "+name+", reconnecting")
+
+    def busRestored(self, name):
+        self.statusBar().showMessage("Reconnected "+name)
+
+    def busSilent(self, name):
+        self.statusBar().showMessage("No response from the devices on "+name)
+
+    def busAnswering(self, name):
+        self.statusBar().showMessage("The devices on "+name+" answer again")
+
+    def commandFailed(self):
+        self.statusBar().showMessage("The device rejected the override changes, reading its overrides again")
 
     def loadDefFileDialog(self):
         options = QFileDialog.Options()
@@ -430,11 +1057,46 @@ class YACPcal(QMainWindow):
             self.loadDefFile(fileName)
 
     def loadDefFile(self, fileName):
-        self.measurements_table.setRowCount(0)
-        self.settings_table.setRowCount(0)
-        self.overrides_table.setRowCount(0)
+        # Replaces the def of the last session, whether or not it is loaded yet
+        self.startup_def = None
+        if self.def_loader != None:
+            self.def_loader.cancelled = True
+
+        self.installDef(fileName, self.yacp.readDefFile(fileName))
+
+    def loadStartupDef(self):
+        if self.startup_def != None:
+            self.loadDefFileBackground(self.startup_def)
+
+    def loadDefFileBackground(self, fileName):
+        self.statusBar().showMessage("Loading "+fileName)
+
+        loader = DefLoader(self.yacp, fileName)
+        loader.finished.connect(self.defLoaderFinished)
+        self.def_loader = loader
+        loader.start()
+
+    def defLoaderFinished(self):
+        loader = self.def_loader
+        self.def_loader = None
+        self.startup_def = None
+
+        if loader.cancelled:
+            return
+
+        if loader.definition == None:
+            self.statusBar().showMessage("Failed to load def "+loader.fileName+": "+loader.error)
+            return
+
+        self.statusBar().showMessage("Loaded "+loader.fileName)
+        self.installDef(loader.fileName, loader.definition)
+
+    def installDef(self, fileName, definition):
+        self.measurements_model.setMeasurements({})
+        self.settings_model.setEntries({})
+        self.overrides_model.setOverrides({}, {})
                 
-        revision = self.yacp.loadDefFile(fileName)
+        revision = self.yacp.installDef(definition)
 
         if revision == -1:
             print("No revision found...")
@@ -444,131 +1106,212 @@ class YACPcal(QMainWindow):
 
         self.btn_hello.setEnabled(True)
         self.calOpenAct.setEnabled(True)
+        self.updateDeviceList()
         self.recentCalMenu.setEnabled(True)
                 
         self.config["RecentDefs"][os.path.basename(fileName)] = fileName
+        self.config['YACP']['LastDef'] = fileName
         self.recentDefFiles[os.path.basename(fileName)] = fileName
         self.projectPath = os.path.split(fileName)[0]
         self.saveConfig()
 
+        # The search stays, the new def's index answers it
+        self.search_results = self.yacp.search_index.search(self.txt_search.text())
         self.update_widgets()
         
+    # Only sent when the measurement's raw value changed. The graph keeps every
+    # sample, the table and plot are redrawn by renderFrame().
     def updateMeasurement(self, table_index, offset):
-        measurement = self.yacp.measurements[offset]
-        val = str(measurement.value)
-        for value in measurement.values.keys():
-            if val == value:
-                val = measurement.values[value]
-                break
-
         if self.graph_row != -1 and self.graph_row == table_index:
-            self.graph_y = self.graph_y[1:]
-            self.graph_y.append(float(val)) 
-            self.graph_line.setData(self.graph_x, self.graph_y)   
-        
-        self.measurements_table.item(table_index, 1).setText(val)
+            measurement = self.yacp.measurements[offset]
+            self.graph_x = self.graph_x[-(GRAPH_SAMPLES-1):]
+            self.graph_y = self.graph_y[-(GRAPH_SAMPLES-1):]
+            self.graph_x.append(measurement.timestamp or time.time())
+            self.graph_y.append(float(measurement.value))
+            self.dirty_graph = True
 
-    def updateSetting(self, table_index, offset):
-        self.settings_table.cellChanged.disconnect()
-        
-        setting = self.yacp.settings[offset]
-        if len(setting.choices) == 0:
-            self.settings_table.item(table_index, 1).setText(str(setting.value))
-        else:
-            index = self.settings_table.cellWidget(table_index, 1).findData(setting.value)
-            self.settings_table.cellWidget(table_index, 1).setCurrentIndex(index)
+        self.dirty_measurements[table_index] = offset
 
-        self.settings_table.cellChanged.connect(self.on_setting_change)
+    def updateSetting(self, table_index, offset):
+        if offset in self.settings_model.rows:
+            self.dirty_settings[self.settings_model.rows[offset]] = offset
 
     def updateOverride(self, table_index, offset, overridden):
-        override = self.yacp.overrides[offset]
-        
-        self.overrides_table.item(table_index, 2).setText(str(override.value))
-        if overridden:
-            self.overrides_table.cellWidget(table_index, 1).setCurrentText("Overridden")
-        else:
-            self.overrides_table.cellWidget(table_index, 1).setCurrentText("Passthrough")
-        
+        if offset in self.overrides_model.rows:
+            self.dirty_overrides[self.overrides_model.rows[offset]] = offset
+
+    def updateDeviceState(self):
+        self.dirty_device_state = True
+
+    def renderFrame(self):
+        if self.dirty_measurements:
+            self.measurements_model.valuesChanged(self.dirty_measurements.keys())
+            self.dirty_measurements.clear()
+
+        if self.dirty_graph:
+            # Plotted against the receive times, the latest sample at 0
+            latest = self.graph_x[-1]
+            self.graph_line.setData([x - latest for x in self.graph_x], self.graph_y)
+            self.dirty_graph = False
+
+        if self.dirty_settings:
+            self.settings_model.valuesChanged(self.dirty_settings.keys())
+            self.dirty_settings.clear()
+
+        if self.dirty_overrides:
+            self.overrides_model.valuesChanged(self.dirty_overrides.keys())
+            self.dirty_overrides.clear()
+
+        if self.dirty_device_state:
+            self.renderDeviceState()
+            self.dirty_device_state = False
+
+        if self.pending_cal_export and self.yacp.settingsLoaded():
+            self.pending_cal_export = False
+            self.exportSettingsCSV()
+
+        self.updateSubscriptions()
+        self.loadShownSections()
+
+    # Keeps the protocol polling the measurements on screen and in the graph first
+    def updateSubscriptions(self):
+        keys = self.measurements_model.keys
+        table = self.measurements_table
+        proxy = self.measurements_proxy
+
+        visible = [keys[row] for row in self.shownRows(table, proxy)]
+
+        graph = []
+        if self.graph_row != -1 and self.graph_row < len(keys):
+            graph = [keys[self.graph_row]]
+
+        state = (self.yacp.session, visible, graph)
+        if state == self.subscribed_state:
+            return
+        self.subscribed_state = state
+
+        self.yacp.subscribe('visible', visible)
+        self.yacp.subscribe('graph', graph)
+
     def updateDeviceList(self):
+        selected = self.combo_devices.currentData()
         self.combo_devices.clear()
-        
-        for device_id in self.yacp.devices:
-            self.combo_devices.addItem(str(device_id))
 
-        if len(self.yacp.devices) > 0:
+        if self.yacp.can_state != 1:
+            return
+        
+        for key in sorted(self.yacp.getBusDevices()):
+            device = self.yacp.devices[key]
+            label = str(device.device_id)+" @ "+hex(device.base_can_id)
+            if len(self.yacp.can_threads) > 1:
+                label += " "+device.bus
+            if not device.confirmed:
+                label += " (cached)"
+            self.combo_devices.addItem(label, key)
+
+        index = self.combo_devices.findData(selected)
+        if index != -1:
+            self.combo_devices.setCurrentIndex(index)
+
+        # Known devices can be connected right away, the def is needed to read them
+        if self.combo_devices.count() > 0 and self.yacp.num_settings > 0:
             self.btn_device_connect.setEnabled(True)
+        else:
+            self.btn_device_connect.setEnabled(False)
 
     def sendHello(self):
-        self.combo_devices.clear()
-        self.btn_device_connect.setEnabled(False)
+        self.scanBus(None)
+
+    # Each bus is scanned once when it opens, the cached inventory is shown meanwhile
+    def busOpened(self, name):
+        self.scanBus(name)
 
-        #try:
-        base_can_id = int(self.txt_yacp_can_base_id.text(),16)
-        self.yacp.set_base_can_id(base_can_id)
-        #except:
-        #    print("Could not set base CAN ID")
+    def scanBus(self, name):
+        try:
+            base_can_ids = [int(x, 16) for x in self.txt_yacp_can_base_id.text().split(',') if x.strip() != ""]
+        except ValueError:
+            self.statusBar().showMessage("Invalid base CAN IDs")
+            return
+
+        self.config['YACP']['BaseCANIDs'] = ", ".join(hex(x) for x in base_can_ids)
+        self.statusBar().showMessage("Scanning for targets...")
         
-        self.yacp.sendHello()
+        self.yacp.scanDevices(base_can_ids, name)
+
+    def scanComplete(self):
+        self.statusBar().showMessage("Found "+str(len(self.yacp.getBusDevices()))+" target(s)")
 
     def deviceConnect(self):
-        device_id = int(self.combo_devices.currentText())
-        if device_id != None and device_id != "":
-            self.yacp.deviceConnect(device_id)
+        device_key = self.combo_devices.currentData()
+        if device_key != None:
+            # Other connected devices keep being polled in the background,
+            # reconnecting to one of them only switches the view
+            self.yacp.deviceConnect(device_key)
+            self.update_widgets()
 
     def saveSettings(self):
         self.yacp.saveSettings()
+
+        # The cal holds every setting, the sections not opened yet are read first
+        if not self.yacp.settingsLoaded():
+            self.yacp.loadAllSections()
+            self.pending_cal_export = True
+            self.statusBar().showMessage("Reading the remaining sections before saving the cal")
+            return
+
         self.exportSettingsCSV()
 
     def exportSettingsCSV(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        fileName, _ = QFileDialog.getSaveFileName(self,"Save Cal File",self.projectPath,"Cal Files (*.csv)", options=options)
+        fileName, _ = QFileDialog.getSaveFileName(self,"Save Cal File",self.projectPath,"Cal Files (*.csv);;Binary Cal Files (*.bin)", options=options)
         if fileName:
-            self.yacp.exportSettingsCSV(fileName)
+            if fileName.lower().endswith('.bin'):
+                self.yacp.exportSettingsBinary(fileName)
+            else:
+                self.yacp.exportSettingsCSV(fileName)
             
             self.statusBar().showMessage("Cal saved to "+fileName)
 
     def loadCalFileDialog(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        fileName, _ = QFileDialog.getOpenFileName(self,"Open Cal File",self.projectPath,"Cal Files (*.csv)", options=options)
+        fileName, _ = QFileDialog.getOpenFileName(self,"Open Cal File",self.projectPath,"Cal Files (*.csv *.bin)", options=options)
         if fileName:
             self.loadCalFile(fileName)
 
     def loadCalFile(self, fileName):
-        self.yacp.loadCalFile(fileName)
-        
-        for offset in self.yacp.settings:
-            setting = self.yacp.settings[offset]
-            table_index = setting.index
+        previous = {offset: self.yacp.settings[offset].value for offset in self.yacp.settings}
 
-            if len(setting.choices) == 0:
-                self.settings_table.item(table_index, 1).setText(str(setting.value))
-            else:
-                for choice in setting.choices.keys():
-                    if choice == str(setting.value):
-                        break
-                    i += 1
-                    
-                if i >= len(setting.choices):
-                    i = 0
-                
-                self.settings_table.cellWidget(table_index, 1).setCurrentIndex(i)
+        if fileName.lower().endswith('.bin'):
+            if not self.yacp.loadSettingsBinary(fileName):
+                self.statusBar().showMessage("Cal file "+fileName+" does not match the loaded def")
+                return
+        else:
+            self.yacp.loadCalFile(fileName)
+
+        for offset in self.yacp.settings:
+            if self.yacp.settings[offset].value != previous[offset]:
+                self.yacp.sendSetting(offset)
+                self.updateSetting(-1, offset)
 
         self.config["RecentCals"][os.path.basename(fileName)] = fileName
         self.recentCalFiles[os.path.basename(fileName)] = fileName
         self.projectPath = os.path.split(fileName)[0]
         self.saveConfig()
 
-    def updateDeviceState(self):
+    def renderDeviceState(self):
         if self.yacp.device_state == YACPProtocol.DEVICE_STATE_DISCONNECTED:
             pass
         
+        elif self.yacp.device_state == YACPProtocol.DEVICE_STATE_READING_SETTINGS_CRC:
+            self.statusBar().showMessage("Checking settings")
+
         elif self.yacp.device_state == YACPProtocol.DEVICE_STATE_READING_SETTINGS:
-            self.statusBar().showMessage("Reading setting "+str(self.yacp.read_setting_index+1)+"/"+str(self.yacp.num_settings))        
+            self.statusBar().showMessage("Reading setting "+str(self.yacp.read_setting_index+1)+"/"+str(self.yacp.read_setting_count))        
                            
         elif self.yacp.device_state == YACPProtocol.DEVICE_STATE_READING_OVERRIDES:
-            self.statusBar().showMessage("Reading override "+str(self.yacp.read_override_index+1)+"/"+str(self.yacp.num_overrides))
+            self.statusBar().showMessage("Reading override "+str(self.yacp.read_override_index+1)+"/"+str(self.yacp.read_override_count))
         
         elif self.yacp.device_state == YACPProtocol.DEVICE_STATE_READING_MEASUREMENTS:
             self.statusBar().showMessage("Reading measurement "+str(self.yacp.read_measurement_index+1)+"/"+str(self.yacp.num_measurements))
@@ -594,6 +1337,11 @@ class YACPcal(QMainWindow):
             bustype = 'vector'
             interface = '0'
 
+        # Several channels can be given to open a whole rig at once
+        if self.txt_channels.text().strip() != "":
+            interface = self.txt_channels.text()
+        self.config['YACP']['CANChannels'] = self.txt_channels.text()
+
         if bitrate == "125k":
             bitrate = 125000
         elif bitrate == "250k":
@@ -617,19 +1365,56 @@ class YACPcal(QMainWindow):
 
             self.combo_rate.setEnabled(False)
             self.combo_bustype.setEnabled(False)
+            self.txt_channels.setEnabled(False)
+
+            # Show the cached inventory immediately, busOpened confirms it in the background
+            self.updateDeviceList()
         elif self.yacp.can_state == 0:
             self.statusBar().showMessage("CAN device disconnected")
             self.btn_connect.setText("Connect")
             
             self.combo_rate.setEnabled(True)
             self.combo_bustype.setEnabled(True)
+            self.txt_channels.setEnabled(True)
             
             self.btn_hello.setEnabled(False)
             self.btn_device_connect.setEnabled(False)
             self.btn_save.setEnabled(False)
 
+            self.combo_devices.clear()
+
+
+# Reports the startup times in ms to yacp_startup_benchmark.py and quits: the imports
+# of this module, the window shown and the def of the last session loaded, then 1/0
+# for each of the modules that should not be loaded at startup
+def startup_benchmark(app, gui):
+    times = {}
+
+    def shown():
+        times['shown'] = time.perf_counter()
+        wait()
+
+    def wait():
+        if gui.startup_def != None:
+            QTimer.singleShot(5, wait)
+            return
+
+        loaded = time.perf_counter()
+        deferred = " ".join(name+"="+str(int(name in sys.modules)) for name in ["pyqtgraph", "can", "numpy"])
+        print("startup imports=%.1f shown=%.1f def=%.1f %s" % ((IMPORTED - STARTED) * 1000, (times['shown'] - STARTED) * 1000, (loaded - STARTED) * 1000, deferred))
+        sys.stdout.flush()
+        gui.close()
+        app.quit()
+
+    # Runs once the window has been shown and the event loop is up
+    QTimer.singleShot(0, shown)
+
+IMPORTED = time.perf_counter()
 
 if __name__ == "__main__":
+    # Needed by the out of process CAN worker in the frozen executable
+    multiprocessing.freeze_support()
+
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon('icon.ico'))
     
@@ -639,5 +1424,8 @@ if __name__ == "__main__":
     gui = YACPcal()
     gui.setGeometry(100, 100, 1900, 500)
     gui.show()
+
+    if "--startup-benchmark" in sys.argv:
+        startup_benchmark(app, gui)
     
     app.exec_()
@@ -7,7 +7,7 @@ a = Analysis(['YACPcal.py'],
              pathex=[],
              binaries=[],
              datas=[('icon.ico','.')],
-             hiddenimports=['can.interfaces.pcan','can.interfaces.kvaser','can.interfaces.ixxat','can.interfaces.vector','pyqtgraph.*'],
+             hiddenimports=['can.interfaces.pcan','can.interfaces.kvaser','can.interfaces.ixxat','can.interfaces.vector','pyqtgraph.*','yacp_worker'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
@@ -0,0 +1,286 @@
+"""
+YACPflash.py
+Yet Another Calibration Protocol (YACP)
+
+Command line tool that pushes a cal to many devices at once, e.g. at end of line.
+Every target gets its own session. All of them are written, verified by reading the
+settings back and saved to NVM concurrently, then a per device report is printed.
+
+Usage: YACPflash.py ./path/to/project-def.json ./path/to/cal.csv --channels can0,can1
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import argparse
+import sys
+import time
+import multiprocessing
+
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtCore import QTimer
+
+from yacp import YACPProtocol, lengths
+
+# Setting writes (and reads) sent to a device before waiting for its responses. Each
+# write is answered with debug frames and an ack, devices polling a single RX mailbox
+# lose frames when more are sent at once (--window)
+WINDOW = 1
+# Time a device may go without answering before its writes are resent or it fails
+TIMEOUT = 1.0
+# Times the writes that were not acknowledged are sent again
+WRITE_RETRIES = 3
+# Times the settings that did not come back are read again
+READ_RETRIES = 3
+
+TICK_MS = 2
+
+class FlashJob:
+    STATE_WRITING = 0
+    STATE_VERIFYING = 1
+    STATE_SAVING = 2
+    STATE_DONE = 3
+    STATE_FAILED = 4
+
+    def __init__(self, session, window=WINDOW):
+        self.session = session
+        self.window = window
+        self.device = session.device
+        self.state = FlashJob.STATE_WRITING
+        self.error = ""
+
+        # Each device keeps its own ID, the rest of the cal is the same for every target
+        for setting in session.settings.values():
+            if setting.name == "device_id":
+                setting.value = self.device.device_id
+
+        self.expected = bytes(session.setting_image)
+        self.keys = [*session.settings]
+        self.index = 0
+        self.retries = 0
+        self.acks_base = session.acks
+
+        self.start_time = time.perf_counter()
+        self.last_progress = self.start_time
+        self.answered = 0
+        self.times = [0, 0, 0]
+        self.phase_start = self.start_time
+
+    def name(self):
+        return str(self.device.device_id)+" @ "+hex(self.device.base_can_id)+" ["+self.device.bus+"]"
+
+    def done(self):
+        return self.state == FlashJob.STATE_DONE or self.state == FlashJob.STATE_FAILED
+
+    def fail(self, error):
+        self.error = error
+        self.state = FlashJob.STATE_FAILED
+
+    def nextPhase(self, state):
+        now = time.perf_counter()
+        self.times[self.state] = now - self.phase_start
+        self.phase_start = now
+        self.last_progress = now
+        self.answered = 0
+        self.index = 0
+        self.retries = 0
+        self.state = state
+
+    def tick(self):
+        session = self.session
+        now = time.perf_counter()
+
+        if session.nacks > 0:
+            self.fail("command rejected")
+            return
+
+        if self.state == FlashJob.STATE_WRITING:
+            answered = session.acks - self.acks_base
+            while self.index < len(self.keys) and self.index - answered < self.window:
+                session.sendSetting(self.keys[self.index])
+                self.index += 1
+
+            if answered >= len(self.keys):
+                session.settings_received.clear()
+                self.nextPhase(FlashJob.STATE_VERIFYING)
+            elif self.stalled(answered, now):
+                if self.retries >= WRITE_RETRIES:
+                    self.fail("settings not acknowledged")
+                    return
+
+                # Acks do not say which write they answer, so only with one write
+                # in flight is the first one not acknowledged known. Otherwise all of
+                # them are sent again
+                self.retries += 1
+                self.last_progress = now
+                self.index = answered if self.window == 1 else 0
+                self.acks_base = session.acks - self.index
+
+        elif self.state == FlashJob.STATE_VERIFYING:
+            answered = len(session.settings_received)
+            while self.index < len(self.keys) and self.index - answered < self.window:
+                self.readSetting(self.keys[self.index])
+                self.index += 1
+
+            if answered >= len(self.keys):
+                if bytes(session.setting_image) != self.expected:
+                    mismatched = [s.name for s in session.settings.values() if session.setting_image[s.offset:s.offset+lengths[s.cal_type]] != self.expected[s.offset:s.offset+lengths[s.cal_type]]]
+                    self.fail("readback mismatch: "+", ".join(mismatched))
+                    return
+
+                self.saved_acks = session.acks
+                session.saveSettings()
+                self.nextPhase(FlashJob.STATE_SAVING)
+            elif self.stalled(answered, now):
+                if self.retries >= READ_RETRIES:
+                    self.fail("settings not read back")
+                    return
+
+                # Lost responses are read again
+                self.retries += 1
+                self.last_progress = now
+                for key in self.keys:
+                    if key not in session.settings_received:
+                        self.readSetting(key)
+
+        elif self.state == FlashJob.STATE_SAVING:
+            if session.acks > self.saved_acks:
+                self.nextPhase(FlashJob.STATE_DONE)
+            elif now - self.last_progress > TIMEOUT:
+                self.fail("save not acknowledged")
+
+    # True once the device has stopped answering
+    def stalled(self, answered, now):
+        if answered != self.answered:
+            self.answered = answered
+            self.last_progress = now
+            return False
+
+        return now - self.last_progress > TIMEOUT
+
+    def readSetting(self, setting_key):
+        setting = self.session.settings[setting_key]
+        self.session.sendCommand(YACPProtocol.CAL_READ_SETTING, setting.offset, lengths[setting.cal_type])
+
+class FleetFlasher:
+    def __init__(self, app, yacp, args):
+        self.app = app
+        self.yacp = yacp
+        self.args = args
+        self.revision = -1
+        self.jobs = []
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.tick)
+
+    def run(self):
+        args = self.args
+
+        self.revision = int(str(self.yacp.loadDefFile(args.def_file)), 0)
+
+        if args.cal_file.lower().endswith('.bin'):
+            if not self.yacp.loadSettingsBinary(args.cal_file):
+                return 1
+        else:
+            self.yacp.loadCalFile(args.cal_file)
+
+        self.yacp.out_of_process_io = args.out_of_process
+        self.yacp.connect(args.bustype, args.channels, args.bitrate, True)
+        if self.yacp.can_state != 1:
+            print("Failed to open "+args.bustype+" "+args.channels)
+            return 1
+
+        self.yacp.app_scan_complete_signal.connect(self.startJobs)
+        self.yacp.scanDevices([int(x, 0) for x in args.base_can_ids.split(',')])
+
+        return self.app.exec_()
+
+    def startJobs(self):
+        devices = None
+        if self.args.devices != None:
+            devices = [int(x, 0) for x in self.args.devices.split(',')]
+
+        for key in sorted(self.yacp.getBusDevices()):
+            device = self.yacp.devices[key]
+            if devices != None and device.device_id not in devices:
+                continue
+
+            session = self.yacp.deviceConnect(key, activate=False, start=False)
+            job = FlashJob(session, self.args.window)
+            if device.cal_revision != self.revision:
+                job.fail("device cal revision "+str(device.cal_revision)+" does not match the def")
+            self.jobs.append(job)
+
+        if devices != None:
+            found = [job.device.device_id for job in self.jobs]
+            for device_id in devices:
+                if device_id not in found:
+                    print("Device "+str(device_id)+" not found")
+
+        if len(self.jobs) == 0:
+            print("No devices to flash")
+            self.finish()
+            return
+
+        print("Flashing "+str(len(self.jobs))+" devices")
+        self.start_time = time.perf_counter()
+        self.timer.start(TICK_MS)
+
+    def tick(self):
+        for job in self.jobs:
+            if not job.done():
+                job.tick()
+
+        if all(job.done() for job in self.jobs):
+            self.timer.stop()
+            self.report()
+            self.finish()
+
+    def report(self):
+        print("")
+        print("%-32s %8s %8s %8s %8s %8s  %s" % ("Device", "Settings", "Write", "Verify", "Save", "Total", "Result"))
+
+        for job in self.jobs:
+            total = sum(job.times)
+            result = "OK"
+            if job.state == FlashJob.STATE_FAILED:
+                result = "FAILED: "+job.error
+            print("%-32s %8d %8.3f %8.3f %8.3f %8.3f  %s" % (job.name(), len(job.keys), job.times[0], job.times[1], job.times[2], total, result))
+
+        ok = len([job for job in self.jobs if job.state == FlashJob.STATE_DONE])
+        print("")
+        print(str(ok)+" of "+str(len(self.jobs))+" devices flashed in "+("%.3f" % (time.perf_counter() - self.start_time))+" s")
+
+    def finish(self):
+        ok = len(self.jobs) > 0 and all(job.state == FlashJob.STATE_DONE for job in self.jobs)
+
+        self.yacp.close()
+        self.app.exit(0 if ok else 1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Flash a YACP cal to many devices at once")
+    parser.add_argument("def_file", help="project def (json)")
+    parser.add_argument("cal_file", help="cal file (csv or bin)")
+    parser.add_argument("--bustype", default="pcan", help="python-can interface (default pcan)")
+    parser.add_argument("--channels", default="PCAN_USBBUS1", help="comma separated list of channels")
+    parser.add_argument("--bitrate", type=int, default=500000)
+    parser.add_argument("--base-can-ids", default="0x100", help="comma separated list of base CAN IDs to scan")
+    parser.add_argument("--devices", default=None, help="comma separated list of device IDs (default all found)")
+    parser.add_argument("--window", type=int, default=WINDOW, help="setting writes and reads in flight per device (default "+str(WINDOW)+")")
+    parser.add_argument("--out-of-process", action="store_true", help="run the bus I/O in worker processes")
+    args = parser.parse_args()
+
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+
+    app = QCoreApplication(sys.argv)
+    yacp = YACPProtocol()
+
+    flasher = FleetFlasher(app, yacp, args)
+    sys.exit(flasher.run())
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,437 @@
+"""
+YACPgateway.py
+Yet Another Calibration Protocol (YACP)
+
+Gateway that owns the CAN adaptor and shares the devices on it with any number of
+clients (YACP scripts, test sequencers, dashboards) over a local TCP port, so they
+can watch and change the same device at once.
+
+Each connected device has one session. The measurements the clients subscribe to are
+merged into that session's poll schedule, so a measurement watched by several clients
+is polled once and every new value is sent to all of them. Settings and overrides are
+read once when the device is opened and kept up to date by the gateway, reading them
+costs no bus traffic. Writes from all clients go into one queue per device and are
+sent one at a time, each waiting for the device's ack before the next. Each written
+entry is then read back and the value the device holds is sent to every client.
+
+Clients send one JSON object per line and get one JSON object per line back. Requests
+can carry an "id" that is returned with their reply. "device" is [bus, base CAN ID,
+device ID] as listed by "devices", and can be left out when the gateway knows one device.
+
+ {"op": "devices"}
+ {"op": "open", "device": [...]}                              entry names and state
+ {"op": "subscribe", "measurements": ["batt_voltage"]}        replaces the subscription
+ {"op": "get", "kind": "settings", "names": ["device_id"]}    all of the kind without names
+ {"op": "set", "setting": "gain", "value": 1.5}
+ {"op": "override", "override": "fan", "value": 3, "overridden": true}
+ {"op": "close"}
+
+Events are sent to the clients that opened the device: "measurement" (subscribed ones),
+"setting", "override" and "state", plus "bus_lost", "bus_restored", "bus_silent" and
+"bus_answering" to every client. Overrides are [value, overridden].
+
+Usage: YACPgateway.py ./path/to/project-def.json --bustype socketcan --channels can0 --port 5170
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import argparse
+import json
+import sys
+import time
+import multiprocessing
+
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtCore import QTimer
+from PyQt5.QtNetwork import QTcpServer
+from PyQt5.QtNetwork import QHostAddress
+
+from yacp import YACPProtocol
+
+PORT = 5170
+# Time a device may take to ack a write before it fails
+TIMEOUT = 1.0
+TICK_MS = 20
+
+KINDS = ["measurements", "settings", "overrides"]
+
+class GatewayError(Exception):
+    pass
+
+class Client:
+    def __init__(self, socket, number):
+        self.socket = socket
+        self.owner = "gateway-client-"+str(number)
+        self.buffer = b""
+        # Device key -> subscribed measurement keys
+        self.devices = {}
+
+    def send(self, message):
+        if self.socket != None:
+            self.socket.write(json.dumps(message).encode()+b"\n")
+
+class Write:
+    def __init__(self, client, request, kind, key, value, overridden=False):
+        self.client = client
+        self.request = request
+        self.kind = kind
+        self.key = key
+        self.value = value
+        self.overridden = overridden
+        # When it was sent and the acks and nacks of the device before it
+        self.sent_time = 0
+        self.answered = 0
+        self.nacks = 0
+
+class DeviceGateway:
+    def __init__(self, session):
+        self.session = session
+        self.clients = []
+        self.writes = []
+        self.write = None
+        self.device_state = session.device_state
+
+    # The next write once the previous one was answered
+    def tick(self):
+        session = self.session
+
+        if self.write != None:
+            write = self.write
+            if session.acks + session.nacks > write.answered:
+                self.finish(write, session.nacks == write.nacks)
+            elif time.perf_counter() - write.sent_time > TIMEOUT:
+                self.finish(write, False, "not acknowledged")
+            return
+
+        if len(self.writes) == 0 or session.device_state != YACPProtocol.DEVICE_STATE_CONNECTED:
+            return
+
+        write = self.writes.pop(0)
+        write.answered = session.acks + session.nacks
+        write.nacks = session.nacks
+        write.sent_time = time.perf_counter()
+        self.write = write
+
+        try:
+            if write.kind == "settings":
+                session.sendSettingChange(write.key, str(write.value))
+            else:
+                session.sendOverrideChange(write.key, str(write.value), "Overridden" if write.overridden else "Passthrough")
+        except ValueError as e:
+            self.write = None
+            reply(write.client, write.request, {"error": str(e)})
+
+    def finish(self, write, success, error="rejected"):
+        self.write = None
+
+        # What the device holds now goes to every client, also when the write failed
+        if write.kind == "settings":
+            self.session.readSettingKey(write.key)
+        else:
+            self.session.readOverrideKey(write.key)
+
+        if success:
+            reply(write.client, write.request, {"ok": True})
+        else:
+            reply(write.client, write.request, {"error": write.kind[:-1]+" "+error})
+
+def reply(client, request, message):
+    if "id" in request:
+        message["id"] = request["id"]
+    client.send(message)
+
+class Gateway:
+    def __init__(self, app, yacp, args):
+        self.app = app
+        self.yacp = yacp
+        self.args = args
+        # A device keeps one image of what it last reported for deltas, another host polling
+        # the same device for deltas would take the changes meant for the gateway
+        self.yacp.delta_measurements = False
+
+        self.clients = []
+        self.client_count = 0
+        # Device key -> DeviceGateway of the devices opened by a client
+        self.devices = {}
+        # Kind -> entry name -> key, the same for every session
+        self.names = {}
+
+        self.server = QTcpServer()
+        self.server.newConnection.connect(self.acceptClients)
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.tick)
+
+    def run(self):
+        args = self.args
+
+        self.yacp.loadDefFile(args.def_file)
+        session = self.yacp.offline_session
+        for kind, entries in zip(KINDS, [session.measurements, session.settings, session.overrides]):
+            self.names[kind] = {entry.name: key for key, entry in entries.items()}
+
+        self.yacp.settings_cache = args.settings_cache
+        self.yacp.out_of_process_io = args.out_of_process
+        self.yacp.connect(args.bustype, args.channels, args.bitrate, True)
+        if self.yacp.can_state != 1:
+            print("Failed to open "+args.bustype+" "+args.channels)
+            return 1
+
+        self.yacp.session_update_measurement_signal.connect(self.updateMeasurement)
+        self.yacp.session_update_setting_signal.connect(self.updateSetting)
+        self.yacp.session_update_override_signal.connect(self.updateOverride)
+        self.yacp.app_bus_lost_signal.connect(lambda name: self.broadcast({"event": "bus_lost", "bus": name}))
+        self.yacp.app_bus_restored_signal.connect(lambda name: self.broadcast({"event": "bus_restored", "bus": name}))
+        self.yacp.app_bus_silent_signal.connect(lambda name: self.broadcast({"event": "bus_silent", "bus": name}))
+        self.yacp.app_bus_answering_signal.connect(lambda name: self.broadcast({"event": "bus_answering", "bus": name}))
+
+        if not self.server.listen(QHostAddress(args.host), args.port):
+            print("Failed to listen on "+args.host+":"+str(args.port)+": "+self.server.errorString())
+            self.yacp.close()
+            return 1
+
+        self.yacp.scanDevices([int(x, 0) for x in args.base_can_ids.split(',')])
+        self.timer.start(TICK_MS)
+
+        print("YACP gateway on "+args.host+":"+str(self.server.serverPort()))
+        result = self.app.exec_()
+
+        self.yacp.close()
+        return result
+
+    def acceptClients(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.client_count += 1
+            client = Client(socket, self.client_count)
+            self.clients.append(client)
+
+            socket.readyRead.connect(lambda client=client: self.readClient(client))
+            socket.disconnected.connect(lambda client=client: self.removeClient(client))
+
+    def removeClient(self, client):
+        if client not in self.clients:
+            return
+        self.clients.remove(client)
+
+        for device_key in [*client.devices]:
+            self.closeDevice(client, device_key)
+
+        client.socket.deleteLater()
+        client.socket = None
+
+    def readClient(self, client):
+        client.buffer += bytes(client.socket.readAll())
+
+        while b"\n" in client.buffer:
+            (line, client.buffer) = client.buffer.split(b"\n", 1)
+            if line.strip() == b"":
+                continue
+
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("requests are JSON objects")
+            except ValueError as e:
+                client.send({"error": "invalid request: "+str(e)})
+                continue
+
+            try:
+                message = self.handle(client, request)
+            except GatewayError as e:
+                message = {"error": str(e)}
+            except (KeyError, ValueError, TypeError) as e:
+                message = {"error": "invalid request: "+str(e)}
+
+            # Writes reply once the device answered
+            if message != None:
+                reply(client, request, message)
+
+    def handle(self, client, request):
+        op = request.get("op")
+
+        if op == "devices":
+            return {"devices": [self.deviceInfo(key) for key in sorted(self.yacp.getBusDevices())]}
+        if op == "open":
+            return self.openDevice(client, self.deviceKey(request))
+
+        device_key = self.deviceKey(request)
+        if device_key not in client.devices:
+            raise GatewayError("device not open")
+        device = self.devices[device_key]
+        session = device.session
+
+        if op == "subscribe":
+            keys = set(self.entryKey("measurements", name) for name in request["measurements"])
+            client.devices[device_key] = keys
+            session.subscribe(client.owner, keys)
+            return {"values": {session.measurements[key].name: session.measurements[key].value for key in keys}}
+
+        if op == "get":
+            kind = request["kind"]
+            if kind not in KINDS:
+                raise GatewayError("unknown kind "+str(kind))
+            if "names" in request:
+                keys = [self.entryKey(kind, name) for name in request["names"]]
+            else:
+                keys = [*self.names[kind].values()]
+            return {"values": dict(entry_value(session, kind, key) for key in keys)}
+
+        if op == "set":
+            key = self.entryKey("settings", request["setting"])
+            device.writes.append(Write(client, request, "settings", key, request["value"]))
+            return None
+
+        if op == "override":
+            key = self.entryKey("overrides", request["override"])
+            device.writes.append(Write(client, request, "overrides", key, request["value"], bool(request.get("overridden", True))))
+            return None
+
+        if op == "close":
+            self.closeDevice(client, device_key)
+            return {"ok": True}
+
+        raise GatewayError("unknown op "+str(op))
+
+    def deviceKey(self, request):
+        if "device" not in request:
+            devices = self.yacp.getBusDevices()
+            if len(devices) != 1:
+                raise GatewayError("device needed, "+str(len(devices))+" devices found")
+            return devices[0]
+
+        device_key = tuple(request["device"])
+        if device_key not in self.yacp.devices:
+            raise GatewayError("no device "+str(request["device"]))
+        return device_key
+
+    def entryKey(self, kind, name):
+        if name not in self.names[kind]:
+            raise GatewayError("no "+kind[:-1]+" "+str(name))
+        return self.names[kind][name]
+
+    def deviceInfo(self, device_key):
+        device = self.yacp.devices[device_key]
+        return {
+            "device": list(device_key),
+            "product_id": device.product_id,
+            "firmware_version": device.firmware_version,
+            "cal_revision": device.cal_revision,
+            "open": device_key in self.devices,
+        }
+
+    def openDevice(self, client, device_key):
+        if device_key not in self.devices:
+            session = self.yacp.deviceConnect(device_key, activate=False)
+            self.devices[device_key] = DeviceGateway(session)
+
+        device = self.devices[device_key]
+        if client not in device.clients:
+            device.clients.append(client)
+            client.devices[device_key] = set()
+
+        message = {"device": list(device_key), "state": device.session.device_state}
+        for kind in KINDS:
+            message[kind] = [*self.names[kind]]
+        return message
+
+    # The device is disconnected once no client has it open
+    def closeDevice(self, client, device_key):
+        client.devices.pop(device_key, None)
+        device = self.devices.get(device_key)
+        if device == None or client not in device.clients:
+            return
+
+        device.clients.remove(client)
+        device.session.subscribe(client.owner, [])
+
+        if len(device.clients) == 0 and device.write == None and len(device.writes) == 0:
+            del self.devices[device_key]
+            self.yacp.deviceDisconnect(device_key)
+
+    def tick(self):
+        for device_key in [*self.devices]:
+            device = self.devices[device_key]
+            device.tick()
+
+            if device.session.device_state != device.device_state:
+                device.device_state = device.session.device_state
+                self.send(device_key, {"event": "state", "state": device.device_state})
+
+            # Closed while its last writes were still going out
+            if len(device.clients) == 0 and device.write == None and len(device.writes) == 0:
+                del self.devices[device_key]
+                self.yacp.deviceDisconnect(device_key)
+
+    def send(self, device_key, message, measurement_key=None):
+        device = self.devices.get(device_key)
+        if device == None:
+            return
+
+        message["device"] = list(device_key)
+        for client in device.clients:
+            if measurement_key == None or measurement_key in client.devices[device_key]:
+                client.send(message)
+
+    def broadcast(self, message):
+        for client in self.clients:
+            client.send(message)
+
+    #@pyqtSlot(object,int)
+    def updateMeasurement(self, device_key, key):
+        device = self.devices.get(device_key)
+        if device == None:
+            return
+
+        measurement = device.session.measurements[key]
+        self.send(device_key, {"event": "measurement", "name": measurement.name, "value": measurement.value, "time": measurement.timestamp}, key)
+
+    #@pyqtSlot(object,int)
+    def updateSetting(self, device_key, key):
+        device = self.devices.get(device_key)
+        if device != None:
+            (name, value) = entry_value(device.session, "settings", key)
+            self.send(device_key, {"event": "setting", "name": name, "value": value})
+
+    #@pyqtSlot(object,int)
+    def updateOverride(self, device_key, key):
+        device = self.devices.get(device_key)
+        if device != None:
+            (name, value) = entry_value(device.session, "overrides", key)
+            self.send(device_key, {"event": "override", "name": name, "value": value})
+
+def entry_value(session, kind, key):
+    if kind == "measurements":
+        entry = session.measurements[key]
+        return (entry.name, entry.value)
+    if kind == "settings":
+        entry = session.settings[key]
+        return (entry.name, entry.value)
+    entry = session.overrides[key]
+    return (entry.name, [entry.value, entry.status == "Overridden"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the YACP devices on a CAN adaptor with many clients")
+    parser.add_argument("def_file", help="project def (json)")
+    parser.add_argument("--bustype", default="pcan", help="python-can interface (default pcan)")
+    parser.add_argument("--channels", default="PCAN_USBBUS1", help="comma separated list of channels")
+    parser.add_argument("--bitrate", type=int, default=500000)
+    parser.add_argument("--base-can-ids", default="0x100", help="comma separated list of base CAN IDs to scan")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default local only)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--settings-cache", default=None, help="directory to cache the settings read from devices in")
+    parser.add_argument("--out-of-process", action="store_true", help="run the bus I/O in worker processes")
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    yacp = YACPProtocol()
+
+    gateway = Gateway(app, yacp, args)
+    sys.exit(gateway.run())
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,79 @@
+"""
+test_yacp_export.py
+Yet Another Calibration Protocol (YACP)
+
+Regression tests for resampling recordings in yacp_export.py.
+
+ python -m pytest test_yacp_export.py
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from yacp_export import Recording, resample, sample_count
+
+RECORDING = """time_s,measurement,value,round_trip_ms
+0.000000,a,1,
+0.000000,b,5,
+0.100000,a,2,
+0.200000,#gap,0.100,
+0.300000,b,6,
+0.350000,a,3,
+"""
+
+class ResampleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="yacp-test-")
+        fileName = os.path.join(self.directory, "recording.csv")
+        with open(fileName, 'w') as recording_file:
+            recording_file.write(RECORDING)
+        self.recording = Recording(fileName)
+
+    def tearDown(self):
+        self.recording.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def resampled(self, method):
+        times = []
+        columns = [[] for name in self.recording.names]
+        for (t, values) in resample(self.recording, 0.05, method):
+            times += list(t)
+            for column, chunk in zip(columns, values):
+                column += list(chunk)
+        return (np.array(times), dict(zip(self.recording.names, [np.array(column) for column in columns])))
+
+    def testLastSampleKept(self):
+        self.assertEqual(sample_count(self.recording, 0.05), 8)
+        (t, columns) = self.resampled("hold")
+        self.assertAlmostEqual(t[-1], 0.35)
+        self.assertEqual(columns["a"][-1], 3)
+
+    def testLinearHoldsUntilGap(self):
+        (t, columns) = self.resampled("linear")
+
+        # Between the last sample and the gap the value is known
+        self.assertEqual(columns["a"][3], 2)
+        self.assertEqual(columns["b"][2], 5)
+        self.assertEqual(columns["b"][3], 5)
+
+        # Inside the gap it is not, until the first sample after it
+        self.assertTrue(np.isnan(columns["a"][4]))
+        self.assertTrue(np.isnan(columns["b"][5]))
+        self.assertEqual(columns["b"][6], 6)
+
+    def testLinearMatchesHoldBeforeGap(self):
+        (t, linear) = self.resampled("linear")
+        (t, hold) = self.resampled("hold")
+        self.assertEqual(linear["a"][3], hold["a"][3])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,12 +11,14 @@ See license.txt at the root of the repository for full license text.
 """
 
 import traceback
+import copy
 import csv
 import json
+import os
+import re
 import struct
 import sys
 import time
-import can
 
 from PyQt5.QtCore import Qt, QObject
 from PyQt5.QtCore import QThread
@@ -25,6 +27,8 @@ from PyQt5.QtCore import pyqtSlot
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtCore import QTimer
 
+from yacp_search import SearchIndex
+
 lengths = {}
 lengths["uint8"] = 1
 lengths["int8"] = 1
@@ -34,193 +38,422 @@ lengths["uint32"] = 4
 lengths["int32"] = 4
 lengths["float"] = 4
 
+# Layout of each type in the device's (little endian) cal structs
+formats = {}
+formats["uint8"] = struct.Struct('<B')
+formats["int8"] = struct.Struct('<b')
+formats["uint16"] = struct.Struct('<H')
+formats["int16"] = struct.Struct('<h')
+formats["uint32"] = struct.Struct('<I')
+formats["int32"] = struct.Struct('<i')
+formats["float"] = struct.Struct('<f')
+
+# cal_override size and offset of its value for each def "layout", see YACPGen
+override_layouts = {}
+override_layouts["packed"] = (5, 1)
+override_layouts["aligned"] = (8, 4)
+
+# Same layout as the device's EEPROM: settings CRC followed by the cal_settings struct
+EEPROM_CRC_OFFSET = 0
+EEPROM_SETTINGS_OFFSET = 4
+
+crc_table = [
+    0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
+    0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
+    0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
+    0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c
+]
+
+# The CRC yacp_eeprom_crc() computes over the stored settings
+def yacp_crc(data):
+    crc = 0xFFFFFFFF
+    for val in data:
+        crc = crc_table[(crc ^ val) & 0x0f] ^ (crc >> 4)
+        crc = crc_table[(crc ^ (val >> 4)) & 0x0f] ^ (crc >> 4)
+        crc = ~crc & 0xFFFFFFFF
+
+    return crc
+
+def parse_value(cal_type, str_val):
+    if cal_type == 'float':
+        return float(str_val)
+    try:
+        return int(str_val)
+    except ValueError:
+        value = int(str_val, 0)
+
+    # Hex and binary text of a signed type is its two's complement
+    bits = lengths[cal_type] * 8
+    if cal_type.startswith('int') and value >= 1 << (bits - 1):
+        value -= 1 << bits
+
+    return value
+
+# Setting and override writes carry the value as var_len bytes of the device's cal
+# struct in reverse (most significant byte first), which yacp_update_setting decodes.
+# Reads answer with the struct's bytes as they are. Overrides always write the
+# OVERRIDE_WRITE_LEN byte field, so smaller values end up in its last bytes.
+OVERRIDE_WRITE_LEN = 4
+
+def write_bytes(cal_type, value, var_len):
+    data = formats[cal_type].pack(value).ljust(var_len, b'\0')[::-1]
+    return list(data) + [0] * (4 - var_len)
+
+# Offsets of struct members of the given sizes (in def order) and the struct size, as
+# YACPGen lays them out. The aligned layout puts the widest members first so every
+# member is naturally aligned without padding between them.
+def struct_layout(sizes, layout):
+    order = list(range(len(sizes)))
+    if layout == "aligned":
+        order.sort(key=lambda i: -sizes[i])
+
+    offsets = [0] * len(sizes)
+    size = 0
+    for i in order:
+        offsets[i] = size
+        size += sizes[i]
+
+    if layout == "aligned" and len(sizes) > 0:
+        align = max(min(x, 4) for x in sizes)
+        size = (size + align - 1) // align * align
+
+    return (offsets, size)
+
+# Opens a python-can bus. socketcand channels are given as interface@host:port, e.g.
+# yacp@localhost:29536 for the Linux device simulator in api/drivers/Linux
+def open_bus(bustype, channel, bitrate):
+    # python-can and its backends are only loaded once a bus is opened
+    import can
+
+    if bustype == 'socketcand':
+        (interface, address) = channel.rsplit('@', 1) if '@' in channel else ('can0', channel)
+        (host, port) = address.rsplit(':', 1)
+        return can.interface.Bus(bustype=bustype, channel=interface, host=host, port=int(port), bitrate=bitrate)
+
+    return can.interface.Bus(bustype=bustype, channel=channel, bitrate=bitrate)
+
+# Base CAN IDs above 0x7FF select extended addressing: the base holds the 29 bit ID
+# prefix, the message type and device address move into the ID and var_start is 24 bits
+def is_extended(base_can_id):
+    return base_can_id > 0x7FF
+
+# Returns the CAN ID and data of a command
+def encode_frame(base_can_id, device_id, message_type, var_start=0, var_len=0, b0=0,b1=0,b2=0,b3=0):
+    if is_extended(base_can_id):
+        msg_id = base_can_id | (message_type << 16) | (device_id & 0xFFFF)
+        return (msg_id, [var_start & 0xFF, (var_start >> 8) & 0xFF, (var_start >> 16) & 0xFF, var_len, b0, b1, b2, b3])
+
+    return (base_can_id, [(device_id << 4) | message_type, var_start & 0xFF, var_start >> 8, var_len, b0, b1, b2, b3])
+
+# Returns (base CAN ID, device ID, message type, var_start, var_len) of a device response.
+# The var_start of a hello response holds the device's capability flags.
+def decode_frame(arbitration_id, is_extended_id, data):
+    if is_extended_id:
+        if not arbitration_id & YACPProtocol.YACP_EXT_RESPONSE:
+            return None
+        base_can_id = arbitration_id & YACPProtocol.YACP_EXT_BASE_MASK
+        return (base_can_id, arbitration_id & 0xFFFF, (arbitration_id >> 16) & 0x0F, data[0] | (data[1] << 8) | (data[2] << 16), data[3])
+
+    return (arbitration_id - 1, data[0] >> 4, data[0] & 0x0F, data[1] | (data[2] << 8), data[3])
+
+# Returns (base CAN ID, device ID, message type, var_start) of a command
+def command_key(msg_id, msg_data):
+    if is_extended(msg_id):
+        return (msg_id & YACPProtocol.YACP_EXT_BASE_MASK, msg_id & 0xFFFF, (msg_id >> 16) & 0x0F, msg_data[0] | (msg_data[1] << 8) | (msg_data[2] << 16))
+
+    return (msg_id, msg_data[0] >> 4, msg_data[0] & 0x0F, msg_data[1] | (msg_data[2] << 8))
+
+# Send time of the last request of each kind on a bus, so a response can be matched with
+# the request it answers. Both ends of a round trip are taken on the host's
+# time.perf_counter(), the adaptor's clock is never mixed in.
+class RequestTimes:
+    def __init__(self):
+        self.times = {}
+
+    def sent(self, msg_id, msg_data):
+        self.times[command_key(msg_id, msg_data)] = time.perf_counter()
+
+    # Returns -1 when no request is known
+    def roundTrip(self, base_can_id, device_id, message_type, var_start):
+        if message_type == YACPProtocol.CAL_READ_MEASUREMENT:
+            # Read directly or reported for the latest delta request
+            direct = self.times.get((base_can_id, device_id, YACPProtocol.CAL_READ_MEASUREMENT, var_start), 0)
+            delta = self.times.get((base_can_id, device_id, YACPProtocol.CAL_READ_MEASUREMENT_DELTA, 0), 0)
+            sent_time = max(direct, delta)
+        else:
+            if message_type == YACPProtocol.CAL_OVERRIDE_ON or message_type == YACPProtocol.CAL_OVERRIDE_OFF:
+                message_type = YACPProtocol.CAL_READ_OVERRIDE
+            sent_time = self.times.get((base_can_id, device_id, message_type, var_start), 0)
+
+        if sent_time == 0:
+            return -1
+        return time.perf_counter() - sent_time
+
+# Maps adaptor receive timestamps onto time.time(). The adaptor clock has its own epoch and
+# drifts, so the offset is the smallest host minus adaptor difference seen, which is the
+# frame with the least receive latency, renewed every WINDOW seconds. Samples keep the
+# adaptor's spacing but share the host clock with everything they are compared with.
+class AdaptorClock:
+    WINDOW = 10.0
+
+    def __init__(self):
+        self.offset = None
+        self.window_offset = None
+        self.window_end = 0
+
+    def hostTime(self, timestamp):
+        now = time.time()
+        if not timestamp:
+            return now
+
+        difference = now - timestamp
+        if self.window_offset == None or difference < self.window_offset:
+            self.window_offset = difference
+        if self.offset == None or difference < self.offset:
+            self.offset = difference
+        if now >= self.window_end:
+            self.offset = self.window_offset
+            self.window_offset = None
+            self.window_end = now + AdaptorClock.WINDOW
+
+        return timestamp + self.offset
+
 class CANThread(QThread):
-    update_measurement_signal = pyqtSignal(int,int,int,int,int,int)
-    update_setting_signal = pyqtSignal(int,int,int,int,int,int)
-    update_override_signal = pyqtSignal(bool,int,int,int,int,int,int)
-    update_hello_signal = pyqtSignal(int,int,int,int,int)
-    send_status_signal = pyqtSignal(int)
+    # Values carry their receive time on the host clock and the round trip of the request they
+    # answer, -1 when unknown
+    update_measurement_signal = pyqtSignal(str,int,int,int,int,bytes,float,float)
+    update_setting_signal = pyqtSignal(str,int,int,int,int,bytes,float,float)
+    update_override_signal = pyqtSignal(str,int,int,bool,int,int,bytes,float,float)
+    update_hello_signal = pyqtSignal(str,int,int,int,int,int,int,int,int)
+    update_ack_signal = pyqtSignal(str,int,int,int)
+    update_settings_crc_signal = pyqtSignal(str,int,int,bytes)
+    # 0: opened, 1: failed to open, 2: closed, 3: lost and reconnecting, 4: reconnected,
+    # 5: the connected devices went silent, 6: they answer again
+    send_status_signal = pyqtSignal(str,int)
+
+    # Measurement polling of connected sessions is done by the protocol timer
+    schedules_polls = False
     
     def __init__(self):
         self.bus = None
-        self.device_id = -1
+        self.name = ""
         self.stop = False
-        self.yacp_update_id = YACPProtocol.YACP_UPDATE_ID
-        self.yacp_command_id = YACPProtocol.YACP_COMMAND_ID
+        self.closing = False
+        self.bus_args = None
+        # Supervision: the run thread owns reopening the bus once it is lost
+        self.reconnect_time = None
+        self.reconnect_delay = YACPProtocol.BUS_RECONNECT_MIN
+        self.last_receive = 0
+        # time.time() of the last frame, where a gap in the values starts
+        self.last_receive_time = 0
+        self.silent = False
+        self.send_errors = 0
+        self.request_times = RequestTimes()
+        self.adaptor_clock = AdaptorClock()
+        self.scan_base_can_ids = set()
+        # base CAN ID -> device IDs of the sessions connected on this bus
+        self.listen_ids = {}
         
         QThread.__init__(self)
 
-    def set_base_can_id(self, base_can_id):
-        self.yacp_command_id = base_can_id
-        self.yacp_update_id = base_can_id + 1
+    def set_scan_base_can_ids(self, base_can_ids):
+        self.scan_base_can_ids = set(base_can_ids)
+
+    def addDevice(self, base_can_id, device_id):
+        # Silence is timed from when answers are first expected
+        if not self.expectsTraffic():
+            self.last_receive = time.monotonic()
+        self.listen_ids.setdefault(base_can_id, set()).add(device_id)
+
+    def removeDevice(self, base_can_id, device_id):
+        if base_can_id in self.listen_ids:
+            self.listen_ids[base_can_id].discard(device_id)
 
     def connect(self, _type, _channel, _bitrate):
+        self.name = str(_type)+":"+str(_channel)
+        self.bus_args = (_type, _channel, _bitrate)
         try:
-            self.bus = can.interface.Bus(bustype=_type, channel=_channel, bitrate=_bitrate)
-            self.send_status_signal.emit(0)
+            self.bus = open_bus(_type, _channel, _bitrate)
+            self.last_receive = time.monotonic()
+            self.last_receive_time = time.time()
+            self.send_status_signal.emit(self.name, 0)
         except:
             self.bus = None
             traceback.print_exc()
-            self.send_status_signal.emit(1)
+            self.send_status_signal.emit(self.name, 1)
 
     def disconnect(self):
-        try:
-            self.bus.shutdown()
-            self.send_status_signal.emit(2)
-        except:
-            pass
+        self.reconnect_time = None
+
+        # Shutting the bus down under the recv of the run thread fails it, so the
+        # thread closes the bus itself once recv returns
+        self.closing = True
+        if not self.isRunning():
+            self.closeBus()
+        self.send_status_signal.emit(self.name, 2)
+
+    def closeBus(self):
+        self.closing = False
+        bus = self.bus
         self.bus = None
+        if bus != None:
+            try:
+                bus.shutdown()
+            except:
+                pass
 
-    # run method gets called when we start the thread
-    def run(self):
-        while self.stop == False:
-            if self.bus != None:
-                for msg in self.bus:
-                    if msg.arbitration_id == self.yacp_update_id and msg.dlc == 8:
-                        device_id = msg.data[0] >> 4
-                        message_type = msg.data[0] & 0x0F
-                        var_start = msg.data[1]
-                        var_start |= msg.data[2] << 8
-                        var_len = msg.data[3]
-
-                        if message_type == YACPProtocol.CAL_HELLO:
-                            firmware_version = msg.data[4]
-                            product_id = msg.data[5]
-                            cal_revision = msg.data[6]
-                            cal_protocol = msg.data[7]
-                            
-                            self.update_hello_signal.emit(device_id, firmware_version, product_id, cal_revision, cal_protocol)
-
-                        if device_id != self.device_id:
-                            continue
-
-                        if message_type == YACPProtocol.CAL_READ_MEASUREMENT:               
-                            self.update_measurement_signal.emit(var_start,var_len,msg.data[4],msg.data[5],msg.data[6],msg.data[7])
-                        elif message_type == YACPProtocol.CAL_READ_SETTING:
-                            self.update_setting_signal.emit(var_start,var_len,msg.data[4],msg.data[5],msg.data[6],msg.data[7])
-                        elif message_type == YACPProtocol.CAL_OVERRIDE_ON:
-                            self.update_override_signal.emit(True,var_start,var_len,msg.data[4],msg.data[5],msg.data[6],msg.data[7])
-                        elif message_type == YACPProtocol.CAL_OVERRIDE_OFF:
-                            self.update_override_signal.emit(False,var_start,var_len,msg.data[4],msg.data[5],msg.data[6],msg.data[7])
-
-    @pyqtSlot(int)
-    def setDeviceId(self, device_id):
-        self.device_id = device_id
+    # Traffic is expected back while any device on this bus is connected
+    def expectsTraffic(self):
+        return any(len(device_ids) > 0 for device_ids in self.listen_ids.values())
 
-    @pyqtSlot(int,int,int,int,int,int)
-    def setSetting(self, var_start, var_len, b0,b1,b2,b3):
-        msg_data = [0,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
+    def busLost(self):
+        bus = self.bus
+        self.bus = None
+        try:
+            bus.shutdown()
+        except:
+            pass
 
-        msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_UPDATE_SETTING
-        msg_data[1] = var_start & 0xFF
-        msg_data[2] = var_start >> 8
-        msg_data[3] = var_len
-        msg_data[4] = b0
-        msg_data[5] = b1
-        msg_data[6] = b2
-        msg_data[7] = b3
+        # The wait grows with every loss until traffic is seen on a reopened bus
+        self.silent = False
+        self.reconnect_time = time.monotonic() + self.reconnect_delay
+        self.reconnect_delay = min(self.reconnect_delay * 2, YACPProtocol.BUS_RECONNECT_MAX)
+        self.send_status_signal.emit(self.name, 3)
 
-        self.sendCANMessage(msg_id, msg_data)
+    def reconnect(self):
+        (_type, _channel, _bitrate) = self.bus_args
+        try:
+            bus = open_bus(_type, _channel, _bitrate)
+        except:
+            # Back off so a missing adaptor is not hammered
+            self.reconnect_time = time.monotonic() + self.reconnect_delay
+            self.reconnect_delay = min(self.reconnect_delay * 2, YACPProtocol.BUS_RECONNECT_MAX)
+            return
 
-    @pyqtSlot(int,int,int,int,int,int,int)
-    def setOverride(self, enabled, var_start, var_len, b0,b1,b2,b3):
-        msg_data = [0,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
+        if self.stop or self.reconnect_time == None:
+            bus.shutdown()
+            return
 
-        if enabled == True:
-            msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_OVERRIDE_ON
-        else:
-            msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_OVERRIDE_OFF
-        msg_data[1] = var_start & 0xFF
-        msg_data[2] = var_start >> 8
-        msg_data[3] = var_len
-        msg_data[4] = b0
-        msg_data[5] = b1
-        msg_data[6] = b2
-        msg_data[7] = b3
+        self.reconnect_time = None
+        self.send_errors = 0
+        self.last_receive = time.monotonic()
+        self.bus = bus
+        self.send_status_signal.emit(self.name, 4)
 
-        self.sendCANMessage(msg_id, msg_data)
+    # run method gets called when we start the thread
+    def run(self):
+        while self.stop == False:
+            if self.closing:
+                self.closeBus()
 
-    @pyqtSlot()
-    def sendHello(self):
-        msg_data = [YACPProtocol.CAL_HELLO,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
+            bus = self.bus
+            if bus == None:
+                if self.reconnect_time != None and time.monotonic() >= self.reconnect_time:
+                    self.reconnect()
+                else:
+                    self.msleep(10)
+                continue
 
-        msg = can.Message(arbitration_id=msg_id, is_extended_id=False, data=msg_data)
-        if self.bus != None:
             try:
-                self.bus.send(msg, 1)
+                msg = bus.recv(0.1)
             except:
-                traceback.print_exc()
-
-    @pyqtSlot()
-    def sendSaveSettings(self):
-        msg_data = [0,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
-
-        msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_SAVE_SETTINGS
-
-        self.sendCANMessage(msg_id, msg_data)
+                if self.bus != None and not self.closing:
+                    traceback.print_exc()
+                    self.busLost()
+                continue
+
+            # Disconnected while waiting, the bus is closed at the top of the loop
+            if self.closing:
+                continue
+
+            # An adaptor that went away or a bus that went bus-off shows up as failing
+            # sends, the bus is reopened for those. Devices that stop answering (e.g.
+            # powered off) are only reported, reopening would not bring them back and
+            # would interrupt the other devices on the bus
+            now = time.monotonic()
+            if msg != None and not msg.is_error_frame:
+                self.last_receive = now
+                self.last_receive_time = time.time()
+                self.reconnect_delay = YACPProtocol.BUS_RECONNECT_MIN
+                if self.silent:
+                    self.silent = False
+                    self.send_status_signal.emit(self.name, 6)
+                self.handleMessage(msg)
+            elif self.send_errors >= YACPProtocol.BUS_SEND_ERROR_LIMIT:
+                self.busLost()
+            elif not self.silent and self.expectsTraffic() and now - self.last_receive > YACPProtocol.BUS_SILENCE_TIMEOUT:
+                self.silent = True
+                self.send_status_signal.emit(self.name, 5)
+
+        self.closeBus()
+
+    def handleMessage(self, msg):
+        if msg.dlc != 8:
+            return
 
-    @pyqtSlot(int,int)
-    def readMeasurement(self, var_start, var_len):
-        msg_data = [0,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
+        frame = decode_frame(msg.arbitration_id, msg.is_extended_id, msg.data)
+        if frame == None:
+            return
 
-        msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_READ_MEASUREMENT
-        msg_data[1] = var_start & 0xFF
-        msg_data[2] = var_start >> 8
-        msg_data[3] = var_len
-        msg_data[4] = 0
-        msg_data[5] = 0
-        msg_data[6] = 0
-        msg_data[7] = 0
+        # Hello responses are accepted from every base ID being scanned,
+        # everything else only from the devices connected on this bus
+        [base_can_id, device_id, message_type, var_start, var_len] = frame
+        listening = base_can_id in self.listen_ids
+        if not listening and base_can_id not in self.scan_base_can_ids:
+            return
 
-        self.sendCANMessage(msg_id, msg_data)
+        if message_type == YACPProtocol.CAL_HELLO:
+            firmware_version = msg.data[4]
+            product_id = msg.data[5]
+            cal_revision = msg.data[6]
+            cal_protocol = msg.data[7]
+            capabilities = var_start & 0xFF
+            
+            self.update_hello_signal.emit(self.name, base_can_id, device_id, firmware_version, product_id, cal_revision, cal_protocol, capabilities, var_len)
+            return
 
-    @pyqtSlot(int,int)
-    def readSetting(self, var_start, var_len):
-        msg_data = [0,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
+        if not listening or device_id not in self.listen_ids[base_can_id]:
+            return
 
-        msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_READ_SETTING
-        msg_data[1] = var_start & 0xFF
-        msg_data[2] = var_start >> 8
-        msg_data[3] = var_len
-        msg_data[4] = 0
-        msg_data[5] = 0
-        msg_data[6] = 0
-        msg_data[7] = 0
+        data = bytes(msg.data[4:8])
+        timestamp = self.adaptor_clock.hostTime(msg.timestamp)
+        round_trip = self.request_times.roundTrip(base_can_id, device_id, message_type, var_start)
+
+        if message_type == YACPProtocol.CAL_READ_MEASUREMENT:               
+            self.update_measurement_signal.emit(self.name, base_can_id, device_id, var_start, var_len, data, timestamp, round_trip)
+        elif message_type == YACPProtocol.CAL_READ_SETTING:
+            self.update_setting_signal.emit(self.name, base_can_id, device_id, var_start, var_len, data, timestamp, round_trip)
+        elif message_type == YACPProtocol.CAL_OVERRIDE_ON:
+            self.update_override_signal.emit(self.name, base_can_id, device_id, True, var_start, var_len, data, timestamp, round_trip)
+        elif message_type == YACPProtocol.CAL_OVERRIDE_OFF:
+            self.update_override_signal.emit(self.name, base_can_id, device_id, False, var_start, var_len, data, timestamp, round_trip)
+        elif message_type == YACPProtocol.CAL_ACK:
+            self.update_ack_signal.emit(self.name, base_can_id, device_id, data[0])
+        elif message_type == YACPProtocol.CAL_READ_SETTINGS_CRC:
+            self.update_settings_crc_signal.emit(self.name, base_can_id, device_id, data)
+
+    def sendCommand(self, base_can_id, device_id, message_type, var_start=0, var_len=0, b0=0,b1=0,b2=0,b3=0):
+        [msg_id, msg_data] = encode_frame(base_can_id, device_id, message_type, var_start, var_len, b0,b1,b2,b3)
 
         self.sendCANMessage(msg_id, msg_data)
 
-    @pyqtSlot(int,int)
-    def readOverride(self, var_start, var_len):
-        msg_data = [0,0,0,0,0,0,0,0]
-        msg_id = self.yacp_command_id
-
-        msg_data[0] = (self.device_id << 4) | YACPProtocol.CAL_READ_OVERRIDE
-        msg_data[1] = var_start & 0xFF
-        msg_data[2] = var_start >> 8
-        msg_data[3] = var_len
-        msg_data[4] = 0
-        msg_data[5] = 0
-        msg_data[6] = 0
-        msg_data[7] = 0
-
-        self.sendCANMessage(msg_id, msg_data)
+    def sendHello(self, base_can_id):
+        # Every device answers a hello, extended ones are addressed by broadcast
+        self.sendCommand(base_can_id, YACPProtocol.YACP_EXT_BROADCAST if is_extended(base_can_id) else 0, YACPProtocol.CAL_HELLO)
 
     def sendCANMessage(self, msg_id, msg_data):
-        if self.device_id == -1:
-            return
-        
-        msg = can.Message(arbitration_id=msg_id, is_extended_id=False, data=msg_data)
-        if self.bus != None:
+        import can
+        msg = can.Message(arbitration_id=msg_id, is_extended_id=msg_id > 0x7FF, data=msg_data)
+        bus = self.bus
+        if bus != None:
+            self.request_times.sent(msg_id, msg_data)
             try:
-                self.bus.send(msg, 1)
+                bus.send(msg, 1)
+                self.send_errors = 0
             except:
-                traceback.print_exc()
+                if self.send_errors == 0:
+                    traceback.print_exc()
+                self.send_errors += 1
 
 class YACPProtocol(QObject):
     YACP_COMMAND_ID = 0x100
@@ -235,21 +468,54 @@ class YACPProtocol(QObject):
     CAL_SAVE_SETTINGS = 6
     CAL_HELLO = 7
     CAL_ACK = 8
+    CAL_READ_MEASUREMENT_DELTA = 9
+    CAL_OVERRIDE_STAGE = 10
+    CAL_OVERRIDE_TRANSACTION = 11
+    CAL_READ_SETTINGS_CRC = 12
+
+    # Capability flags from the hello response
+    YACP_CAP_DELTA = 0x01
+    YACP_CAP_EXTENDED = 0x02
+    YACP_CAP_TRANSACTIONS = 0x04
+    YACP_CAP_SETTINGS_CRC = 0x08
+
+    YACP_TRANSACTION_BEGIN = 0
+    YACP_TRANSACTION_COMMIT = 1
+
+    # Extended addressing: [28:21] prefix, [20] direction, [19:16] message type, [15:0] device address
+    YACP_EXT_PREFIX = 0x0C
+    YACP_EXT_BASE_MASK = 0x1FE00000
+    YACP_EXT_RESPONSE = 0x00100000
+    YACP_EXT_BROADCAST = 0xFFFF
+    YACP_EXT_BASE_CAN_ID = YACP_EXT_PREFIX << 21
+
+    YACP_DELTA_FULL = 0x01
+    # While measurements are subscribed, one poll in this many reads an unsubscribed one
+    BACKGROUND_SWEEP_RATIO = 10
 
     DEVICE_STATE_DISCONNECTED = 0
     DEVICE_STATE_READING_SETTINGS = 1
     DEVICE_STATE_READING_OVERRIDES = 2
     DEVICE_STATE_READING_MEASUREMENTS = 3
     DEVICE_STATE_CONNECTED = 4
+    DEVICE_STATE_READING_SETTINGS_CRC = 5
+
+    # Ticks to wait for the settings CRC before reading the settings anyway
+    SETTINGS_CRC_TIMEOUT_TICKS = 10
+    # After a settings cache miss the settings of the sections not opened are read one
+    # every this many ticks while connected, so the new image can be cached
+    SETTINGS_BACKGROUND_TICKS = 5
 
-    set_setting_signal = pyqtSignal(int,int,int,int,int,int)
-    set_override_signal = pyqtSignal(int,int,int,int,int,int,int)
-    send_hello_signal = pyqtSignal()
-    save_settings_signal = pyqtSignal()
-    set_device_id_signal = pyqtSignal(int)
-    read_measurement_signal = pyqtSignal(int,int)
-    read_setting_signal = pyqtSignal(int,int)
-    read_override_signal = pyqtSignal(int,int)
+    # Time to collect hello responses after a scan has been sent
+    DISCOVERY_WINDOW_MS = 250
+
+    # Bus supervision: failing sends or receives mark the bus lost, it is then reopened
+    # with the delay doubling from MIN to MAX seconds until traffic is seen again.
+    # Polled devices that are silent for BUS_SILENCE_TIMEOUT are only reported
+    BUS_SILENCE_TIMEOUT = 3.0
+    BUS_SEND_ERROR_LIMIT = 10
+    BUS_RECONNECT_MIN = 0.5
+    BUS_RECONNECT_MAX = 10.0
 
     app_update_device_state_signal = pyqtSignal()
     app_update_measurement_signal = pyqtSignal(int,int)
@@ -257,84 +523,166 @@ class YACPProtocol(QObject):
     app_update_override_signal = pyqtSignal(int,int,int)
     app_update_devices_signal = pyqtSignal()
     app_update_can_status_signal = pyqtSignal()
+    app_bus_opened_signal = pyqtSignal(str)
+    app_scan_complete_signal = pyqtSignal()
+    app_command_failed_signal = pyqtSignal()
+    app_bus_lost_signal = pyqtSignal(str)
+    app_bus_restored_signal = pyqtSignal(str)
+    app_bus_silent_signal = pyqtSignal(str)
+    app_bus_answering_signal = pyqtSignal(str)
+    # The same updates for every connected session, not only the active one,
+    # with the session's device key (e.g. for YACPgateway.py)
+    session_update_measurement_signal = pyqtSignal(object,int)
+    session_update_setting_signal = pyqtSignal(object,int)
+    session_update_override_signal = pyqtSignal(object,int)
 
     def __init__(self):
         super().__init__()
         
-        self.measurements = {}
-        self.overrides = {}
-        self.settings = {}
         self.devices = {}
 
         self.num_measurements = 0
         self.num_settings = 0
         self.num_overrides = 0
 
-        self.device_state = YACPProtocol.DEVICE_STATE_DISCONNECTED
-        self.read_measurement_index = 0
-        self.read_setting_index = 0
-        self.read_override_index = 0
-        self.device_id = -1
-        self.can_state = 0
-
-        self.can_thread = CANThread()
-        
-        self.can_thread.update_measurement_signal.connect(self.updateMeasurement)
-        self.can_thread.update_setting_signal.connect(self.updateSetting)
-        self.can_thread.update_override_signal.connect(self.updateOverride)
-        self.can_thread.update_hello_signal.connect(self.updateDeviceList)
-        self.can_thread.send_status_signal.connect(self.handleCANStatus)
-        
-        self.set_setting_signal.connect(self.can_thread.setSetting)
-        self.set_override_signal.connect(self.can_thread.setOverride)
-        self.send_hello_signal.connect(self.can_thread.sendHello)
-        self.save_settings_signal.connect(self.can_thread.sendSaveSettings)
-        self.set_device_id_signal.connect(self.can_thread.setDeviceId)
-        self.read_measurement_signal.connect(self.can_thread.readMeasurement)
-        self.read_setting_signal.connect(self.can_thread.readSetting)
-        self.read_override_signal.connect(self.can_thread.readOverride)
+        # The offline session holds the def (and any cal loaded without a device).
+        # Each connected device gets its own session with a copy of it, the GUI
+        # shows whichever session is active.
+        self.offline_session = DeviceSession(self, None, None)
+        self.session = self.offline_session
+        self.sessions = {}
 
-        self.can_thread.start()
+        self.can_threads = {}
+        self.can_state = 0
+        # Run bus I/O, polling and decoding in a worker process (see yacp_worker.py)
+        self.out_of_process_io = False
+        # Let devices that support it report only the measurements that changed
+        self.delta_measurements = True
+        # Directory of the settings images last read from each device, None reads them every time
+        self.settings_cache = None
+        # Read the settings and overrides of a section only once it is opened (see loadSection)
+        self.lazy_sections = False
+        # Name prefix of the shared memory blocks the connected devices are published in
+        # for other processes (see yacp_shm.py), None does not publish them
+        self.shm_prefix = None
+
+        # Def sections in def order, None holds the entries without a section
+        self.sections = []
+        self.section_descriptions = {}
+        # Names, units, notes and enum labels of the def entries
+        self.search_index = SearchIndex()
+
+        self.scan_base_can_ids = [YACPProtocol.YACP_COMMAND_ID]
+        self.scanning = False
+        self.inventory_file = None
 
         self.timer = QTimer(self) 
         self.timer.timeout.connect(self.tick) 
         self.timer.start(20)
 
+    # The active session's state, kept as attributes of the protocol for the GUI
+    @property
+    def measurements(self):
+        return self.session.measurements
+
+    @property
+    def settings(self):
+        return self.session.settings
+
+    @property
+    def overrides(self):
+        return self.session.overrides
+
+    @property
+    def device_state(self):
+        return self.session.device_state
+
+    @property
+    def device_id(self):
+        return self.session.device_id
+
+    @property
+    def device_key(self):
+        return self.session.key
+
+    @property
+    def read_measurement_index(self):
+        return self.session.read_measurement_index
+
+    @property
+    def read_setting_index(self):
+        return self.session.read_setting_index
+
+    @property
+    def read_override_index(self):
+        return self.session.read_override_index
+
+    @property
+    def read_setting_count(self):
+        return len(self.session.read_setting_keys)
+
+    @property
+    def read_override_count(self):
+        return len(self.session.read_override_keys)
+
     def close(self):
         self.timer.stop()
-        self.can_thread.disconnect()
-        self.can_thread.stop = True
-        self.can_thread.wait()
+        self.closeSessions()
+        for name in [*self.can_threads]:
+            self.disconnectBus(name)
 
     def loadDefFile(self, fileName):
-        self.measurements = {}
-        self.settings = {}
-        self.overrides = {}
+        return self.installDef(self.readDefFile(fileName))
+
+    # Builds the offline session of a def without changing the protocol, so a def can
+    # be read in the background and installed once it is ready
+    def readDefFile(self, fileName):
+        definition = Definition()
+        session = DeviceSession(self, None, None)
+        definition.session = session
 
-        measurement_offset = 0
-        override_offset = 0
-        setting_offset = 0
         revision = -1
         
         with open(fileName, newline='\n') as def_file:
             defs = json.load(def_file)
 
+            layout = defs.get("layout", "packed")
+            if layout not in override_layouts:
+                print("Unknown layout "+str(layout)+" in "+fileName)
+                layout = "packed"
+            [override_size, override_value_offset] = override_layouts[layout]
+
+            for section in defs.get("sections", []):
+                definition.sections.append(section["name"])
+                definition.section_descriptions[section["name"]] = section.get("description", "")
+
+            # The images are sized like the device structs, including any padding at the end
+            [measurement_offsets, size] = struct_layout([lengths[m["type"]] for m in defs["measurements"]], layout)
+            session.measurement_image.extend(bytes(size))
+            [setting_offsets, size] = struct_layout([lengths[s["type"]] for s in defs["settings"]], layout)
+            session.setting_image.extend(bytes(size))
+            [override_offsets, size] = struct_layout([override_size for o in defs["overrides"]], layout)
+            session.override_image.extend(bytes(size))
+
             for m in defs["measurements"]:
                 if "unit" not in m.keys():
                     unit = ""
                 else:
                     unit = m["unit"]
                 
-                measurement = Measurement(m["name"], m["type"], unit, measurement_offset, self.num_measurements)
+                measurement_offset = measurement_offsets[definition.num_measurements]
+                measurement = Measurement(m["name"], m["type"], unit, measurement_offset, definition.num_measurements, session.measurement_image)
                 #print(m["name"]+" "+str(measurement_offset)+" ")
 
                 if "values" in m.keys():
                     for value in m["values"]:
                         measurement.values[value["value"]] = value["name"]
+
+                measurement.formatter = Formatter(m["type"], m.get("display", "decimal"), measurement.values, m.get("precision"), unit)
+                measurement.notes = m.get("notes", "")
                 
-                self.measurements[measurement_offset] = measurement
-                measurement_offset += lengths[m["type"]]
-                self.num_measurements += 1
+                session.measurements[measurement_offset] = measurement
+                definition.num_measurements += 1
                 
             for s in defs["settings"]:
                 if "unit" not in s.keys():
@@ -342,15 +690,19 @@ class YACPProtocol(QObject):
                 else:
                     unit = s["unit"]
                     
-                setting = Setting(s["name"], None, s["type"], unit, s["default"], setting_offset, self.num_settings)
+                setting_offset = setting_offsets[definition.num_settings]
+                setting = Setting(s["name"], None, s["type"], unit, s.get("default"), setting_offset, definition.num_settings, session.setting_image)
+                # Settings and overrides are edited as text, so only lossless display formats apply
+                setting.formatter = Formatter(s["type"], s.get("display", "decimal"), unit=unit)
+                setting.section = s.get("section")
+                setting.notes = s.get("notes", "")
 
                 if "choices" in s.keys():
                     for choice in s["choices"]:
                         setting.choices[choice["value"]] = choice["name"]
                 
-                self.settings[setting_offset] = setting
-                setting_offset += lengths[s["type"]]
-                self.num_settings += 1
+                session.settings[setting_offset] = setting
+                definition.num_settings += 1
 
                 if s["name"] == 'revision':
                     revision = s["default"]
@@ -361,12 +713,48 @@ class YACPProtocol(QObject):
                 else:
                     unit = o["unit"]
                     
-                override = Override(o["name"], o["type"], unit, override_offset, self.num_overrides)
-                self.overrides[override_offset] = override
-                override_offset += 5
-                self.num_overrides += 1
-                
-        return revision
+                override_offset = override_offsets[definition.num_overrides]
+                override = Override(o["name"], o["type"], unit, override_offset, definition.num_overrides, session.override_image, override_value_offset)
+                override.formatter = Formatter(o["type"], o.get("display", "decimal"), unit=unit)
+                override.section = o.get("section")
+                override.notes = o.get("notes", "")
+
+                # Only used to find the override, its value is edited as a number
+                if "choices" in o.keys():
+                    for choice in o["choices"]:
+                        override.choices[choice["value"]] = choice["name"]
+                session.overrides[override_offset] = override
+                definition.num_overrides += 1
+
+        # Sections only named by the entries follow the listed ones, the entries
+        # without a section come first
+        for entry in [*session.settings.values(), *session.overrides.values()]:
+            if entry.section not in definition.sections:
+                if entry.section == None:
+                    definition.sections.insert(0, None)
+                else:
+                    definition.sections.append(entry.section)
+                definition.section_descriptions[entry.section] = ""
+
+        definition.search_index = SearchIndex(session)
+        definition.revision = revision
+
+        return definition
+
+    def installDef(self, definition):
+        self.closeSessions()
+
+        self.offline_session = definition.session
+        self.session = definition.session
+
+        self.num_measurements = definition.num_measurements
+        self.num_settings = definition.num_settings
+        self.num_overrides = definition.num_overrides
+        self.sections = definition.sections
+        self.section_descriptions = definition.section_descriptions
+        self.search_index = definition.search_index
+
+        return definition.revision
 
     def loadCalFile(self, fileName):
         with open(fileName, newline='\n') as csvfile:
@@ -385,10 +773,7 @@ class YACPProtocol(QObject):
                     if self.settings[offset].name != name:
                         continue
 
-                    if self.settings[offset].cal_type == "float":
-                        self.settings[offset].value = float(str_val)
-                    else:
-                        self.settings[offset].value = int(str_val)
+                    self.settings[offset].value = parse_value(self.settings[offset].cal_type, str_val)
 
     def exportSettingsCSV(self, fileName):
         with open(fileName, 'w', newline='') as csvfile:
@@ -408,107 +793,678 @@ class YACPProtocol(QObject):
                     
                 writer.writerow([setting.name,setting.value,setting.cal_type,setting.unit,label])
 
-                        
-    def getValueFromBytes(self,cal_type,b0,b1,b2,b3):
-        if cal_type == "uint8":
-            [typed_value] = struct.unpack('>B',bytes([b0]))
-        elif cal_type == "int8":
-            [typed_value] = struct.unpack('>b',bytes([b0]))
-        elif cal_type == "uint16":
-            [typed_value] = struct.unpack('>H',bytes([b1,b0]))
-        elif cal_type == "int16":
-            [typed_value] = struct.unpack('>h',bytes([b1,b0]))
-        elif cal_type == "uint32":
-            [typed_value] = struct.unpack('>I',bytes([b3,b2,b1,b0]))
-        elif cal_type == "int32":
-            [typed_value] = struct.unpack('>i',bytes([b3,b2,b1,b0]))
-        elif cal_type == "float":
-            [typed_value] = struct.unpack('>f',bytes([b3,b2,b1,b0]))
-
-        #print(str(b3)+" "+str(b2)+" "+str(b1)+" "+str(b0)+" = "+str(typed_value))
-            
-        return typed_value
-
-    def getBytesFromValue(self,cal_type,val):
-        if cal_type == "uint8":
-            bs = struct.pack('>B',val)
-        elif cal_type == "int8":
-            bs = struct.pack('>b',val)
-        elif cal_type == "uint16":
-            bs = struct.pack('>H',val)
-        elif cal_type == "int16":
-            bs = struct.pack('>h',val)
-        elif cal_type == "uint32":
-            bs = struct.pack('>I',val)
-        elif cal_type == "int32":
-            bs = struct.pack('>i',val)
-        elif cal_type == "float":
-            bs = struct.pack('>f',val)
-
-        ints = list(bs)
-        ints += [0] * (4 - len(ints))
-
-        #print(cal_type+" "+str(val)+" = "+str(ints[3])+" "+str(ints[2])+" "+str(ints[1])+" "+str(ints[0]))
-
-        return ints
+    def exportSettingsBinary(self, fileName):
+        image = bytes(self.session.setting_image)
+
+        with open(fileName, 'wb') as binfile:
+            binfile.write(struct.pack('<I', yacp_crc(image)))
+            binfile.write(image)
+
+    def loadSettingsBinary(self, fileName):
+        with open(fileName, 'rb') as binfile:
+            data = binfile.read()
 
+        image = data[EEPROM_SETTINGS_OFFSET:]
+        if len(image) != len(self.session.setting_image):
+            print("Cal file "+fileName+" does not match the def settings size")
+            return False
+
+        [crc] = struct.unpack_from('<I', data, EEPROM_CRC_OFFSET)
+        if crc != yacp_crc(image):
+            print("Cal file "+fileName+" failed the CRC check")
+            return False
+
+        self.session.setting_image[:] = image
+
+        return True
+                        
     def saveSettings(self):
-        self.save_settings_signal.emit()
+        self.session.saveSettings()
+
+    # Reads the settings and overrides of the active session's section if they were not yet
+    def loadSection(self, section):
+        self.session.loadSection(section)
 
-    #@pyqtSlot(int,int,int,int,int,int)
-    def updateMeasurement(self, var_start, var_len, b0,b1,b2,b3):
-        table_index = self.measurements[var_start].index
-        cal_type = self.measurements[var_start].cal_type
-        value = self.getValueFromBytes(cal_type,b0,b1,b2,b3)
+    def loadAllSections(self):
+        for section in self.sections:
+            self.session.loadSection(section)
 
-        self.measurements[var_start].value = value
+    # True once every setting of the active session is known, e.g. before saving a cal
+    def settingsLoaded(self):
+        return self.session.settingsLoaded()
 
-        self.app_update_measurement_signal.emit(table_index, var_start)
+    #@pyqtSlot(str,int,int,int,int,bytes,float,float)
+    def updateMeasurement(self, bus, base_can_id, device_id, var_start, var_len, data, timestamp, round_trip):
+        session = self.sessions.get((bus, base_can_id, device_id))
+        if session == None or var_start not in session.measurements:
+            return
 
-    #@pyqtSlot(int,int,int,int,int,int)
-    def updateSetting(self, var_start, var_len, b0,b1,b2,b3):
-        table_index = self.settings[var_start].index
-        cal_type = self.settings[var_start].cal_type
-        value = self.getValueFromBytes(cal_type,b0,b1,b2,b3)
+        table_index = session.updateMeasurement(var_start, data, timestamp, round_trip)
+        if table_index == -1:
+            return
 
-        self.settings[var_start].value = value
+        self.session_update_measurement_signal.emit(session.key, var_start)
+        if session is self.session:
+            self.app_update_measurement_signal.emit(table_index, var_start)
 
-        self.app_update_setting_signal.emit(table_index, var_start)
+    #@pyqtSlot(str,int,int,int,int,bytes,float,float)
+    def updateSetting(self, bus, base_can_id, device_id, var_start, var_len, data, timestamp, round_trip):
+        session = self.sessions.get((bus, base_can_id, device_id))
+        if session == None or var_start not in session.settings:
+            return
 
-    #@pyqtSlot(bool,int,int,int,int,int,int)
-    def updateOverride(self, overridden, var_start, var_len, b0,b1,b2,b3):
-        table_index = self.overrides[var_start].index
-        cal_type = self.overrides[var_start].cal_type
-        value = self.getValueFromBytes(cal_type,b0,b1,b2,b3)
+        table_index = session.updateSetting(var_start, data, timestamp)
 
-        self.overrides[var_start].value = value
+        self.session_update_setting_signal.emit(session.key, var_start)
+        if session is self.session:
+            self.app_update_setting_signal.emit(table_index, var_start)
 
-        if overridden:
-            self.overrides[var_start].status = "Overridden"
-        else:
-            self.overrides[var_start].status = "Passthrough"
-        
-        self.app_update_override_signal.emit(table_index, var_start, overridden)
+    #@pyqtSlot(str,int,int,bool,int,int,bytes,float,float)
+    def updateOverride(self, bus, base_can_id, device_id, overridden, var_start, var_len, data, timestamp, round_trip):
+        session = self.sessions.get((bus, base_can_id, device_id))
+        if session == None or var_start not in session.overrides:
+            return
+
+        table_index = session.updateOverride(overridden, var_start, data, timestamp)
+
+        self.session_update_override_signal.emit(session.key, var_start)
+        if session is self.session:
+            self.app_update_override_signal.emit(table_index, var_start, overridden)
         
-    #@pyqtSlot(int,int,int,int,int)
-    def updateDeviceList(self, device_id, firmware_version, product_id, cal_revision, cal_protocol):
-        self.devices[device_id] = Device(device_id, firmware_version, product_id, cal_revision, cal_protocol)
+    #@pyqtSlot(str,int,int,int)
+    def updateAck(self, bus, base_can_id, device_id, success):
+        session = self.sessions.get((bus, base_can_id, device_id))
+        if session == None:
+            return
+
+        session.updateAck(success)
+
+        if not success and session is self.session:
+            self.app_command_failed_signal.emit()
+
+    def updateSettingsCRC(self, bus, base_can_id, device_id, data):
+        session = self.sessions.get((bus, base_can_id, device_id))
+        if session == None:
+            return
+
+        [crc] = struct.unpack('<I', data)
+        if session.updateSettingsCRC(crc):
+            # The settings came from the cache, nothing else will refresh them
+            for offset, setting in session.settings.items():
+                self.session_update_setting_signal.emit(session.key, offset)
+                if session is self.session:
+                    self.app_update_setting_signal.emit(setting.index, offset)
+
+    # var_len of a hello is the most measurements the device sends per delta request
+    #@pyqtSlot(str,int,int,int,int,int,int,int,int)
+    def updateDeviceList(self, bus, base_can_id, device_id, firmware_version, product_id, cal_revision, cal_protocol, capabilities, delta_burst):
+        device = Device(device_id, firmware_version, product_id, cal_revision, cal_protocol, base_can_id, bus)
+        device.capabilities = capabilities
+        device.delta_burst = delta_burst
+        device.confirmed = True
+        device.last_seen = time.time()
+        self.devices[device.key()] = device
         
         self.app_update_devices_signal.emit()
 
-    def sendHello(self):
-        self.devices.clear()
-        
-        self.send_hello_signal.emit()
+    # Frames decoded by a worker process (yacp_worker.RING_RECORD), a batch per read of its ring
+    #@pyqtSlot(str,object)
+    def updateFrames(self, bus, frames):
+        for [timestamp, round_trip, base_can_id, var_start, device_id, message_type, var_len, data] in frames:
+            if message_type == YACPProtocol.CAL_HELLO:
+                self.updateDeviceList(bus, base_can_id, device_id, data[0], data[1], data[2], data[3], var_start & 0xFF, var_len)
+            elif message_type == YACPProtocol.CAL_READ_MEASUREMENT:
+                self.updateMeasurement(bus, base_can_id, device_id, var_start, var_len, data, timestamp, round_trip)
+            elif message_type == YACPProtocol.CAL_READ_SETTING:
+                self.updateSetting(bus, base_can_id, device_id, var_start, var_len, data, timestamp, round_trip)
+            elif message_type == YACPProtocol.CAL_OVERRIDE_ON:
+                self.updateOverride(bus, base_can_id, device_id, True, var_start, var_len, data, timestamp, round_trip)
+            elif message_type == YACPProtocol.CAL_OVERRIDE_OFF:
+                self.updateOverride(bus, base_can_id, device_id, False, var_start, var_len, data, timestamp, round_trip)
+            elif message_type == YACPProtocol.CAL_ACK:
+                self.updateAck(bus, base_can_id, device_id, data[0])
+            elif message_type == YACPProtocol.CAL_READ_SETTINGS_CRC:
+                self.updateSettingsCRC(bus, base_can_id, device_id, data)
+
+    # Scans every open bus, or only the named one (e.g. one that was just opened)
+    def scanDevices(self, base_can_ids=None, bus=None):
+        if base_can_ids != None:
+            self.scan_base_can_ids = list(base_can_ids)
+
+        can_threads = [self.can_threads[bus]] if bus != None else [*self.can_threads.values()]
+
+        # Previously known devices stay listed (and connectable) until the scan
+        # window closes without them answering. A scan requested while one is
+        # already running just joins its window.
+        if not self.scanning:
+            for device in self.devices.values():
+                if device.bus in [x.name for x in can_threads] and device.base_can_id in self.scan_base_can_ids:
+                    device.confirmed = False
+
+            self.scanning = True
+            QTimer.singleShot(YACPProtocol.DISCOVERY_WINDOW_MS, self.finishScan)
+
+        # Every base ID on every scanned bus is probed at once
+        for can_thread in can_threads:
+            can_thread.set_scan_base_can_ids(self.scan_base_can_ids)
+            for base_can_id in self.scan_base_can_ids:
+                can_thread.sendHello(base_can_id)
+
+    def finishScan(self):
+        if not self.scanning:
+            return
+        self.scanning = False
 
-    def deviceConnect(self, device_id):
-        self.device_id = device_id
-        self.set_device_id_signal.emit(device_id)
+        for key in [*self.devices]:
+            device = self.devices[key]
+            if device.confirmed or key in self.sessions:
+                continue
+            if device.bus in self.can_threads and device.base_can_id in self.scan_base_can_ids:
+                del self.devices[key]
+
+        if self.inventory_file != None:
+            self.saveInventory(self.inventory_file)
+
+        self.app_update_devices_signal.emit()
+        self.app_scan_complete_signal.emit()
+
+    def loadInventory(self, fileName):
+        self.inventory_file = fileName
+
+        try:
+            with open(fileName) as inventory_file:
+                inventory = json.load(inventory_file)
+        except FileNotFoundError:
+            return
+        except:
+            print("Failed to load device inventory "+fileName)
+            return
 
+        for d in inventory:
+            device = Device(d["device_id"], d["firmware_version"], d["product_id"], d["cal_revision"], d["cal_protocol"], d["base_can_id"], d["bus"])
+            device.last_seen = d["last_seen"]
+            device.capabilities = d.get("capabilities", 0)
+            device.delta_burst = d.get("delta_burst", 0)
+            self.devices[device.key()] = device
+
+        self.app_update_devices_signal.emit()
+
+    def saveInventory(self, fileName):
+        inventory = []
+        for device in self.devices.values():
+            inventory.append({
+                "bus": device.bus,
+                "base_can_id": device.base_can_id,
+                "device_id": device.device_id,
+                "product_id": device.product_id,
+                "firmware_version": device.firmware_version,
+                "cal_revision": device.cal_revision,
+                "cal_protocol": device.cal_protocol,
+                "capabilities": device.capabilities,
+                "delta_burst": device.delta_burst,
+                "last_seen": device.last_seen
+            })
+
+        try:
+            with open(fileName, 'w') as inventory_file:
+                json.dump(inventory, inventory_file, indent=1)
+        except:
+            traceback.print_exc()
+
+    def getBusDevices(self):
+        return [key for key in self.devices if self.devices[key].bus in self.can_threads]
+
+    # Sessions opened with start=False are not read or polled, the caller drives them
+    def deviceConnect(self, device_key, activate=True, start=True):
+        session = self.sessions.get(device_key)
+
+        if session == None:
+            device = self.devices[device_key]
+            can_thread = self.can_threads[device.bus]
+
+            session = self.offline_session.copy(device, can_thread)
+            can_thread.addDevice(device.base_can_id, device.device_id)
+            self.sessions[device_key] = session
+
+            if self.shm_prefix != None:
+                from yacp_shm import ShmPublisher, block_name
+                try:
+                    session.publisher = ShmPublisher(session, block_name(self.shm_prefix, device.bus, device.base_can_id, device.device_id))
+                except OSError:
+                    traceback.print_exc()
+
+            if start:
+                session.start()
+
+        if activate:
+            # Whatever is being watched follows the active session
+            if session is not self.session:
+                session.setSubscriptions(self.session.subscriptions)
+                self.session.setSubscriptions({})
+
+            self.session = session
+            self.app_update_device_state_signal.emit()
+
+        return session
+
+    def deviceDisconnect(self, device_key):
+        session = self.sessions.pop(device_key, None)
+        if session == None:
+            return
+
+        session.can_thread.removeDevice(session.base_can_id, session.device_id)
+        session.device_state = YACPProtocol.DEVICE_STATE_DISCONNECTED
+
+        if session.publisher != None:
+            session.publisher.close()
+            session.publisher = None
+
+        if session is self.session:
+            self.offline_session.setSubscriptions(session.subscriptions)
+            self.session = self.offline_session
+            self.app_update_device_state_signal.emit()
+
+    def closeSessions(self):
+        for device_key in [*self.sessions]:
+            self.deviceDisconnect(device_key)
+
+    # Measurements of the active session that owner (e.g. the visible rows or the graph)
+    # wants kept up to date. Subscribed measurements are polled first.
+    def subscribe(self, owner, measurement_keys):
+        self.session.subscribe(owner, measurement_keys)
+
+    def unsubscribe(self, owner):
+        self.session.subscribe(owner, [])
+
+    def sendSettingChange(self, setting_key, str_val):
+        self.session.sendSettingChange(setting_key, str_val)
+
+    def sendSetting(self, setting_key):
+        self.session.sendSetting(setting_key)
+
+    def sendOverrideChange(self, override_key, str_val, override_status):
+        self.session.sendOverrideChange(override_key, str_val, override_status)
+
+    def stageOverrideChange(self, override_key, str_val, override_status):
+        self.session.stageOverrideChange(override_key, str_val, override_status)
+
+    def commitOverrides(self):
+        return self.session.commitOverrides()
+
+    def abortOverrides(self):
+        self.session.abortOverrides()
+
+    def tick(self):
+        # Each bus schedules the requests of the sessions on it independently,
+        # so a rig spread over several channels is polled in parallel
+        for can_thread in self.can_threads.values():
+            self.tickBus(can_thread)
+
+    def tickBus(self, can_thread):
+        for session in [*self.sessions.values()]:
+            if session.can_thread is not can_thread:
+                continue
+
+            device_state = session.device_state
+            session.tick()
+            session.publish()
+
+            if session is self.session and device_state != YACPProtocol.DEVICE_STATE_CONNECTED:
+                self.app_update_device_state_signal.emit()
+
+    def connect(self, bustype, interface, bitrate, connect):
+        if connect == True:
+            # Several channels of the same adaptor type can be opened at once
+            for channel in str(interface).split(','):
+                if channel.strip() != "":
+                    self.connectBus(bustype, channel.strip(), bitrate)
+        else:
+            for name in [*self.can_threads]:
+                self.disconnectBus(name)
+
+    def connectBus(self, bustype, channel, bitrate):
+        if self.out_of_process_io:
+            from yacp_worker import CANProcess
+            can_thread = CANProcess()
+            can_thread.update_frames_signal.connect(self.updateFrames)
+        else:
+            can_thread = CANThread()
+            can_thread.update_measurement_signal.connect(self.updateMeasurement)
+            can_thread.update_setting_signal.connect(self.updateSetting)
+            can_thread.update_override_signal.connect(self.updateOverride)
+            can_thread.update_hello_signal.connect(self.updateDeviceList)
+            can_thread.update_ack_signal.connect(self.updateAck)
+            can_thread.update_settings_crc_signal.connect(self.updateSettingsCRC)
+
+        can_thread.connect(bustype, channel, bitrate)
+        if can_thread.bus == None:
+            self.handleCANStatus(can_thread.name, 1)
+            return None
+
+        self.can_threads[can_thread.name] = can_thread
+        can_thread.send_status_signal.connect(self.handleCANStatus)
+        can_thread.start()
+
+        self.handleCANStatus(can_thread.name, 0)
+        self.app_bus_opened_signal.emit(can_thread.name)
+
+        return can_thread
+
+    def disconnectBus(self, name):
+        can_thread = self.can_threads.pop(name, None)
+        if can_thread == None:
+            return
+
+        for device_key in [*self.sessions]:
+            if self.sessions[device_key].can_thread is can_thread:
+                self.deviceDisconnect(device_key)
+
+        can_thread.stop = True
+        can_thread.disconnect()
+        can_thread.wait()
+
+    # time.time() of the last frame received on a bus, 0 when not known
+    def lastReceiveTime(self, name):
+        can_thread = self.can_threads.get(name)
+        if can_thread == None:
+            return 0
+        return can_thread.last_receive_time
+
+    @pyqtSlot(str,int)
+    def handleCANStatus(self, name, status):
+        if status == 3:
+            self.app_bus_lost_signal.emit(name)
+            return
+        if status == 5:
+            self.app_bus_silent_signal.emit(name)
+            return
+        if status == 4 or status == 6:
+            # The sessions carry on from what they already hold, a device that went
+            # silent may have restarted
+            for session in self.sessions.values():
+                if session.can_thread != None and session.can_thread.name == name:
+                    session.resume()
+            if status == 4:
+                self.app_bus_restored_signal.emit(name)
+            else:
+                self.app_bus_answering_signal.emit(name)
+            return
+
+        if len(self.can_threads) > 0:
+            self.can_state = 1
+        else:
+            self.can_state = 0
+            
+        self.app_update_can_status_signal.emit()
+
+class DeviceSession:
+    def __init__(self, protocol, device, can_thread):
+        self.protocol = protocol
+        self.device = device
+        self.can_thread = can_thread
+
+        if device != None:
+            self.key = device.key()
+            self.base_can_id = device.base_can_id
+            self.device_id = device.device_id
+        else:
+            self.key = None
+            self.base_can_id = YACPProtocol.YACP_COMMAND_ID
+            self.device_id = -1
+
+        self.measurements = {}
+        self.overrides = {}
+        self.settings = {}
+
+        # Byte images of the device's cal structs, the entries decode their values from these
+        self.measurement_image = bytearray()
+        self.setting_image = bytearray()
+        self.override_image = bytearray()
+
+        self.device_state = YACPProtocol.DEVICE_STATE_DISCONNECTED
         self.read_measurement_index = 0
         self.read_setting_index = 0
         self.read_override_index = 0
+        self.poll_list_sent = False
+        self.delta_synced = False
+
+        # Owner -> subscribed measurement keys, split into the poll schedule
+        self.subscriptions = {}
+        self.subscribed = []
+        self.background = []
+        self.read_subscribed_index = 0
+        self.read_background_index = 0
+        self.poll_count = 0
+
+        # Acknowledged commands and settings read back, for callers waiting on the device
+        self.acks = 0
+        self.nacks = 0
+        self.settings_received = set()
+
+        # Override key -> (value, status) changes waiting for commitOverrides. Only ever
+        # cleared in place, the GUI shows it
+        self.staged_overrides = {}
+
+        # CRC the device reported for its settings and the settings still to be read
+        # before the image can be cached under it
+        self.settings_crc = None
+        self.settings_uncached = set()
+        self.read_settings_crc_ticks = 0
+        # Settings of the sections not opened, read in the background after a cache miss
+        self.background_setting_keys = []
+        self.background_ticks = 0
+
+        # Measurements to report on their next response even if they did not change
+        self.measurements_stale = set()
+
+        # Sections whose settings and overrides are read, the keys the reading states go
+        # through and the reads of sections opened after connecting, as (type, key)
+        self.loaded_sections = set()
+        self.read_setting_keys = []
+        self.read_override_keys = []
+        self.read_queue = []
+        self.settings_cached = False
+
+        # Latest request to response time in seconds, None until one is known
+        self.round_trip = None
+
+        # Shared memory the images are published in and whether they changed since
+        self.publisher = None
+        self.images_changed = False
+
+    def copy(self, device, can_thread):
+        session = DeviceSession(self.protocol, device, can_thread)
+
+        # One deepcopy so the copied entries share the copied images
+        state = (self.measurement_image, self.setting_image, self.override_image, self.measurements, self.settings, self.overrides)
+        (session.measurement_image, session.setting_image, session.override_image, session.measurements, session.settings, session.overrides) = copy.deepcopy(state)
+
+        return session
+
+    def start(self):
+        self.read_measurement_index = 0
+        self.read_setting_index = 0
+        self.read_override_index = 0
+        self.poll_list_sent = False
+        self.delta_synced = False
+        self.setSubscriptions(self.subscriptions)
+
+        self.settings_crc = None
+        self.settings_uncached = set()
+        self.read_settings_crc_ticks = 0
+        self.settings_cached = False
+        self.background_setting_keys = []
+
+        if not self.protocol.lazy_sections:
+            self.loaded_sections = set(self.protocol.sections)
+        self.read_setting_keys = self.sectionKeys(self.settings, self.loaded_sections)
+        self.read_override_keys = self.sectionKeys(self.overrides, self.loaded_sections)
+        self.read_queue = []
+
+        if self.usesSettingsCache():
+            self.device_state = YACPProtocol.DEVICE_STATE_READING_SETTINGS_CRC
+        else:
+            self.device_state = YACPProtocol.DEVICE_STATE_READING_SETTINGS
+
+    # The bus was reopened after being lost. Measurements resync on the next poll and
+    # the overrides are read again in case the device restarted, the settings are kept.
+    def resume(self):
+        self.poll_list_sent = False
+        self.delta_synced = False
+        self.measurements_stale = set(self.measurements)
+
+        if self.device_state == YACPProtocol.DEVICE_STATE_CONNECTED:
+            for override_key in self.sectionKeys(self.overrides, self.loaded_sections):
+                self.readOverrideKey(override_key)
+
+            # Settings of a section that was still being read
+            if not self.settings_cached:
+                self.read_queue = [(YACPProtocol.CAL_READ_SETTING, key) for key in self.sectionKeys(self.settings, self.loaded_sections) if key not in self.settings_received]
+        elif self.device_state != YACPProtocol.DEVICE_STATE_DISCONNECTED:
+            # Responses to a read in progress were lost
+            self.start()
+
+    # At most once a tick, when something changed
+    def publish(self):
+        if self.publisher == None:
+            return
+
+        if self.images_changed or self.device_state != self.publisher.device_state:
+            self.publisher.publish(self)
+            self.images_changed = False
+
+    def sendCommand(self, message_type, var_start=0, var_len=0, b0=0,b1=0,b2=0,b3=0):
+        if self.can_thread == None:
+            return
+
+        self.can_thread.sendCommand(self.base_can_id, self.device_id, message_type, var_start, var_len, b0,b1,b2,b3)
+
+    def saveSettings(self):
+        self.sendCommand(YACPProtocol.CAL_SAVE_SETTINGS)
+
+    # Responses are written straight into the images, values are decoded when read.
+    # Measurements that did not change return -1 so nothing downstream is redone.
+    def updateMeasurement(self, var_start, data, timestamp=0, round_trip=-1):
+        measurement = self.measurements[var_start]
+        var_len = lengths[measurement.cal_type]
+
+        # Every response is timestamped, even when the value did not change
+        measurement.timestamp = timestamp
+        if round_trip >= 0:
+            measurement.round_trip = round_trip
+            self.round_trip = round_trip
+
+        if self.measurement_image[var_start:var_start+var_len] == data[:var_len] and var_start not in self.measurements_stale:
+            return -1
+        self.measurements_stale.discard(var_start)
+        self.measurement_image[var_start:var_start+var_len] = data[:var_len]
+        self.images_changed = True
+
+        return measurement.index
+
+    def updateSetting(self, var_start, data, timestamp=0):
+        setting = self.settings[var_start]
+        var_len = lengths[setting.cal_type]
+        self.setting_image[var_start:var_start+var_len] = data[:var_len]
+        setting.timestamp = timestamp
+        self.images_changed = True
+        self.settings_received.add(var_start)
+
+        if len(self.settings_uncached) > 0:
+            self.settings_uncached.discard(var_start)
+            if len(self.settings_uncached) == 0:
+                self.saveCachedSettings()
+
+        return setting.index
+
+    def usesSettingsCache(self):
+        return self.protocol.settings_cache != None and self.device != None and self.device.capabilities & YACPProtocol.YACP_CAP_SETTINGS_CRC
+
+    # Settings images are cached per bus, base CAN ID, product, device ID and cal
+    # revision, the file holds the image the way it is stored in EEPROM
+    def cacheFileName(self, crc):
+        device = self.device
+        bus = re.sub('[^0-9A-Za-z]+', '_', device.bus)
+        return os.path.join(self.protocol.settings_cache, "%s-%x-%d-%d-%d-%08x.bin" % (bus, device.base_can_id, device.product_id, device.device_id, device.cal_revision, crc))
+
+    def loadCachedSettings(self, crc):
+        try:
+            with open(self.cacheFileName(crc), 'rb') as binfile:
+                data = binfile.read()
+        except OSError:
+            return False
+
+        image = data[EEPROM_SETTINGS_OFFSET:]
+        if len(image) != len(self.setting_image) or yacp_crc(image) != crc:
+            return False
+
+        self.setting_image[:] = image
+        self.images_changed = True
+        return True
+
+    def saveCachedSettings(self):
+        image = bytes(self.setting_image)
+
+        # A setting changed while they were being read, the image matches neither CRC
+        if yacp_crc(image) != self.settings_crc:
+            return
+
+        fileName = self.cacheFileName(self.settings_crc)
+        prefix = os.path.basename(fileName)[:-len("00000000.bin")]
+        try:
+            os.makedirs(self.protocol.settings_cache, exist_ok=True)
+
+            # Only the latest image of each device is kept
+            for old in os.listdir(self.protocol.settings_cache):
+                if old.startswith(prefix) and old.endswith(".bin"):
+                    os.remove(os.path.join(self.protocol.settings_cache, old))
+
+            with open(fileName, 'wb') as binfile:
+                binfile.write(struct.pack('<I', self.settings_crc))
+                binfile.write(image)
+        except OSError:
+            traceback.print_exc()
+
+    # Returns True when the settings were loaded from the cache
+    def updateSettingsCRC(self, crc):
+        if self.device_state != YACPProtocol.DEVICE_STATE_READING_SETTINGS_CRC:
+            return False
+
+        self.settings_crc = crc
+
+        # The overrides are not part of the CRC and are always read
+        if self.loadCachedSettings(crc):
+            self.settings_cached = True
+            self.device_state = YACPProtocol.DEVICE_STATE_READING_OVERRIDES
+            return True
+
+        # The image is only cached once it is complete, the sections that are not
+        # opened are read in the background once connected
+        self.settings_uncached = set(self.settings)
+        self.background_setting_keys = [key for key in self.settings if self.settings[key].section not in self.loaded_sections]
         self.device_state = YACPProtocol.DEVICE_STATE_READING_SETTINGS
+        return False
+
+    def updateAck(self, success):
+        if success:
+            self.acks += 1
+        else:
+            self.nacks += 1
+
+            # Only a failed override commit is nacked, the device kept its overrides
+            for override_key in self.sectionKeys(self.overrides, self.loaded_sections):
+                self.readOverrideKey(override_key)
+
+    def updateOverride(self, overridden, var_start, data, timestamp=0):
+        override = self.overrides[var_start]
+        var_len = lengths[override.cal_type]
+        override.timestamp = timestamp
+        self.override_image[var_start] = 1 if overridden else 0
+        value_start = var_start + override.value_offset
+        self.override_image[value_start:value_start+var_len] = data[:var_len]
+        self.images_changed = True
+
+        return override.index
 
     def readMeasurement(self):
         measurement_key = [*self.measurements][self.read_measurement_index]
@@ -517,160 +1473,494 @@ class YACPProtocol(QObject):
         var_start = measurement.offset
         var_len = lengths[measurement.cal_type]
         
-        self.read_measurement_signal.emit(var_start, var_len)
+        self.sendCommand(YACPProtocol.CAL_READ_MEASUREMENT, var_start, var_len)
+
+    def subscribe(self, owner, measurement_keys):
+        subscriptions = dict(self.subscriptions)
+        if len(measurement_keys) == 0:
+            subscriptions.pop(owner, None)
+        else:
+            subscriptions[owner] = set(measurement_keys)
+
+        self.setSubscriptions(subscriptions)
+
+    def setSubscriptions(self, subscriptions):
+        self.subscriptions = subscriptions
+
+        subscribed = set()
+        for measurement_keys in subscriptions.values():
+            subscribed |= measurement_keys
+
+        self.subscribed = [key for key in self.measurements if key in subscribed]
+        self.background = [key for key in self.measurements if key not in subscribed]
+        self.read_subscribed_index = 0
+        self.read_background_index = 0
+        self.poll_list_sent = False
+
+    def readMeasurementKey(self, measurement_key):
+        measurement = self.measurements[measurement_key]
+        self.sendCommand(YACPProtocol.CAL_READ_MEASUREMENT, measurement.offset, lengths[measurement.cal_type])
+
+    def readSubscribed(self):
+        self.read_subscribed_index %= len(self.subscribed)
+        self.readMeasurementKey(self.subscribed[self.read_subscribed_index])
+        self.read_subscribed_index += 1
+
+    def readBackground(self):
+        self.read_background_index %= len(self.background)
+        self.readMeasurementKey(self.background[self.read_background_index])
+        self.read_background_index += 1
+
+    # Subscribed measurements get most of the polls, the rest are swept slowly
+    def pollMeasurement(self):
+        self.poll_count += 1
+
+        if len(self.subscribed) == 0:
+            self.readBackground()
+        elif len(self.background) == 0 or self.poll_count % YACPProtocol.BACKGROUND_SWEEP_RATIO != 0:
+            self.readSubscribed()
+        else:
+            self.readBackground()
 
     def readSetting(self):
-        setting_key = [*self.settings][self.read_setting_index]
+        self.readSettingKey(self.read_setting_keys[self.read_setting_index])
+
+    def readSettingKey(self, setting_key):
         setting = self.settings[setting_key]
-        
-        var_start = setting.offset
-        var_len = lengths[setting.cal_type]
-        
-        self.read_setting_signal.emit(var_start, var_len)
+        self.sendCommand(YACPProtocol.CAL_READ_SETTING, setting.offset, lengths[setting.cal_type])
+
+    def usesDeltaMeasurements(self):
+        return self.protocol.delta_measurements and self.device.capabilities & YACPProtocol.YACP_CAP_DELTA
+
+    # The device sends at most the burst it reports per request, whatever is asked for
+    def deltaBudget(self):
+        return max(1, self.device.delta_burst)
+
+    def readMeasurementDelta(self, flags=0):
+        self.sendCommand(YACPProtocol.CAL_READ_MEASUREMENT_DELTA, 0, self.deltaBudget(), flags)
 
     def readOverride(self):
-        override_key = [*self.overrides][self.read_override_index]
+        self.readOverrideKey(self.read_override_keys[self.read_override_index])
+
+    def readOverrideKey(self, override_key):
         override = self.overrides[override_key]
-        
-        var_start = override.offset
-        var_len = lengths[override.cal_type]
-        
-        self.read_override_signal.emit(var_start, var_len)
+        self.sendCommand(YACPProtocol.CAL_READ_OVERRIDE, override.offset, lengths[override.cal_type])
+
+    def sectionKeys(self, entries, sections):
+        return [key for key in entries if entries[key].section in sections]
+
+    # A section opened before the reads reach its entries is read with the rest,
+    # one opened later is queued and read between the polls
+    def loadSection(self, section):
+        if section in self.loaded_sections:
+            return
+        self.loaded_sections.add(section)
+
+        setting_keys = [] if self.settings_cached else self.sectionKeys(self.settings, [section])
+        override_keys = self.sectionKeys(self.overrides, [section])
+
+        # start() reads the loaded sections
+        if self.device_state == YACPProtocol.DEVICE_STATE_DISCONNECTED:
+            return
+
+        if self.device_state in (YACPProtocol.DEVICE_STATE_READING_SETTINGS_CRC, YACPProtocol.DEVICE_STATE_READING_SETTINGS):
+            self.read_setting_keys += setting_keys
+        else:
+            self.read_queue += [(YACPProtocol.CAL_READ_SETTING, key) for key in setting_keys]
+
+        if self.device_state in (YACPProtocol.DEVICE_STATE_READING_SETTINGS_CRC, YACPProtocol.DEVICE_STATE_READING_SETTINGS, YACPProtocol.DEVICE_STATE_READING_OVERRIDES):
+            self.read_override_keys += override_keys
+        else:
+            self.read_queue += [(YACPProtocol.CAL_READ_OVERRIDE, key) for key in override_keys]
+
+    def readQueued(self):
+        (message_type, key) = self.read_queue.pop(0)
+        if message_type == YACPProtocol.CAL_READ_SETTING:
+            self.readSettingKey(key)
+        else:
+            self.readOverrideKey(key)
+
+    # One setting of the background read every SETTINGS_BACKGROUND_TICKS, True when
+    # one was sent. Unanswered reads go round again until every setting arrived.
+    def readBackgroundSetting(self):
+        keys = self.background_setting_keys
+        while len(keys) > 0 and keys[0] in self.settings_received:
+            keys.pop(0)
+        if len(keys) == 0:
+            return False
+
+        self.background_ticks += 1
+        if self.background_ticks % YACPProtocol.SETTINGS_BACKGROUND_TICKS != 0:
+            return False
+
+        key = keys.pop(0)
+        keys.append(key)
+        self.readSettingKey(key)
+        return True
+
+    def settingsLoaded(self):
+        if self.device == None or self.settings_cached:
+            return True
+        return all(key in self.settings_received for key in self.settings)
 
     def sendSettingChange(self, setting_key, str_val):
         setting = self.settings[setting_key]
+        setting.value = parse_value(setting.cal_type, str_val)
 
-        if setting.cal_type == 'float':
-            setting.value = float(str_val)
-        else:
-            setting.value = int(str_val)
+        self.sendSetting(setting_key)
 
-        [b0,b1,b2,b3] = self.getBytesFromValue(setting.cal_type, setting.value)
+    def sendSetting(self, setting_key):
+        setting = self.settings[setting_key]
+
+        [b0,b1,b2,b3] = write_bytes(setting.cal_type, setting.value, lengths[setting.cal_type])
 
-        self.set_setting_signal.emit(setting.offset, lengths[setting.cal_type], b0,b1,b2,b3)
+        self.sendCommand(YACPProtocol.CAL_UPDATE_SETTING, setting.offset, lengths[setting.cal_type], b0,b1,b2,b3)
 
     def sendOverrideChange(self, override_key, str_val, override_status):
         override = self.overrides[override_key]
-        
-        if override.cal_type == 'float':
-            override.value = float(str_val)
-        else:
-            override.value = int(str_val)
+        override.value = parse_value(override.cal_type, str_val)
 
         override.status = override_status
-        enabled = False
-        if override.status == "Overridden":
-            enabled = True
 
-        [b0,b1,b2,b3] = self.getBytesFromValue(override.cal_type, override.value)
+        self.sendOverride(override_key)
+
+    def sendOverride(self, override_key, staged=False):
+        override = self.overrides[override_key]
+        overridden = override.status == "Overridden"
 
-        #print(str(enabled)+" "+str(b0)+" "+str(b1)+" "+str(b2)+" "+str(b3)+" "+str(override.value))
+        [b0,b1,b2,b3] = write_bytes(override.cal_type, override.value, OVERRIDE_WRITE_LEN)
 
-        self.set_override_signal.emit(enabled, override.offset, lengths[override.cal_type], b0,b1,b2,b3)
+        if staged:
+            # The status to stage goes in the var_len field
+            self.sendCommand(YACPProtocol.CAL_OVERRIDE_STAGE, override.offset, 1 if overridden else 0, b0,b1,b2,b3)
+        elif overridden:
+            self.sendCommand(YACPProtocol.CAL_OVERRIDE_ON, override.offset, lengths[override.cal_type], b0,b1,b2,b3)
+        else:
+            self.sendCommand(YACPProtocol.CAL_OVERRIDE_OFF, override.offset, lengths[override.cal_type], b0,b1,b2,b3)
+
+    def usesOverrideTransactions(self):
+        return self.device != None and self.device.capabilities & YACPProtocol.YACP_CAP_TRANSACTIONS
+
+    # Staged changes are only sent by commitOverrides, a device that supports
+    # transactions applies them all at once and acks the commit once
+    def stageOverrideChange(self, override_key, str_val, override_status):
+        override = self.overrides[override_key]
+        self.staged_overrides[override_key] = (parse_value(override.cal_type, str_val), override_status)
+
+    def commitOverrides(self):
+        staged = dict(self.staged_overrides)
+        self.staged_overrides.clear()
+
+        return self.applyOverrides(staged)
+
+    # Sends override key -> (value, status) changes together, as one transaction where
+    # the device supports it. Callers with their own changes use this directly so what
+    # the user staged is left alone
+    def applyOverrides(self, staged):
+        if len(staged) == 0:
+            return 0
+
+        for override_key, (value, status) in staged.items():
+            override = self.overrides[override_key]
+            override.value = value
+            override.status = status
+
+        if not self.usesOverrideTransactions():
+            for override_key in staged:
+                self.sendOverride(override_key)
+            return len(staged)
+
+        self.sendCommand(YACPProtocol.CAL_OVERRIDE_TRANSACTION, 0, 0, YACPProtocol.YACP_TRANSACTION_BEGIN)
+        for override_key in staged:
+            self.sendOverride(override_key, staged=True)
+        self.sendCommand(YACPProtocol.CAL_OVERRIDE_TRANSACTION, len(staged), 0, YACPProtocol.YACP_TRANSACTION_COMMIT)
+
+        return len(staged)
+
+    def abortOverrides(self):
+        self.staged_overrides.clear()
+
+    def sendPollList(self):
+        # Polling is handed to the bus worker as the list of request frames to cycle through
+        subscribed = [self.readFrame(key) for key in self.subscribed]
+        background = [self.readFrame(key) for key in self.background]
+
+        if self.usesDeltaMeasurements():
+            if not self.delta_synced:
+                self.readMeasurementDelta(YACPProtocol.YACP_DELTA_FULL)
+                self.delta_synced = True
+
+            # Subscribed measurements are read directly between the delta requests
+            delta = encode_frame(self.base_can_id, self.device_id, YACPProtocol.CAL_READ_MEASUREMENT_DELTA, 0, self.deltaBudget())
+            poll_list = [delta]
+            for frame in subscribed:
+                poll_list += [frame, delta]
+            background = []
+        elif len(subscribed) > 0:
+            poll_list = subscribed
+        else:
+            poll_list = background
+            background = []
+
+        self.can_thread.setPollList(self.base_can_id, self.device_id, poll_list, background)
+
+    def readFrame(self, measurement_key):
+        measurement = self.measurements[measurement_key]
+        return encode_frame(self.base_can_id, self.device_id, YACPProtocol.CAL_READ_MEASUREMENT, measurement.offset, lengths[measurement.cal_type])
 
     def tick(self):
         if self.device_state == YACPProtocol.DEVICE_STATE_DISCONNECTED:
             pass
+
+        elif self.device_state == YACPProtocol.DEVICE_STATE_READING_SETTINGS_CRC:
+            if self.read_settings_crc_ticks == 0:
+                self.sendCommand(YACPProtocol.CAL_READ_SETTINGS_CRC)
+
+            self.read_settings_crc_ticks += 1
+            if self.read_settings_crc_ticks >= YACPProtocol.SETTINGS_CRC_TIMEOUT_TICKS:
+                self.device_state = YACPProtocol.DEVICE_STATE_READING_SETTINGS
         
         elif self.device_state == YACPProtocol.DEVICE_STATE_READING_SETTINGS:
-            self.app_update_device_state_signal.emit()
-            
-            self.readSetting()
+            if self.read_setting_index < len(self.read_setting_keys):
+                self.readSetting()
 
             self.read_setting_index += 1
-            if self.read_setting_index >= self.num_settings:
+            if self.read_setting_index >= len(self.read_setting_keys):
                 self.device_state = YACPProtocol.DEVICE_STATE_READING_OVERRIDES
                 self.read_setting_index = 0
                 
         elif self.device_state == YACPProtocol.DEVICE_STATE_READING_OVERRIDES:
-            self.app_update_device_state_signal.emit()
-            
-            self.readOverride()
+            if self.read_override_index < len(self.read_override_keys):
+                self.readOverride()
 
             self.read_override_index += 1
-            if self.read_override_index >= self.num_overrides:
+            if self.read_override_index >= len(self.read_override_keys):
                 self.device_state = YACPProtocol.DEVICE_STATE_READING_MEASUREMENTS
-                self.read_overrides_index = 0
+                self.read_override_index = 0
         
         elif self.device_state == YACPProtocol.DEVICE_STATE_READING_MEASUREMENTS:
-            self.app_update_device_state_signal.emit()
-            
-            self.readMeasurement()
+            if len(self.measurements) > 0:
+                self.readMeasurement()
 
             self.read_measurement_index += 1
-            if self.read_measurement_index >= self.num_measurements:
+            if self.read_measurement_index >= len(self.measurements):
                 self.device_state = YACPProtocol.DEVICE_STATE_CONNECTED
                 self.read_measurement_index = 0
-
-                self.app_update_device_state_signal.emit()
             
         elif self.device_state == YACPProtocol.DEVICE_STATE_CONNECTED:
-            self.readMeasurement()
-            self.read_measurement_index += 1
-            if self.read_measurement_index >= self.num_measurements:
-                self.read_measurement_index = 0
-
-    def connect(self, bustype, interface, bitrate, connect):
-        if connect == True:
-            self.can_thread.connect(bustype, interface, bitrate)
-        else:
-            self.can_thread.disconnect()
-
-    def set_base_can_id(self, base_can_id):
-        self.can_thread.set_base_can_id(base_can_id)
+            # Sections opened since connecting are read before polling resumes
+            if len(self.read_queue) > 0:
+                self.readQueued()
+                return
+
+            # Takes the tick's poll unless the bus worker polls
+            if self.readBackgroundSetting() and not self.can_thread.schedules_polls:
+                return
+
+            if len(self.measurements) == 0:
+                return
+
+            if self.can_thread.schedules_polls:
+                if not self.poll_list_sent:
+                    self.sendPollList()
+                    self.poll_list_sent = True
+                return
+
+            if self.usesDeltaMeasurements():
+                # The first request resyncs the device's image of what was reported.
+                # Subscribed measurements are read directly between the delta requests.
+                self.poll_count += 1
+                if not self.delta_synced:
+                    self.readMeasurementDelta(YACPProtocol.YACP_DELTA_FULL)
+                    self.delta_synced = True
+                elif len(self.subscribed) > 0 and self.poll_count % 2 == 0:
+                    self.readSubscribed()
+                else:
+                    self.readMeasurementDelta()
+                return
 
-    @pyqtSlot(int)
-    def handleCANStatus(self, status):
-        if status == 1:
-            self.can_state = 0
-        elif status == 0:
-            self.can_state = 1
-        elif status == 2:
-            self.can_state = 0
-            
-        self.app_update_can_status_signal.emit()
+            self.pollMeasurement()
         
+# The entries of a def and the offline session holding them, see readDefFile
+class Definition:
+    def __init__(self):
+        self.session = None
+        self.num_measurements = 0
+        self.num_settings = 0
+        self.num_overrides = 0
+        self.sections = []
+        self.section_descriptions = {}
+        self.search_index = None
+        self.revision = -1
+
 class Measurement:
-    def __init__(self, name, cal_type, unit, offset, index):
+    def __init__(self, name, cal_type, unit, offset, index, image):
         self.name = name
         self.cal_type = cal_type
-        self.value = 0
         self.values = {}
         self.unit = unit
+        self.notes = ""
         self.offset = offset
         self.index = index
+        self.image = image
+        self.formatter = Formatter(cal_type, unit=unit)
+        # Receive time of the latest response and its round trip time, in seconds
+        self.timestamp = 0
+        self.round_trip = None
+
+    @property
+    def value(self):
+        return formats[self.cal_type].unpack_from(self.image, self.offset)[0]
+
+    @value.setter
+    def value(self, value):
+        formats[self.cal_type].pack_into(self.image, self.offset, value)
+
+# Display text of a value, the conversion is picked once from the def entry
+class Formatter:
+    def __init__(self, cal_type, display="decimal", values={}, precision=None, unit=""):
+        self.cal_type = cal_type
+        self.display = display
+        self.unit = unit
+        self.hidden = display == "hidden"
+        self.mask = (1 << (lengths[cal_type] * 8)) - 1
+
+        self.values = {}
+        for value in values:
+            try:
+                self.values[parse_value(cal_type, value)] = values[value]
+            except ValueError:
+                pass
+
+        if cal_type == "float":
+            self.base = self.textDecimal
+            if precision != None:
+                self.pattern = "%." + str(int(precision)) + "f"
+                self.base = self.textPattern
+        elif display == "hex":
+            self.pattern = "0x%0" + str(lengths[cal_type] * 2) + "X"
+            self.base = self.textHex
+        elif display == "binary":
+            self.pattern = "0" + str(lengths[cal_type] * 8) + "b"
+            self.base = self.textBinary
+        else:
+            self.base = self.textDecimal
+
+        if len(self.values) > 0:
+            self.text = self.textEnum
+        else:
+            self.text = self.base
+
+    # Formatters never change once built, sessions share them
+    def __deepcopy__(self, memo):
+        return self
+
+    def textWithUnit(self, value):
+        if self.unit == "":
+            return self.text(value)
+        return self.text(value) + " " + self.unit
+
+    def textEnum(self, value):
+        label = self.values.get(value)
+        if label == None:
+            return self.base(value)
+        return label
+
+    def textDecimal(self, value):
+        return str(value)
+
+    def textPattern(self, value):
+        return self.pattern % value
+
+    def textHex(self, value):
+        return self.pattern % (value & self.mask)
+
+    def textBinary(self, value):
+        return "0b" + format(value & self.mask, self.pattern)
 
 class Setting:
-    def __init__(self, name, value, cal_type, unit, default_value, offset, index):
+    def __init__(self, name, value, cal_type, unit, default_value, offset, index, image):
         self.name = name
         self.cal_type = cal_type
+        self.offset = offset
+        self.image = image
         if value != None:
             self.value = value
         elif default_value != None:
-            self.value = default_value
+            self.value = parse_value(cal_type, default_value)
         else:
             self.value = 0
+        self.default = self.value
         self.choices = {}
         self.unit = unit
-        self.offset = offset
+        self.notes = ""
         self.index = index
+        self.formatter = Formatter(cal_type, unit=unit)
+        # Def section, None when it has none
+        self.section = None
+        # Receive time of the latest response
+        self.timestamp = 0
+
+    @property
+    def value(self):
+        return formats[self.cal_type].unpack_from(self.image, self.offset)[0]
+
+    @value.setter
+    def value(self, value):
+        formats[self.cal_type].pack_into(self.image, self.offset, value)
 
 class Override:
-    def __init__(self, name, cal_type, unit, offset, index):
+    # The image holds the cal_override: status byte then the value at value_offset
+    def __init__(self, name, cal_type, unit, offset, index, image, value_offset=1):
         self.name = name
         self.cal_type = cal_type
         self.offset = offset
-        self.status = "Passthrough"
-        self.value = 0
+        self.value_offset = value_offset
+        self.image = image
+        self.choices = {}
         self.unit = unit
+        self.notes = ""
         self.index = index
+        self.formatter = Formatter(cal_type, unit=unit)
+        # Def section, None when it has none
+        self.section = None
+        # Receive time of the latest response
+        self.timestamp = 0
+
+    @property
+    def value(self):
+        return formats[self.cal_type].unpack_from(self.image, self.offset + self.value_offset)[0]
+
+    @value.setter
+    def value(self, value):
+        formats[self.cal_type].pack_into(self.image, self.offset + self.value_offset, value)
+
+    @property
+    def status(self):
+        if self.image[self.offset] != 0:
+            return "Overridden"
+        return "Passthrough"
+
+    @status.setter
+    def status(self, status):
+        self.image[self.offset] = 1 if status == "Overridden" else 0
 
 class Device:
-    def __init__(self, device_id, firmware_version, product_id, cal_revision, cal_protocol):
+    def __init__(self, device_id, firmware_version, product_id, cal_revision, cal_protocol, base_can_id=YACPProtocol.YACP_COMMAND_ID, bus=""):
         self.device_id = device_id
         self.firmware_version = firmware_version
         self.product_id = product_id
         self.cal_revision = cal_revision
         self.cal_protocol = cal_protocol
+        self.base_can_id = base_can_id
+        self.bus = bus
+        self.capabilities = 0
+        # Most measurements sent per delta request, 0 from devices that do not report it
+        self.delta_burst = 0
+        self.confirmed = False
+        self.last_seen = 0
+
+    def key(self):
+        return (self.bus, self.base_can_id, self.device_id)
 
         
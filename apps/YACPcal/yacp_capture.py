@@ -0,0 +1,261 @@
+"""
+yacp_capture.py
+Yet Another Calibration Protocol (YACP)
+
+Triggered capture of measurements. Every captured measurement keeps its recent samples
+in a fixed size ring, so a capture can run unattended for days in constant memory.
+When a trigger fires, the samples from the pre trigger window before it to the post
+trigger window after it are saved to a CSV file and the capture rearms.
+
+Config (json):
+{
+    "measurements": ["pack_voltage", "pack_current"],
+    "triggers": [
+        {"measurement": "bms_state", "type": "change"},
+        {"measurement": "pack_voltage", "type": "falling", "level": 300}
+    ],
+    "pre": 5,
+    "post": 5,
+    "samples": 100000,
+    "directory": "captures"
+}
+
+Trigger types: rising and falling (crossing level), equals (becoming level, which can
+be one of the measurement's value names) and change (any new value).
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import csv
+import json
+import os
+import time
+
+from array import array
+
+from PyQt5.QtCore import QObject
+from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import pyqtSignal
+
+from yacp import parse_value
+
+# Samples kept for each measurement unless the config says otherwise
+DEFAULT_SAMPLES = 100000
+
+# Period of the check for post trigger windows that have ended
+CHECK_MS = 100
+
+class CaptureBuffer:
+    # Preallocated ring of (time, value) samples
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.count = 0
+
+    def append(self, sample_time, value):
+        i = self.count % self.capacity
+        self.times[i] = sample_time
+        self.values[i] = value
+        self.count += 1
+
+    # Samples from start to end plus the last one before start, values hold until the next sample
+    def window(self, start, end):
+        samples = []
+
+        i = self.count - 1
+        oldest = max(self.count - self.capacity, 0)
+        while i >= oldest:
+            sample_time = self.times[i % self.capacity]
+            if sample_time <= end:
+                samples.append((sample_time, self.values[i % self.capacity]))
+                if sample_time < start:
+                    break
+            i -= 1
+
+        samples.reverse()
+        return samples
+
+class Trigger:
+    def __init__(self, measurement_key, name, kind, level=None):
+        self.measurement_key = measurement_key
+        self.name = name
+        self.kind = kind
+        self.level = level
+
+        # The check is picked once, each new value costs one comparison
+        if kind == "rising":
+            self.check = self.checkRising
+        elif kind == "falling":
+            self.check = self.checkFalling
+        elif kind == "equals":
+            self.check = self.checkEquals
+        elif kind == "change":
+            self.check = self.checkChange
+        else:
+            raise ValueError("Unknown trigger type "+str(kind))
+
+    def description(self):
+        if self.kind == "change":
+            return self.name+" change"
+        return self.name+" "+self.kind+" "+str(self.level)
+
+    def checkRising(self, previous, value):
+        return previous != None and previous < self.level and value >= self.level
+
+    def checkFalling(self, previous, value):
+        return previous != None and previous > self.level and value <= self.level
+
+    def checkEquals(self, previous, value):
+        return previous != self.level and value == self.level
+
+    def checkChange(self, previous, value):
+        return previous != None and previous != value
+
+class Capture(QObject):
+    capture_saved_signal = pyqtSignal(str)
+
+    # Captures the measurements of the protocol's active session
+    def __init__(self, protocol, measurement_keys, triggers, pre, post, samples=DEFAULT_SAMPLES, directory="captures"):
+        super().__init__()
+
+        self.protocol = protocol
+        self.session = protocol.session
+        self.pre = pre
+        self.post = post
+        self.directory = directory
+
+        self.triggers = {}
+        for trigger in triggers:
+            self.triggers.setdefault(trigger.measurement_key, []).append(trigger)
+
+        keys = list(measurement_keys)
+        for key in self.triggers:
+            if key not in keys:
+                keys.append(key)
+        self.buffers = {key: CaptureBuffer(samples) for key in keys}
+        self.last = {}
+
+        # Time and description of the trigger whose post trigger window is being recorded
+        self.trigger_time = None
+        self.trigger_description = ""
+        self.saved = 0
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.checkWindow)
+
+    def start(self):
+        # Values only arrive when they change, the current ones start every ring
+        now = time.time()
+        for key, buffer in self.buffers.items():
+            value = self.session.measurements[key].value
+            buffer.append(now, value)
+            self.last[key] = value
+
+        self.protocol.app_update_measurement_signal.connect(self.updateMeasurement)
+        self.protocol.subscribe('capture', [*self.buffers])
+        self.timer.start(CHECK_MS)
+
+    def stop(self):
+        self.timer.stop()
+        self.protocol.app_update_measurement_signal.disconnect(self.updateMeasurement)
+        self.protocol.unsubscribe('capture')
+
+        # A capture cut short keeps the part of the post trigger window that was recorded
+        if self.trigger_time != None:
+            self.save(time.time())
+
+    #@pyqtSlot(int,int)
+    def updateMeasurement(self, table_index, offset):
+        if self.protocol.session is not self.session:
+            return
+
+        buffer = self.buffers.get(offset)
+        if buffer == None:
+            return
+
+        # Samples are placed at the time the adaptor received them, mapped onto time.time()
+        # so the post trigger window can be checked against it
+        measurement = self.session.measurements[offset]
+        now = measurement.timestamp or time.time()
+        value = measurement.value
+        buffer.append(now, value)
+
+        triggers = self.triggers.get(offset)
+        if triggers != None:
+            previous = self.last[offset]
+            if self.trigger_time == None:
+                for trigger in triggers:
+                    if trigger.check(previous, value):
+                        self.trigger_time = now
+                        self.trigger_description = trigger.description()
+                        break
+        self.last[offset] = value
+
+    def checkWindow(self):
+        if self.trigger_time != None and time.time() >= self.trigger_time + self.post:
+            self.save(self.trigger_time + self.post)
+
+    def save(self, end):
+        trigger_time = self.trigger_time
+        self.trigger_time = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        fileName = os.path.join(self.directory, "capture-"+time.strftime("%Y%m%d-%H%M%S", time.localtime(trigger_time))+("-%03d" % (int(trigger_time * 1000) % 1000))+".csv")
+
+        with open(fileName, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["trigger", self.trigger_description, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trigger_time))])
+            writer.writerow(["time_s", "measurement", "value"])
+
+            for key, buffer in self.buffers.items():
+                measurement = self.session.measurements[key]
+                # The rings hold doubles, integer measurements are written back as integers
+                text = repr if measurement.cal_type == "float" else lambda value: str(int(value))
+                for (sample_time, value) in buffer.window(trigger_time - self.pre, end):
+                    writer.writerow(["%.6f" % (sample_time - trigger_time), measurement.name, text(value)])
+
+        self.saved += 1
+        self.capture_saved_signal.emit(fileName)
+
+def load_capture(protocol, fileName):
+    with open(fileName) as config_file:
+        config = json.load(config_file)
+
+    names = {measurement.name: key for key, measurement in protocol.measurements.items()}
+
+    measurement_keys = []
+    for name in config.get("measurements", []):
+        if name not in names:
+            raise ValueError("Unknown measurement "+name)
+        measurement_keys.append(names[name])
+
+    triggers = []
+    for t in config.get("triggers", []):
+        if t.get("measurement") not in names:
+            raise ValueError("Unknown trigger measurement "+str(t.get("measurement")))
+
+        key = names[t["measurement"]]
+        measurement = protocol.measurements[key]
+
+        level = None
+        if "level" in t:
+            # Value names from the def can be used as levels
+            level = str(t["level"])
+            value_names = {name: value for value, name in measurement.formatter.values.items()}
+            if level in value_names:
+                level = value_names[level]
+            else:
+                level = parse_value(measurement.cal_type, level)
+        elif t.get("type") != "change":
+            raise ValueError("Trigger on "+t["measurement"]+" needs a level")
+
+        triggers.append(Trigger(key, measurement.name, t.get("type"), level))
+
+    if len(triggers) == 0:
+        raise ValueError("No triggers")
+
+    return Capture(protocol, measurement_keys, triggers, float(config.get("pre", 5)), float(config.get("post", 5)), int(config.get("samples", DEFAULT_SAMPLES)), config.get("directory", "captures"))
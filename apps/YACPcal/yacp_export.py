@@ -0,0 +1,262 @@
+"""
+yacp_export.py
+Yet Another Calibration Protocol (YACP)
+
+Exports recordings (see yacp_recorder.py) and captures with every measurement
+resampled onto a common time base. The measurements of a recording are sampled at
+staggered times, the export gives them one time column and one value column each.
+
+Resampling methods: hold (the last value received, as the recording means it),
+linear (interpolated between the samples around each time) and nearest (the sample
+closest in time). Gaps in the recording are exported as NaN until a measurement's
+first value after the gap.
+
+The recording is first split into a binary time and value file per measurement, then
+the output is resampled and written in chunks of CHUNK_SAMPLES times, so the memory
+used does not depend on the length of the recording. Outputs:
+ .npz  one array per column, time_s and the measurement names
+ .npy  a directory with a .npy file per column, for np.load(mmap_mode='r')
+ .csv  time_s then a column per measurement
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import csv
+import os
+import shutil
+import tempfile
+import traceback
+import zipfile
+
+import numpy as np
+
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+
+from yacp_recorder import GAP
+
+METHODS = ["hold", "linear", "nearest"]
+
+# Times resampled and written at once
+CHUNK_SAMPLES = 100000
+
+# Samples parsed from the recording before they are written to the column files
+PARSE_SAMPLES = 100000
+
+class Recording:
+    # The samples of a recording split into a (times, values) pair of float64 files per
+    # measurement. Values do not hold across a gap, each gap ends every measurement with NaN.
+    def __init__(self, fileName):
+        self.directory = tempfile.mkdtemp(prefix="yacp-export-")
+        self.names = []
+        self.counts = {}
+        self.start = None
+        self.end = None
+
+        pending = {}
+        last = {}
+        parsed = 0
+
+        with open(fileName, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+
+            # Captures start with a trigger row before the header
+            for row in reader:
+                if len(row) > 0 and row[0] == "time_s":
+                    break
+
+            for row in reader:
+                if len(row) < 3:
+                    continue
+
+                sample_time = float(row[0])
+                if row[1] == GAP:
+                    for name in self.names:
+                        pending[name].append((max(sample_time, last[name]), np.nan))
+                        last[name] = max(sample_time, last[name])
+                    parsed += len(self.names)
+                else:
+                    name = row[1]
+                    if name not in pending:
+                        self.names.append(name)
+                        self.counts[name] = 0
+                        pending[name] = []
+                        last[name] = sample_time
+
+                    # Receive times can be a little out of order across the start of a
+                    # recording, a measurement's samples are kept in order
+                    sample_time = max(sample_time, last[name])
+                    last[name] = sample_time
+                    pending[name].append((sample_time, float(row[2])))
+                    parsed += 1
+
+                if self.start == None or sample_time < self.start:
+                    self.start = sample_time
+                if self.end == None or sample_time > self.end:
+                    self.end = sample_time
+
+                if parsed >= PARSE_SAMPLES:
+                    self.flush(pending)
+                    parsed = 0
+
+        self.flush(pending)
+
+    def flush(self, pending):
+        for name, samples in pending.items():
+            if len(samples) == 0:
+                continue
+
+            with open(self.columnFile(name), 'ab') as column_file:
+                np.array(samples, dtype=np.float64).tofile(column_file)
+            self.counts[name] += len(samples)
+            samples.clear()
+
+    def columnFile(self, name):
+        return os.path.join(self.directory, str(self.names.index(name))+".bin")
+
+    # Memory mapped (times, values) of a measurement
+    def column(self, name):
+        samples = np.memmap(self.columnFile(name), dtype=np.float64, mode='r', shape=(self.counts[name], 2))
+        return (samples[:, 0], samples[:, 1])
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def resample_column(times, values, t, method):
+    # Only the samples around this chunk of times are read from the column
+    first = max(np.searchsorted(times, t[0], 'right') - 1, 0)
+    last = min(np.searchsorted(times, t[-1], 'right') + 1, len(times))
+    times = np.asarray(times[first:last])
+    values = np.asarray(values[first:last])
+
+    result = np.full(len(t), np.nan)
+    if len(times) == 0:
+        return result
+
+    # The samples at or before and after each time. Before the first sample the value
+    # is not known, after the last one it holds.
+    before = np.searchsorted(times, t, 'right') - 1
+    known = before >= 0
+    lower = before.clip(0)
+    upper = np.minimum(before + 1, len(times) - 1)
+
+    if method == "hold":
+        result = values[lower]
+    elif method == "linear":
+        span = times[upper] - times[lower]
+        # The last value before a gap holds until the gap, inside a gap it stays NaN
+        upper_values = np.where(np.isnan(values[upper]), values[lower], values[upper])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(span > 0, (t - times[lower]) / span, 0)
+            result = np.where(fraction == 0, values[lower], values[lower] + (upper_values - values[lower]) * fraction)
+    elif method == "nearest":
+        # A gap is never left early or entered early
+        usable = ~np.isnan(values[lower]) & ~np.isnan(values[upper])
+        nearer_upper = usable & (times[upper] - t < t - times[lower])
+        result = values[np.where(nearer_upper, upper, lower)]
+    else:
+        raise ValueError("Unknown resampling method "+str(method))
+
+    result[~known] = np.nan
+    return result
+
+def sample_count(recording, period):
+    if recording.start == None:
+        return 0
+    # An end that is a whole number of periods in is not lost to rounding
+    return int(np.floor((recording.end - recording.start) / period + 1e-9)) + 1
+
+# Yields (times, [values of each measurement]) in chunks of at most chunk times
+def resample(recording, period, method="hold", chunk=CHUNK_SAMPLES):
+    if method not in METHODS:
+        raise ValueError("Unknown resampling method "+str(method))
+    if period <= 0:
+        raise ValueError("The period must be more than 0")
+
+    count = sample_count(recording, period)
+    columns = [recording.column(name) for name in recording.names]
+
+    for first in range(0, count, chunk):
+        t = recording.start + np.arange(first, min(first + chunk, count)) * period
+        yield (t, [resample_column(times, values, t, method) for (times, values) in columns])
+
+def export_npy(recording, directory, period, method="hold"):
+    os.makedirs(directory, exist_ok=True)
+
+    # Each column gets its .npy header and then its values appended chunk by chunk
+    names = ["time_s"] + recording.names
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float64)), 'fortran_order': False, 'shape': (sample_count(recording, period),)}
+    for name in names:
+        with open(os.path.join(directory, name+".npy"), 'wb') as npy_file:
+            np.lib.format.write_array_header_1_0(npy_file, header)
+
+    for (t, columns) in resample(recording, period, method):
+        for name, column in zip(names, [t] + columns):
+            with open(os.path.join(directory, name+".npy"), 'ab') as npy_file:
+                npy_file.write(column.astype(np.float64).tobytes())
+
+    return names
+
+def export_npz(recording, fileName, period, method="hold"):
+    # The columns are written as .npy files first, then stored in the archive one at a time
+    directory = tempfile.mkdtemp(prefix="yacp-export-")
+    try:
+        names = export_npy(recording, directory, period, method)
+        with zipfile.ZipFile(fileName, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name in names:
+                archive.write(os.path.join(directory, name+".npy"), name+".npy")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def export_csv(recording, fileName, period, method="hold"):
+    with open(fileName, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["time_s"] + recording.names)
+
+        for (t, columns) in resample(recording, period, method):
+            np.savetxt(csvfile, np.column_stack([t] + columns), fmt='%.9g', delimiter=',')
+
+# Output format from the extension of outName, anything else is a .npy directory
+def export_recording(fileName, outName, period, method="hold"):
+    recording = Recording(fileName)
+    try:
+        if recording.start == None:
+            raise ValueError("No measurements in "+fileName)
+
+        if outName.lower().endswith('.npz'):
+            export_npz(recording, outName, period, method)
+        elif outName.lower().endswith('.csv'):
+            export_csv(recording, outName, period, method)
+        else:
+            export_npy(recording, outName, period, method)
+    finally:
+        recording.close()
+
+class ExportRunner(QThread):
+    # Empty on success, otherwise the error
+    export_done_signal = pyqtSignal(str)
+
+    def __init__(self, fileName, outName, period, method):
+        QThread.__init__(self)
+
+        self.fileName = fileName
+        self.outName = outName
+        self.period = period
+        self.method = method
+
+    def run(self):
+        # Whatever goes wrong is reported, otherwise the GUI would wait for the export forever
+        try:
+            export_recording(self.fileName, self.outName, self.period, self.method)
+        except (OSError, ValueError) as e:
+            self.export_done_signal.emit(str(e))
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.export_done_signal.emit(str(e) or type(e).__name__)
+            return
+
+        self.export_done_signal.emit("")
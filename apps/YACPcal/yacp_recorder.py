@@ -0,0 +1,118 @@
+"""
+yacp_recorder.py
+Yet Another Calibration Protocol (YACP)
+
+Records the measurements of the active session to a CSV file as they change. Each
+measurement is written when a new value arrives, at the time the adaptor received it,
+so a value holds until the next row for it. The recording starts and ends with a row
+for every measurement. Time the bus was lost is written as a gap row, values before a
+gap do not hold across it and every measurement is written again when it is first read
+after it. Devices that stop answering leave a gap the same way.
+
+CSV: time_s (from the start of the recording), measurement, value, round_trip_ms (from
+the request to the response, empty when not known). A gap row has "#gap" as the
+measurement and the length of the gap in seconds as the value, at the time the last
+frame was received before it.
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import csv
+import time
+
+from PyQt5.QtCore import QObject
+
+GAP = "#gap"
+
+class Recorder(QObject):
+    # Records the given measurements of the protocol's active session, all of them by default
+    def __init__(self, protocol, fileName, measurement_keys=None):
+        super().__init__()
+
+        self.protocol = protocol
+        self.session = protocol.session
+        self.fileName = fileName
+
+        if measurement_keys == None:
+            measurement_keys = [*self.session.measurements]
+        self.measurement_keys = set(measurement_keys)
+
+        self.csvfile = None
+        self.writer = None
+        self.start_time = 0
+        self.gap_start = None
+        self.gaps = 0
+        self.rows = 0
+
+    def start(self):
+        self.csvfile = open(self.fileName, 'w', newline='')
+        self.writer = csv.writer(self.csvfile)
+        self.writer.writerow(["time_s", "measurement", "value", "round_trip_ms"])
+
+        # Values only arrive when they change, the recording starts with the current ones
+        self.start_time = time.time()
+        for key in self.measurement_keys:
+            self.writeValue(key, self.start_time)
+
+        self.protocol.app_update_measurement_signal.connect(self.updateMeasurement)
+        self.protocol.app_bus_lost_signal.connect(self.busLost)
+        self.protocol.app_bus_restored_signal.connect(self.busRestored)
+        self.protocol.app_bus_silent_signal.connect(self.busLost)
+        self.protocol.app_bus_answering_signal.connect(self.busRestored)
+        self.protocol.subscribe('recorder', [*self.measurement_keys])
+
+    def stop(self):
+        self.protocol.app_update_measurement_signal.disconnect(self.updateMeasurement)
+        self.protocol.app_bus_lost_signal.disconnect(self.busLost)
+        self.protocol.app_bus_restored_signal.disconnect(self.busRestored)
+        self.protocol.app_bus_silent_signal.disconnect(self.busLost)
+        self.protocol.app_bus_answering_signal.disconnect(self.busRestored)
+        self.protocol.unsubscribe('recorder')
+
+        # A recording stopped while the bus is down ends with that gap,
+        # otherwise it ends with the current values like it started
+        now = time.time()
+        if self.gap_start != None:
+            self.writeGap(now)
+        else:
+            for key in self.measurement_keys:
+                self.writeValue(key, now)
+
+        self.csvfile.close()
+        self.csvfile = None
+
+    def writeValue(self, key, now):
+        measurement = self.session.measurements[key]
+        round_trip = "" if measurement.round_trip == None else "%.3f" % (measurement.round_trip * 1000)
+        self.writer.writerow(["%.6f" % (now - self.start_time), measurement.name, measurement.value, round_trip])
+        self.rows += 1
+
+    def writeGap(self, now):
+        self.writer.writerow(["%.6f" % (self.gap_start - self.start_time), GAP, "%.3f" % (now - self.gap_start), ""])
+        self.gap_start = None
+        self.gaps += 1
+
+    #@pyqtSlot(int,int)
+    def updateMeasurement(self, table_index, offset):
+        if self.protocol.session is not self.session or offset not in self.measurement_keys:
+            return
+
+        self.writeValue(offset, self.session.measurements[offset].timestamp or time.time())
+
+    def onSessionBus(self, name):
+        return self.session.can_thread != None and self.session.can_thread.name == name
+
+    #@pyqtSlot(str)
+    def busLost(self, name):
+        if self.onSessionBus(name) and self.gap_start == None:
+            # The values stopped coming with the last frame, not when that was noticed
+            self.gap_start = max(self.protocol.lastReceiveTime(name), self.start_time) or time.time()
+            self.csvfile.flush()
+
+    #@pyqtSlot(str)
+    def busRestored(self, name):
+        if self.onSessionBus(name) and self.gap_start != None:
+            self.writeGap(time.time())
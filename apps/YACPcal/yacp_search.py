@@ -0,0 +1,164 @@
+"""
+yacp_search.py
+Yet Another Calibration Protocol (YACP)
+
+Search index over the measurements, settings and overrides of a def, built when the
+def is loaded. Each entry is indexed by its name, unit, notes and enum labels. A query
+matches entries with the query in any of them, and entries whose name holds the
+letters of the query in order (fuzzy, e.g. "bvlt" finds "batt_voltage"). Results are
+ranked: exact name, name prefix, name substring, other text, then fuzzy matches.
+
+A query that extends the previous one only looks through the previous matches, so
+filtering as the query is typed stays fast on defs with thousands of entries.
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QAbstractProxyModel
+from PyQt5.QtCore import QModelIndex
+
+MEASUREMENT = "measurement"
+SETTING = "setting"
+OVERRIDE = "override"
+
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_NAME = 2
+RANK_TEXT = 3
+RANK_FUZZY = 4
+
+def fuzzy_match(query, name):
+    letters = iter(name)
+    return all(c in letters for c in query)
+
+class SearchIndex:
+    def __init__(self, session=None):
+        # (kind, key, name, name unit notes and labels), in lower case
+        self.entries = []
+
+        self.last_query = ""
+        self.last_matches = None
+
+        if session != None:
+            self.build(session)
+
+    def build(self, session):
+        self.entries = []
+        self.last_query = ""
+        self.last_matches = None
+
+        for (kind, entries) in ((MEASUREMENT, session.measurements), (SETTING, session.settings), (OVERRIDE, session.overrides)):
+            for key, entry in entries.items():
+                labels = entry.values if kind == MEASUREMENT else entry.choices
+                text = "\n".join([entry.name, entry.unit, entry.notes] + [str(label) for label in labels.values()])
+                self.entries.append((kind, key, entry.name.lower(), text.lower()))
+
+    def rank(self, query, name, text):
+        if name == query:
+            return RANK_EXACT
+        if name.startswith(query):
+            return RANK_PREFIX
+        if query in name:
+            return RANK_NAME
+        if query in text:
+            return RANK_TEXT
+        if fuzzy_match(query, name):
+            return RANK_FUZZY
+        return -1
+
+    # Returns [(kind, key, rank)] best matches first, def order within a rank.
+    # An empty query returns None.
+    def search(self, query):
+        query = query.strip().lower()
+        if query == "":
+            self.last_query = ""
+            self.last_matches = None
+            return None
+
+        # Anything matching the longer query matched the shorter one
+        if self.last_matches != None and query.startswith(self.last_query):
+            candidates = self.last_matches
+        else:
+            candidates = self.entries
+
+        matches = []
+        results = []
+        for entry in candidates:
+            (kind, key, name, text) = entry
+            rank = self.rank(query, name, text)
+            if rank != -1:
+                matches.append(entry)
+                results.append((kind, key, rank))
+
+        self.last_query = query
+        self.last_matches = matches
+
+        results.sort(key=lambda result: result[2])
+        return results
+
+# Shows the source rows given a rank, lowest rank first. The rows shown are kept as a
+# list, so filtering costs one sort and mapping a row is a lookup, without calling back
+# into Python for every row. Value updates of the source pass straight through.
+class RankFilterProxy(QAbstractProxyModel):
+    def __init__(self):
+        super().__init__()
+
+        # Proxy row -> source row and back
+        self.rows = []
+        self.proxy_rows = {}
+
+    def setSourceModel(self, model):
+        super().setSourceModel(model)
+        model.dataChanged.connect(self.sourceDataChanged)
+        model.modelReset.connect(self.sourceReset)
+
+    def setRanks(self, ranks):
+        self.beginResetModel()
+        self.rows = sorted(ranks, key=lambda row: (ranks[row], row))
+        self.proxy_rows = {row: i for i, row in enumerate(self.rows)}
+        self.endResetModel()
+
+    def sourceReset(self):
+        self.setRanks({})
+
+    # The changed source rows can be anywhere in the proxy, the view only redraws what it shows
+    def sourceDataChanged(self, top_left, bottom_right, roles=[]):
+        if len(self.rows) > 0:
+            self.dataChanged.emit(self.index(0, top_left.column()), self.index(len(self.rows) - 1, bottom_right.column()), roles)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid() or self.sourceModel() == None:
+            return 0
+        return self.sourceModel().columnCount()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or row < 0 or row >= len(self.rows) or column < 0 or column >= self.columnCount():
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=QModelIndex()):
+        return QModelIndex()
+
+    def mapToSource(self, proxy_index):
+        if not proxy_index.isValid():
+            return QModelIndex()
+        return self.sourceModel().index(self.rows[proxy_index.row()], proxy_index.column())
+
+    def mapFromSource(self, source_index):
+        if not source_index.isValid() or source_index.row() not in self.proxy_rows:
+            return QModelIndex()
+        return self.index(self.proxy_rows[source_index.row()], source_index.column())
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and self.sourceModel() != None:
+            return self.sourceModel().headerData(section, orientation, role)
+        return None
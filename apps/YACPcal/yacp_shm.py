@@ -0,0 +1,297 @@
+"""
+yacp_shm.py
+Yet Another Calibration Protocol (YACP)
+
+Publishes the live cal images of connected devices in named shared memory blocks so
+other processes on the same PC (test sequencers, HIL scripts, dashboards) can read
+the values YACPcal is already polling without opening the CAN adaptor themselves.
+Only the Python standard library is needed to read them.
+
+YACPcal publishes a device when `SharedMemory` in yacp.ini is set to a name prefix. The
+block of a device is named "<prefix>-<bus>-<base CAN ID in hex>-<device ID>", with
+anything but letters and digits in the bus replaced by _, e.g.
+yacp-pcan_PCAN_USBBUS1-100-1. Block layout:
+ header   HEADER, see below
+ layout   JSON: the device, its bus, the PID of the publisher and the entries of the
+          def with their type and their offset in their image
+ images   the measurement, setting and override images as the device holds them
+
+The header's sequence counter is odd while the images are being written. Readers
+read it, read the values, and read it again; when it changed or was odd they retry
+(a seqlock), so they never block the publisher.
+
+    reader = ShmReader("yacp-pcan_PCAN_USBBUS1-100-1")
+    reader.value("batt_voltage")
+    reader.snapshot()["settings"]["device_id"]
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import json
+import os
+import re
+import struct
+import sys
+import time
+
+from multiprocessing import shared_memory
+
+SHM_MAGIC = b'YACP'
+SHM_VERSION = 1
+
+# magic, version, device state, sequence, layout size, publish time (time.time()),
+# then the offset and size of the measurement, setting and override images
+HEADER = struct.Struct('<4sHHIIdIIIIII')
+STATE_OFFSET = 6
+SEQUENCE_OFFSET = 8
+TIME_OFFSET = 16
+
+# Reads given up on when the publisher keeps writing
+READ_RETRIES = 1000
+
+KINDS = ["measurements", "settings", "overrides"]
+
+# struct formats of the cal types, the same as yacp.py's
+FORMATS = {
+    "uint8": "B",
+    "int8": "b",
+    "uint16": "H",
+    "int16": "h",
+    "uint32": "I",
+    "int32": "i",
+    "float": "f",
+}
+
+def attach_shared_memory(name, own_tracker=True):
+    # The creating process owns the block, attaching must not register it for cleanup.
+    # Processes spawned by the owner share its resource tracker and need no fix up.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if own_tracker:
+            untrack(shm)
+        return shm
+
+def untrack(shm):
+    # Blocks attached with track=False were never registered
+    if not getattr(shm, '_track', True):
+        return
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except:
+        pass
+
+# Devices with the same IDs on different channels get their own blocks
+def block_name(prefix, bus, base_can_id, device_id):
+    return "%s-%s-%x-%d" % (prefix, re.sub('[^0-9A-Za-z]+', '_', bus).strip('_'), base_can_id, device_id)
+
+# PID of the process that published a block, None when it is not a YACP block
+def block_owner(name):
+    # Whether the tracker may let go of the block is only known once the owner is
+    shm = attach_shared_memory(name, own_tracker=False)
+    owner = None
+    try:
+        header = HEADER.unpack_from(shm.buf, 0)
+        if header[0] == SHM_MAGIC and header[1] == SHM_VERSION:
+            layout = json.loads(bytes(shm.buf[HEADER.size:HEADER.size+header[4]]).decode())
+            owner = layout.get("owner_pid")
+    except ValueError:
+        pass
+
+    if owner != os.getpid():
+        untrack(shm)
+    shm.close()
+    return owner
+
+def process_running(pid):
+    if sys.platform == 'win32':
+        # Blocks go away with the last process holding them, one that exists is in use
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def session_layout(session):
+    device = session.device
+    layout = {
+        "device_id": session.device_id,
+        "base_can_id": session.base_can_id,
+        "bus": device.bus if device != None else "",
+        "owner_pid": os.getpid(),
+        "product_id": device.product_id if device != None else 0,
+        "cal_revision": device.cal_revision if device != None else 0,
+    }
+
+    for kind, entries in zip(KINDS, [session.measurements, session.settings, session.overrides]):
+        layout[kind] = []
+        for entry in entries.values():
+            item = {"name": entry.name, "type": entry.cal_type, "unit": entry.unit, "offset": entry.offset}
+            if kind == "overrides":
+                # The status byte is at the offset, the value after it
+                item["value_offset"] = entry.value_offset
+            layout[kind].append(item)
+
+    return layout
+
+class ShmPublisher:
+    def __init__(self, session, name):
+        self.name = name
+        self.device_state = None
+
+        layout = json.dumps(session_layout(session)).encode()
+        images = [session.measurement_image, session.setting_image, session.override_image]
+
+        self.image_offsets = []
+        offset = HEADER.size + len(layout)
+        for image in images:
+            self.image_offsets.append(offset)
+            offset += len(image)
+
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=offset)
+        except FileExistsError:
+            # Only a block left behind by a YACPcal that is gone is taken over, one that
+            # is still published would go on being read by its readers
+            owner = block_owner(name)
+            if owner == None:
+                raise FileExistsError("Shared memory "+name+" exists and was not published by YACPcal")
+            if owner == os.getpid() or process_running(owner):
+                raise FileExistsError("Shared memory "+name+" is published by the running process "+str(owner))
+
+            stale = attach_shared_memory(name, own_tracker=False)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=offset)
+
+        self.sequence = 0
+        sizes = []
+        for image_offset, image in zip(self.image_offsets, images):
+            sizes += [image_offset, len(image)]
+        HEADER.pack_into(self.shm.buf, 0, SHM_MAGIC, SHM_VERSION, session.device_state, self.sequence, len(layout), time.time(), *sizes)
+        self.shm.buf[HEADER.size:HEADER.size+len(layout)] = layout
+
+        self.publish(session)
+
+    def writeSequence(self):
+        struct.pack_into('<I', self.shm.buf, SEQUENCE_OFFSET, self.sequence)
+
+    def publish(self, session):
+        buf = self.shm.buf
+
+        self.sequence += 1
+        self.writeSequence()
+
+        struct.pack_into('<H', buf, STATE_OFFSET, session.device_state)
+        struct.pack_into('<d', buf, TIME_OFFSET, time.time())
+        for image_offset, image in zip(self.image_offsets, [session.measurement_image, session.setting_image, session.override_image]):
+            buf[image_offset:image_offset+len(image)] = image
+
+        self.sequence += 1
+        self.writeSequence()
+        self.device_state = session.device_state
+
+    def close(self):
+        # Readers still attached see the device disconnected
+        buf = self.shm.buf
+        self.sequence += 1
+        self.writeSequence()
+        struct.pack_into('<H', buf, STATE_OFFSET, 0)
+        self.sequence += 1
+        self.writeSequence()
+
+        self.shm.close()
+        self.shm.unlink()
+
+class ShmReader:
+    # own_tracker is False when reading in the process that publishes the block
+    def __init__(self, name, own_tracker=True):
+        self.name = name
+        self.shm = attach_shared_memory(name, own_tracker)
+
+        header = HEADER.unpack_from(self.shm.buf, 0)
+        if header[0] != SHM_MAGIC or header[1] != SHM_VERSION:
+            self.shm.close()
+            raise ValueError(name+" is not a YACP shared memory block")
+
+        layout_size = header[4]
+        self.layout = json.loads(bytes(self.shm.buf[HEADER.size:HEADER.size+layout_size]).decode())
+        image_offsets = header[6::2]
+
+        # (kind, name) -> (struct, offset in the block[, status offset])
+        self.entries = {}
+        for kind, image_offset in zip(KINDS, image_offsets):
+            for item in self.layout[kind]:
+                value_format = struct.Struct('<'+FORMATS[item["type"]])
+                offset = image_offset + item["offset"]
+                if kind == "overrides":
+                    self.entries[(kind, item["name"])] = (value_format, offset + item["value_offset"], offset)
+                else:
+                    self.entries[(kind, item["name"])] = (value_format, offset)
+
+    @property
+    def sequence(self):
+        return struct.unpack_from('<I', self.shm.buf, SEQUENCE_OFFSET)[0]
+
+    # Runs read() on the block until the publisher did not write meanwhile
+    def consistent(self, read):
+        for i in range(READ_RETRIES):
+            sequence = self.sequence
+            if sequence & 1:
+                time.sleep(0)
+                continue
+
+            result = read()
+            if self.sequence == sequence:
+                return result
+
+        raise TimeoutError("The images of "+self.name+" kept changing")
+
+    def readEntry(self, key):
+        entry = self.entries[key]
+        value = entry[0].unpack_from(self.shm.buf, entry[1])[0]
+        if key[0] == "overrides":
+            return (value, self.shm.buf[entry[2]] != 0)
+        return value
+
+    # Overrides read as (value, overridden)
+    def value(self, name, kind="measurements"):
+        return self.consistent(lambda: self.readEntry((kind, name)))
+
+    def header(self):
+        header = HEADER.unpack_from(self.shm.buf, 0)
+        return {"device_state": header[2], "sequence": header[3], "time": header[5]}
+
+    # Every value and the header from one publication, as {kind: {name: value}}
+    def snapshot(self):
+        def read():
+            values = self.header()
+            for kind in KINDS:
+                values[kind] = {}
+            for key in self.entries:
+                values[key[0]][key[1]] = self.readEntry(key)
+            return values
+
+        return self.consistent(read)
+
+    # Returns the sequence once the images were published again after sequence,
+    # or None after timeout seconds
+    def wait(self, sequence, timeout=1.0, interval=0.001):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            current = self.sequence
+            if current != sequence and not current & 1:
+                return current
+            time.sleep(interval)
+        return None
+
+    def close(self):
+        self.shm.close()
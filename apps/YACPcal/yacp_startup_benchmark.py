@@ -0,0 +1,102 @@
+"""
+yacp_startup_benchmark.py
+Yet Another Calibration Protocol (YACP)
+
+Measures how long YACPcal takes to start. Each run starts YACPcal in a new process
+with --startup-benchmark in a scratch directory, with a yacp.ini that has the given
+def as the def of the last session. YACPcal reports the time its imports took, the
+time until its window was shown and the time until the def was loaded in the
+background, all from the start of YACPcal.py. The whole run, including starting
+the interpreter, is timed here.
+
+Fails (exit code 1) when the median time to the window being shown is over
+--max-shown-ms, or when pyqtgraph, python-can or numpy were loaded before it was.
+
+ python yacp_startup_benchmark.py --def project-def.json --runs 5 --max-shown-ms 1500
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import argparse
+import configparser
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RUNS = 5
+
+def run_once(defFile):
+    directory = tempfile.mkdtemp(prefix="yacp-startup-")
+    try:
+        config = configparser.ConfigParser()
+        config['YACP'] = {'LastDef': os.path.abspath(defFile) if defFile else ''}
+        config['RecentCals'] = {}
+        config['RecentDefs'] = {}
+        if defFile:
+            config['RecentDefs'][os.path.basename(defFile)] = os.path.abspath(defFile)
+        with open(os.path.join(directory, 'yacp.ini'), 'w') as configfile:
+            config.write(configfile)
+
+        # Runs headless where there is no display
+        env = dict(os.environ)
+        if sys.platform.startswith('linux') and 'DISPLAY' not in env and 'WAYLAND_DISPLAY' not in env:
+            env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'YACPcal.py')
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, script, '--startup-benchmark'], cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120)
+        total = (time.perf_counter() - started) * 1000
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for line in result.stdout.splitlines():
+        if line.startswith("startup "):
+            values = dict(field.split('=') for field in line.split()[1:])
+            times = {name: float(values[name]) for name in ['imports', 'shown', 'def']}
+            times['total'] = total
+            loaded = [name for name in ['pyqtgraph', 'can', 'numpy'] if values.get(name) == '1']
+            return (times, loaded)
+
+    raise RuntimeError("YACPcal did not report its startup:\n"+result.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of YACPcal')
+    parser.add_argument('--def', dest='def_file', default='', help='def loaded in the background as the last session\'s def')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--max-shown-ms', type=float, default=None, help='fail if the median time to the window being shown is longer')
+    args = parser.parse_args()
+
+    if args.def_file and not os.path.exists(args.def_file):
+        print("No def file "+args.def_file)
+        return 1
+
+    runs = []
+    deferred_loaded = set()
+    for i in range(args.runs):
+        (times, loaded) = run_once(args.def_file)
+        runs.append(times)
+        deferred_loaded |= set(loaded)
+        print("run %d: imports %.0f ms, shown %.0f ms, def %.0f ms, process %.0f ms" % (i + 1, times['imports'], times['shown'], times['def'], times['total']))
+
+    medians = {name: statistics.median(times[name] for times in runs) for name in ['imports', 'shown', 'def', 'total']}
+    print("median: imports %.0f ms, shown %.0f ms, def %.0f ms, process %.0f ms" % (medians['imports'], medians['shown'], medians['def'], medians['total']))
+
+    failed = False
+    if len(deferred_loaded) > 0:
+        print("Loaded at startup: "+", ".join(sorted(deferred_loaded)))
+        failed = True
+    if args.max_shown_ms != None and medians['shown'] > args.max_shown_ms:
+        print("Window shown after %.0f ms, the limit is %.0f ms" % (medians['shown'], args.max_shown_ms))
+        failed = True
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+yacp_stimulus.py
+Yet Another Calibration Protocol (YACP)
+
+Runs timed override stimulus profiles against a connected device. A profile is a list
+of (time, override, value, status) steps, from a CSV file or built in a script. The
+steps are timed by their own thread against absolute deadlines, independent of the
+Qt timers, and sent by the thread that owns the session. The time each one actually
+went out is logged so the jitter can be reported.
+
+Profile CSV: time (seconds from the start), override name, value, status
+(Overridden or Passthrough, default Overridden)
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import csv
+import math
+import sys
+import time
+
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+
+from yacp import parse_value
+
+# Time before a step that is busy waited instead of slept, covers the OS sleep granularity
+SPIN_TIME = 0.016 if sys.platform == 'win32' else 0.002
+
+class StimulusStep:
+    def __init__(self, time, override, value, status):
+        self.time = time
+        self.override = override
+        self.value = value
+        self.status = status
+
+class StimulusProfile:
+    def __init__(self):
+        self.steps = []
+
+    def add(self, time, override, value, status="Overridden"):
+        self.steps.append(StimulusStep(float(time), override, str(value), status))
+
+    def loadCSV(self, fileName):
+        with open(fileName, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            for row in reader:
+                if len(row) < 3 or row[0].strip().lower() == "time" or row[0].lstrip().startswith("#"):
+                    continue
+
+                status = "Overridden"
+                if len(row) > 3 and row[3].strip() != "":
+                    status = row[3].strip()
+
+                self.add(row[0].strip(), row[1].strip(), row[2].strip(), status)
+
+class StimulusRunner(QThread):
+    # Same arguments as YACPProtocol.app_update_override_signal
+    update_override_signal = pyqtSignal(int,int,int)
+    # Profile errors found by resolve
+    error_signal = pyqtSignal(str)
+    # Steps that are due, with their scheduled time. The runner is owned by the thread
+    # of the session, so the steps are sent there and not from the run thread
+    send_step_signal = pyqtSignal(float,object)
+
+    def __init__(self, session, profile):
+        QThread.__init__(self)
+
+        self.session = session
+        self.profile = profile
+        self.stop = False
+
+        # (time, [(override key, value, status)]), steps at the same time are sent together
+        self.schedule = []
+        # (scheduled time, sent time, number of overrides), from the start of the run
+        self.log = []
+        self.start_time = 0
+
+        self.send_step_signal.connect(self.sendStep)
+
+    # Checks the profile against the session's overrides before anything is sent
+    def resolve(self):
+        names = {override.name: key for key, override in self.session.overrides.items()}
+
+        groups = {}
+        for step in sorted(self.profile.steps, key=lambda step: step.time):
+            if step.override not in names:
+                self.error_signal.emit("Unknown override "+step.override+" at "+str(step.time)+" s")
+                return False
+            if step.status != "Overridden" and step.status != "Passthrough":
+                self.error_signal.emit("Unknown status "+step.status+" at "+str(step.time)+" s")
+                return False
+
+            override_key = names[step.override]
+            try:
+                parse_value(self.session.overrides[override_key].cal_type, step.value)
+            except ValueError:
+                self.error_signal.emit("Invalid value "+step.value+" for "+step.override+" at "+str(step.time)+" s")
+                return False
+
+            groups.setdefault(step.time, []).append((override_key, step.value, step.status))
+
+        self.schedule = sorted(groups.items())
+        return True
+
+    def run(self):
+        self.log = []
+
+        # Deadlines are absolute from the start so a late step does not delay the ones after it
+        self.start_time = time.perf_counter()
+        for (step_time, changes) in self.schedule:
+            self.waitUntil(self.start_time + step_time)
+            if self.stop:
+                return
+
+            self.send_step_signal.emit(step_time, changes)
+
+    def sendStep(self, step_time, changes):
+        session = self.session
+        if self.stop:
+            return
+
+        # Several overrides due at once are applied as one transaction where the device
+        # supports it, built from the step's own changes and not the user's staged ones
+        if len(changes) == 1:
+            [(override_key, value, status)] = changes
+            session.sendOverrideChange(override_key, value, status)
+        else:
+            session.applyOverrides({override_key: (parse_value(session.overrides[override_key].cal_type, value), status) for (override_key, value, status) in changes})
+        sent = time.perf_counter()
+
+        self.log.append((step_time, sent - self.start_time, len(changes)))
+
+        for (override_key, value, status) in changes:
+            self.update_override_signal.emit(session.overrides[override_key].index, override_key, status == "Overridden")
+
+    def waitUntil(self, deadline):
+        while not self.stop:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            if remaining > SPIN_TIME:
+                time.sleep(remaining - SPIN_TIME)
+
+    # Lateness of each step in seconds
+    def errors(self):
+        return [sent - scheduled for (scheduled, sent, count) in self.log]
+
+    def report(self):
+        errors = self.errors()
+        if len(errors) == 0:
+            return "No steps sent"
+
+        mean = sum(errors) / len(errors)
+        jitter = math.sqrt(sum((e - mean) ** 2 for e in errors) / len(errors))
+        ordered = sorted(errors)
+        p99 = ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+
+        return "%d steps, late by %.3f ms mean, %.3f ms max, %.3f ms p99, jitter %.3f ms" % (len(errors), mean * 1000, max(errors) * 1000, p99 * 1000, jitter * 1000)
+
+    def saveLog(self, fileName):
+        with open(fileName, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["scheduled_s", "sent_s", "error_ms", "overrides"])
+            for (scheduled, sent, count) in self.log:
+                writer.writerow(["%.6f" % scheduled, "%.6f" % sent, "%.3f" % ((sent - scheduled) * 1000), count])
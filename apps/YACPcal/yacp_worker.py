@@ -0,0 +1,365 @@
+"""
+yacp_worker.py
+Yet Another Calibration Protocol (YACP)
+
+Out of process CAN I/O for YACPcal. The bus, the measurement polling and the frame
+decoding run in a separate process so they do not compete with the GUI for the GIL.
+Decoded frames come back through a shared memory ring buffer, commands go out
+through a queue.
+
+Matthew Bergman 2021
+
+MIT license, all text above must be included in any redistribution.
+See license.txt at the root of the repository for full license text.
+"""
+
+import traceback
+import struct
+import time
+import queue
+import multiprocessing
+
+from multiprocessing import shared_memory
+
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+
+from yacp import YACPProtocol, RequestTimes, AdaptorClock, encode_frame, decode_frame, is_extended, open_bus
+from yacp_shm import attach_shared_memory
+
+# Ring header: write count (uint64)
+RING_HEADER = struct.Struct('<Q')
+# Decoded frame: receive time on the host clock, round trip of the request it answers, base CAN ID,
+# var_start, device ID, message type, var_len, data
+RING_RECORD = struct.Struct('<ddIIHBB4s')
+RING_CAPACITY = 65536
+
+# Period of the measurement polling done by the worker, one request per device
+POLL_PERIOD = 0.02
+
+class SharedRing:
+    def __init__(self, name=None, capacity=RING_CAPACITY):
+        size = RING_HEADER.size + capacity * RING_RECORD.size
+
+        if name == None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            RING_HEADER.pack_into(self.shm.buf, 0, 0)
+        else:
+            self.shm = attach_shared_memory(name, own_tracker=False)
+
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.write_count = 0
+        self.read_count = 0
+        self.dropped = 0
+
+    # Single writer: the record is written before the count is published
+    def write(self, *record):
+        offset = RING_HEADER.size + (self.write_count % self.capacity) * RING_RECORD.size
+        RING_RECORD.pack_into(self.shm.buf, offset, *record)
+        self.write_count += 1
+        RING_HEADER.pack_into(self.shm.buf, 0, self.write_count)
+
+    # Single reader: returns every record written since the last read
+    def read(self):
+        [write_count] = RING_HEADER.unpack_from(self.shm.buf, 0)
+
+        if write_count - self.read_count > self.capacity:
+            self.dropped += write_count - self.read_count - self.capacity
+            self.read_count = write_count - self.capacity
+
+        start = self.read_count
+        records = []
+        while self.read_count < write_count:
+            offset = RING_HEADER.size + (self.read_count % self.capacity) * RING_RECORD.size
+            records.append(RING_RECORD.unpack_from(self.shm.buf, offset))
+            self.read_count += 1
+
+        # The writer may have lapped the reader during the copy. Record N shares its
+        # slot with record N + capacity, which is being written once N + capacity
+        # records are published, so those records may be torn
+        [write_count] = RING_HEADER.unpack_from(self.shm.buf, 0)
+        overwritten = min(write_count - self.capacity + 1 - start, len(records))
+        if overwritten > 0:
+            self.dropped += overwritten
+            records = records[overwritten:]
+
+        return records
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+def worker_main(bustype, channel, bitrate, ring_name, commands, status):
+    import can
+
+    try:
+        bus = open_bus(bustype, channel, bitrate)
+    except Exception as e:
+        status.put((1, str(e), 0))
+        return
+
+    ring = SharedRing(ring_name)
+    status.put((0, "", 0))
+
+    # Supervision, as in CANThread: the bus is reopened with backoff once it is lost
+    # and the polls carry on where they were, silent devices are only reported
+    last_receive = time.monotonic()
+    last_receive_time = time.time()
+    silent = False
+    send_errors = 0
+    reconnect_time = None
+    reconnect_delay = YACPProtocol.BUS_RECONNECT_MIN
+    request_times = RequestTimes()
+    adaptor_clock = AdaptorClock()
+
+    scan_base_can_ids = set()
+    listen_ids = {}
+    # (base_can_id, device_id) -> [request frames, index, background frames, index, count],
+    # each frame is a (CAN ID, data) pair
+    polls = {}
+    next_poll = time.perf_counter()
+
+    def send(msg_id, msg_data):
+        nonlocal send_errors
+        if bus == None:
+            return
+        request_times.sent(msg_id, msg_data)
+        try:
+            bus.send(can.Message(arbitration_id=msg_id, is_extended_id=msg_id > 0x7FF, data=msg_data), 1)
+            send_errors = 0
+        except:
+            if send_errors == 0:
+                traceback.print_exc()
+            send_errors += 1
+
+    running = True
+    while running:
+        # Commands from the GUI process
+        while True:
+            try:
+                command = commands.get_nowait()
+            except queue.Empty:
+                break
+
+            if command[0] == 'send':
+                send(command[1], command[2])
+            elif command[0] == 'scan':
+                scan_base_can_ids = set(command[1])
+            elif command[0] == 'listen':
+                listen_ids.setdefault(command[1], set()).add(command[2])
+            elif command[0] == 'unlisten':
+                if command[1] in listen_ids:
+                    listen_ids[command[1]].discard(command[2])
+                polls.pop((command[1], command[2]), None)
+            elif command[0] == 'poll':
+                # Silence is timed from when answers are first expected
+                if len(polls) == 0:
+                    last_receive = time.monotonic()
+                if command[3] or command[4]:
+                    polls[(command[1], command[2])] = [command[3], 0, command[4], 0, 0]
+                else:
+                    polls.pop((command[1], command[2]), None)
+            elif command[0] == 'stop':
+                running = False
+
+        if bus == None:
+            if time.monotonic() >= reconnect_time:
+                try:
+                    bus = open_bus(bustype, channel, bitrate)
+                    send_errors = 0
+                    last_receive = time.monotonic()
+                    status.put((4, "", last_receive_time))
+                except:
+                    reconnect_time = time.monotonic() + reconnect_delay
+                    reconnect_delay = min(reconnect_delay * 2, YACPProtocol.BUS_RECONNECT_MAX)
+            if bus == None:
+                time.sleep(0.01)
+                continue
+
+        if send_errors >= YACPProtocol.BUS_SEND_ERROR_LIMIT:
+            try:
+                bus.shutdown()
+            except:
+                pass
+            bus = None
+            silent = False
+            reconnect_time = time.monotonic() + reconnect_delay
+            reconnect_delay = min(reconnect_delay * 2, YACPProtocol.BUS_RECONNECT_MAX)
+            status.put((3, "", last_receive_time))
+            continue
+
+        if not silent and len(polls) > 0 and time.monotonic() - last_receive > YACPProtocol.BUS_SILENCE_TIMEOUT:
+            silent = True
+            status.put((5, "", last_receive_time))
+
+        # Measurement polling, independent of the GUI timer
+        now = time.perf_counter()
+        if now >= next_poll:
+            next_poll += POLL_PERIOD
+            if next_poll < now:
+                next_poll = now + POLL_PERIOD
+
+            # The background frames get one poll in BACKGROUND_SWEEP_RATIO
+            for (base_can_id, device_id), poll in polls.items():
+                poll[4] += 1
+                if poll[2] and (not poll[0] or poll[4] % YACPProtocol.BACKGROUND_SWEEP_RATIO == 0):
+                    send(*poll[2][poll[3]])
+                    poll[3] = (poll[3] + 1) % len(poll[2])
+                else:
+                    send(*poll[0][poll[1]])
+                    poll[1] = (poll[1] + 1) % len(poll[0])
+
+        try:
+            msg = bus.recv(min(max(next_poll - time.perf_counter(), 0), 0.005))
+        except:
+            traceback.print_exc()
+            send_errors = YACPProtocol.BUS_SEND_ERROR_LIMIT
+            continue
+
+        if msg == None or msg.is_error_frame:
+            continue
+        last_receive = time.monotonic()
+        last_receive_time = time.time()
+        reconnect_delay = YACPProtocol.BUS_RECONNECT_MIN
+        if silent:
+            silent = False
+            status.put((6, "", last_receive_time))
+
+        if msg.dlc != 8:
+            continue
+
+        frame = decode_frame(msg.arbitration_id, msg.is_extended_id, msg.data)
+        if frame == None:
+            continue
+
+        [base_can_id, device_id, message_type, var_start, var_len] = frame
+        listening = base_can_id in listen_ids
+        if not listening and base_can_id not in scan_base_can_ids:
+            continue
+
+        if message_type != YACPProtocol.CAL_HELLO:
+            if not listening or device_id not in listen_ids[base_can_id]:
+                continue
+
+        round_trip = request_times.roundTrip(base_can_id, device_id, message_type, var_start)
+        ring.write(adaptor_clock.hostTime(msg.timestamp), round_trip, base_can_id, var_start, device_id, message_type, var_len, bytes(msg.data[4:8]))
+
+    if bus != None:
+        bus.shutdown()
+    ring.close()
+
+class CANProcess(QThread):
+    # Everything read from the ring at once goes to the GUI thread in one signal, the
+    # records as laid out in RING_RECORD
+    update_frames_signal = pyqtSignal(str,object)
+    send_status_signal = pyqtSignal(str,int)
+
+    # Measurement polling of connected sessions is done by the worker process
+    schedules_polls = True
+
+    def __init__(self):
+        self.bus = None
+        self.name = ""
+        self.stop = False
+        self.process = None
+        self.ring = None
+        # time.time() of the last frame as of the latest report from the worker
+        self.last_receive_time = 0
+
+        context = multiprocessing.get_context('spawn')
+        self.context = context
+        self.commands = context.Queue()
+        self.status = context.Queue()
+
+        QThread.__init__(self)
+
+    def set_scan_base_can_ids(self, base_can_ids):
+        self.commands.put(('scan', list(base_can_ids)))
+
+    def addDevice(self, base_can_id, device_id):
+        self.commands.put(('listen', base_can_id, device_id))
+
+    def removeDevice(self, base_can_id, device_id):
+        self.commands.put(('unlisten', base_can_id, device_id))
+
+    def setPollList(self, base_can_id, device_id, poll_list, background=[]):
+        self.commands.put(('poll', base_can_id, device_id, poll_list, background))
+
+    def connect(self, _type, _channel, _bitrate):
+        self.name = str(_type)+":"+str(_channel)
+
+        self.ring = SharedRing()
+        self.process = self.context.Process(target=worker_main, args=(_type, _channel, _bitrate, self.ring.name, self.commands, self.status), daemon=True)
+        self.process.start()
+
+        try:
+            [result, error, self.last_receive_time] = self.status.get(timeout=10)
+        except queue.Empty:
+            [result, error] = [1, "CAN worker did not start"]
+
+        if result == 0:
+            self.bus = self.process
+            self.send_status_signal.emit(self.name, 0)
+        else:
+            print(error)
+            self.shutdown()
+            self.ring.close(unlink=True)
+            self.ring = None
+            self.send_status_signal.emit(self.name, 1)
+
+    def disconnect(self):
+        if self.bus == None:
+            return
+
+        self.shutdown()
+        self.send_status_signal.emit(self.name, 2)
+
+    def shutdown(self):
+        self.bus = None
+
+        if self.process != None:
+            self.commands.put(('stop',))
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+
+    def run(self):
+        while self.stop == False:
+            ring = self.ring
+            if ring == None or self.bus == None:
+                self.msleep(10)
+                continue
+
+            # Supervision reports from the worker, the bus stays open from here
+            while True:
+                try:
+                    [result, error, self.last_receive_time] = self.status.get_nowait()
+                except queue.Empty:
+                    break
+                self.send_status_signal.emit(self.name, result)
+
+            records = ring.read()
+            if len(records) == 0:
+                self.msleep(2)
+                continue
+
+            self.update_frames_signal.emit(self.name, records)
+
+        if self.ring != None:
+            self.ring.close(unlink=True)
+            self.ring = None
+
+    def sendCommand(self, base_can_id, device_id, message_type, var_start=0, var_len=0, b0=0,b1=0,b2=0,b3=0):
+        [msg_id, msg_data] = encode_frame(base_can_id, device_id, message_type, var_start, var_len, b0,b1,b2,b3)
+
+        self.sendCANMessage(msg_id, msg_data)
+
+    def sendHello(self, base_can_id):
+        self.sendCommand(base_can_id, YACPProtocol.YACP_EXT_BROADCAST if is_extended(base_can_id) else 0, YACPProtocol.CAL_HELLO)
+
+    def sendCANMessage(self, msg_id, msg_data):
+        if self.bus != None:
+            self.commands.put(('send', msg_id, msg_data))